@@ -0,0 +1,25 @@
+'''Timing helpers shared by the benchmarks.'''
+import time
+
+import torch
+
+
+def sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, n_iters, device, n_warmup=3):
+    '''Average seconds per call of fn after n_warmup calls, the peak cuda memory
+    stats are reset after the warmup'''
+    device = torch.device(device)
+    for _ in range(n_warmup):
+        fn()
+    sync(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    eps_time = time.time()
+    for _ in range(n_iters):
+        fn()
+    sync(device)
+    return (time.time() - eps_time) / n_iters
@@ -0,0 +1,96 @@
+'''Micro-benchmark of the field-head marching.
+
+Compares the fused single-pass `march_heads` (SegmentMarch) against the
+former four separate `segment_coo` calls for rgb, seg, dual-seg and depth, in
+the segmentation setting (only the mask channels require gradients).
+
+    python benchmarks/march_heads.py --n_rays 8192 --n_samples 64 --num_objects 1
+'''
+import os, sys, argparse
+
+import torch
+from torch_scatter import segment_coo
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.render_core import march_heads
+from benchmarks.common import timeit
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rays', type=int, default=8192)
+    parser.add_argument('--n_samples', type=int, default=64,
+                        help='average number of surviving samples per ray')
+    parser.add_argument('--num_objects', type=int, default=1)
+    parser.add_argument('--n_iters', type=int, default=100)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser
+
+
+def make_inputs(n_rays, n_samples, num_objects, device):
+    n_pts = n_rays * n_samples
+    ray_id = torch.sort(torch.randint(0, n_rays, [n_pts], device=device))[0]
+    weights = torch.rand([n_pts], device=device)
+    rgb = torch.rand([n_pts, 3], device=device)
+    seg = torch.rand([n_pts, num_objects], device=device, requires_grad=True)
+    dual_seg = torch.rand([n_pts, num_objects], device=device, requires_grad=True)
+    step_id = torch.randint(0, n_samples, [n_pts], device=device)
+    return weights, ray_id, [rgb, seg, dual_seg, step_id]
+
+
+def march_four_calls(vals, weights, ray_id, N):
+    '''The per-head segment_coo calls used before the fused march.'''
+    rgb, seg, dual_seg, step_id = vals
+    rgb_marched = segment_coo(
+            src=(weights.unsqueeze(-1) * rgb),
+            index=ray_id,
+            out=torch.zeros([N, 3], device=weights.device),
+            reduce='sum')
+    seg_mask_marched = segment_coo(
+            src=(weights.unsqueeze(-1) * seg),
+            index=ray_id,
+            out=torch.zeros([N, seg.shape[-1]], device=weights.device),
+            reduce='sum')
+    dual_seg_mask_marched = segment_coo(
+            src=(weights.unsqueeze(-1) * dual_seg),
+            index=ray_id,
+            out=torch.zeros([N, dual_seg.shape[-1]], device=weights.device),
+            reduce='sum')
+    depth = segment_coo(
+            src=(weights * step_id),
+            index=ray_id,
+            out=torch.zeros([N], device=weights.device),
+            reduce='sum')
+    return [rgb_marched, seg_mask_marched, dual_seg_mask_marched, depth]
+
+
+def march_fused(vals, weights, ray_id, N):
+    return march_heads(vals, [False, False, False, True], weights, ray_id, N)
+
+
+def main():
+    args = config_parser().parse_args()
+    torch.manual_seed(0)
+    weights, ray_id, vals = make_inputs(args.n_rays, args.n_samples, args.num_objects, args.device)
+    N = args.n_rays
+
+    # both versions must agree before being timed
+    for a, b in zip(march_four_calls(vals, weights, ray_id, N), march_fused(vals, weights, ray_id, N)):
+        assert torch.allclose(a, b, atol=1e-4, rtol=1e-4), 'fused march mismatch'
+
+    def step(march):
+        def fn():
+            marched = march(vals, weights, ray_id, N)
+            (marched[1].sum() + marched[2].sum()).backward()
+        return fn
+
+    print(f'march_heads: {len(weights)} samples, {N} rays, {args.num_objects} objects on {args.device}')
+    for name, march in [('four_calls', march_four_calls), ('fused', march_fused)]:
+        with torch.no_grad():
+            t_fwd = timeit(lambda: march(vals, weights, ray_id, N), args.n_iters, args.device)
+        t_bwd = timeit(step(march), args.n_iters, args.device)
+        print(f'{name:>10s}: forward {t_fwd*1e3:8.3f} ms   forward+backward {t_bwd*1e3:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
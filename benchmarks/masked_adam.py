@@ -0,0 +1,233 @@
+'''Micro-benchmark of the MaskedAdam step on a fine-stage parameter set.
+
+Compares the former per-tensor update (one kernel launch per parameter) against
+the multi-tensor update, which launches one kernel per update mode, and the
+sparse state, which only keeps and updates the moments of the density grid
+rows with non-zero grad, without and with the freeing of the cold rows. The
+parameters mimic a fine-stage model: a dense density grid, a TensoRF k0 grid
+(planes, vectors and the feature matrix) and the colors MLP. The multi-tensor
+update only applies to cuda tensors, on cpu both optimizers run the per-tensor
+update.
+
+The grads are redrawn at every step as in training: the batch hits a random
+grad_density fraction of the rows, within the `occupied` fraction of the rows
+the rays reach (the rest being pruned as free space), and the first tv_steps
+steps add a dense total variation grad to every voxel (tv_dense_before). The
+step time and the state size are reported once the TV phase is over.
+
+    python benchmarks/masked_adam.py --world_size 160 --n_comp 48 --tv_steps 100 --n_iters 300
+'''
+import os, sys, io, time, argparse
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.masked_adam import MaskedAdam
+from benchmarks.common import sync
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world_size', type=int, default=160)
+    parser.add_argument('--n_comp', type=int, default=48)
+    parser.add_argument('--rgbnet_dim', type=int, default=12)
+    parser.add_argument('--rgbnet_width', type=int, default=128)
+    parser.add_argument('--occupied', type=float, default=0.3,
+                        help='fraction of the density grid rows reached by the rays')
+    parser.add_argument('--grad_density', type=float, default=0.05,
+                        help='fraction of the grid rows (voxels of the k0 planes) with non-zero grads at a step')
+    parser.add_argument('--tv_steps', type=int, default=100,
+                        help='first steps with a dense total variation grad on every voxel')
+    parser.add_argument('--cold_steps', type=int, default=100,
+                        help='sparse_cold_steps of the sparse_cold optimizer')
+    parser.add_argument('--n_iters', type=int, default=300)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser
+
+
+def make_params(args):
+    # same layout as the fine stage (TensoRFGrid k0, DenseGrid density, rgbnet)
+    torch.manual_seed(0)
+    X = Y = Z = args.world_size
+    R = args.n_comp
+    density = [torch.randn([1, 1, X, Y, Z])]
+    k0 = [
+        torch.randn([1, R, X, Y]), torch.randn([1, R, X, Z]), torch.randn([1, R, Y, Z]),
+        torch.randn([1, R, Z, 1]), torch.randn([1, R, Y, 1]), torch.randn([1, R, X, 1]),
+        torch.randn([R*3, args.rgbnet_dim]),
+    ]
+    rgbnet = [
+        torch.randn([args.rgbnet_width, args.rgbnet_dim+27]), torch.randn([args.rgbnet_width]),
+        torch.randn([args.rgbnet_width, args.rgbnet_width]), torch.randn([args.rgbnet_width]),
+        torch.randn([3, args.rgbnet_width]), torch.randn([3]),
+    ]
+    groups = []
+    for params, lr, skip_zero_grad in [(density, 1e-1, True), (k0, 1e-1, True), (rgbnet, 1e-3, False)]:
+        params = [nn.Parameter(p.to(args.device)) for p in params]
+        groups.append({'params': params, 'lr': lr, 'skip_zero_grad': skip_zero_grad})
+    return groups
+
+
+def draw_grads(groups, args, it, tv=False):
+    '''Grads of the it-th batch, the same for every optimizer'''
+    generator = torch.Generator(args.device).manual_seed(it)
+    rand = lambda shape: torch.rand(shape, device=args.device, generator=generator)
+    for group in groups:
+        for p in group['params']:
+            grad = torch.randn(p.shape, device=args.device, generator=generator)
+            if not group['skip_zero_grad']:
+                p.grad = grad
+                continue
+            if p.dim() == 5:
+                # the rays of a batch touch a few rows of the dense grid, in the occupied space
+                occupied = torch.Generator(args.device).manual_seed(12345)
+                row_shape = [*p.shape[:-1], 1]
+                in_scene = torch.rand(row_shape, device=args.device, generator=occupied) < args.occupied
+                keep = in_scene & (rand(row_shape) < args.grad_density / args.occupied)
+            else:
+                keep = rand(p.shape) < args.grad_density
+            grad = grad * keep
+            if tv:
+                # dense total variation: a small grad on every voxel
+                grad = grad + 1e-6 * rand(p.shape)
+            p.grad = grad
+
+
+def state_nbytes(optimizer):
+    return sum(v.numel() * v.element_size()
+               for state in optimizer.state.values() for v in state.values() if torch.is_tensor(v))
+
+
+def max_param_diff(optimizer_a, optimizer_b):
+    max_diff = 0
+    for group_a, group_b in zip(optimizer_a.param_groups, optimizer_b.param_groups):
+        for a, b in zip(group_a['params'], group_b['params']):
+            max_diff = max(max_diff, (a - b).abs().max().item())
+    return max_diff
+
+
+def check_fixed_footprint(args):
+    '''With the same rows hit at every step all the variants match the per-tensor update'''
+    optimizers = [(name, MaskedAdam(make_params(args), **kwargs)) for name, kwargs in [
+        ('per_tensor', dict(multi_tensor=False)),
+        ('multi', dict(multi_tensor=True)),
+        ('sparse', dict(sparse_state=True)),
+    ]]
+    for _, optimizer in optimizers:
+        draw_grads(optimizer.param_groups, args, 0)
+        for _ in range(5):
+            optimizer.step()
+    for name, optimizer in optimizers[1:]:
+        max_diff = max_param_diff(optimizers[0][1], optimizer)
+        print(f'masked_adam: {name} vs per-tensor max abs diff {max_diff:.3e} (fixed footprint)')
+        assert max_diff < 1e-5, f'{name} MaskedAdam mismatch'
+    return optimizers
+
+
+def check_block_bias_correction(args, n_steps=40, cold_steps=10, beta1=0.9, beta2=0.99, lr=0.1, eps=1e-8):
+    '''Sparse state with redrawn footprints and cold blocks freeing against a per-row reference:
+    a row counts its own updates for the bias correction and restarts once freed'''
+    torch.manual_seed(0)
+    param = nn.Parameter(torch.randn([1, 2, 12, 12, 12], device=args.device))
+    ref = param.detach().clone().view(-1, 12)
+    optimizer = MaskedAdam([{'params': [param], 'lr': lr, 'skip_zero_grad': True}],
+                           betas=(beta1, beta2), eps=eps, sparse_state=True, sparse_cold_steps=cold_steps)
+    exp_avg, exp_avg_sq = torch.zeros_like(ref), torch.zeros_like(ref)
+    row_step = torch.zeros([len(ref)], device=args.device)
+    row_last = torch.zeros([len(ref)], device=args.device)
+    for it in range(1, n_steps+1):
+        generator = torch.Generator(args.device).manual_seed(it)
+        rows = torch.rand([*param.shape[:-1], 1], device=args.device, generator=generator) < 0.2
+        param.grad = torch.randn(param.shape, device=args.device, generator=generator) * rows
+        optimizer.step()
+
+        grad = param.grad.view(-1, 12)
+        hit = grad.ne(0).any(1)
+        keep = grad != 0
+        exp_avg[keep] = beta1 * exp_avg[keep] + (1-beta1) * grad[keep]
+        exp_avg_sq[keep] = beta2 * exp_avg_sq[keep] + (1-beta2) * grad[keep]**2
+        row_step[hit] += 1
+        row_last[hit] = it
+        step = row_step.double().clamp(min=1)
+        step_size = (lr * torch.sqrt(1 - beta2**step) / (1 - beta1**step)).float().unsqueeze(1)
+        ref -= (step_size * exp_avg / (exp_avg_sq.sqrt() + eps)) * keep
+        if it % cold_steps == 0:
+            cold = row_last <= it - cold_steps
+            exp_avg[cold], exp_avg_sq[cold], row_step[cold] = 0, 0, 0
+    max_diff = (param.detach().view(-1, 12) - ref).abs().max().item()
+    print(f'masked_adam: sparse_cold vs per-row reference max abs diff {max_diff:.3e} (redrawn footprints)')
+    assert max_diff < 1e-5, 'sparse MaskedAdam bias correction mismatch'
+
+
+def check_resume(name, optimizer):
+    '''Save / load the optimizer state as run.py does on resume and step both copies'''
+    buf = io.BytesIO()
+    torch.save(optimizer.state_dict(), buf)
+    buf.seek(0)
+    groups = []
+    for group in optimizer.param_groups:
+        params = []
+        for p in group['params']:
+            q = nn.Parameter(p.detach().clone())
+            q.grad = p.grad.clone()
+            params.append(q)
+        groups.append({'params': params, 'lr': group['lr'], 'skip_zero_grad': group['skip_zero_grad']})
+    resumed = MaskedAdam(groups, multi_tensor=optimizer.multi_tensor, sparse_state=optimizer.sparse_state,
+                         sparse_cold_steps=optimizer.sparse_cold_steps)
+    resumed.load_state_dict(torch.load(buf))
+    optimizer.step()
+    resumed.step()
+    max_diff = max_param_diff(optimizer, resumed)
+    print(f'masked_adam: {name} resumed vs original max abs diff {max_diff:.3e}')
+    assert max_diff == 0, f'{name} MaskedAdam resume mismatch'
+
+
+def run_training(args, optimizer):
+    '''The TV phase then n_iters steps, return the state size after the TV phase, at the end
+    and the average step time after the TV phase'''
+    groups = optimizer.param_groups
+    for it in range(args.tv_steps):
+        draw_grads(groups, args, it, tv=True)
+        optimizer.step()
+    tv_nbytes = state_nbytes(optimizer)
+    eps_time = 0
+    for it in range(args.tv_steps, args.tv_steps + args.n_iters):
+        draw_grads(groups, args, it)
+        sync(args.device)
+        eps_start = time.time()
+        optimizer.step()
+        sync(args.device)
+        eps_time += time.time() - eps_start
+    return tv_nbytes, state_nbytes(optimizer), eps_time / args.n_iters
+
+
+def main():
+    args = config_parser().parse_args()
+    for name, optimizer in check_fixed_footprint(args):
+        check_resume(name, optimizer)
+    check_block_bias_correction(args)
+
+    variants = [
+        ('per_tensor', dict(multi_tensor=False)),
+        ('multi', dict(multi_tensor=True)),
+        ('sparse', dict(sparse_state=True)),
+        ('sparse_cold', dict(sparse_state=True, sparse_cold_steps=args.cold_steps)),
+    ]
+    param_groups = make_params(args)
+    n_params = sum(len(g['params']) for g in param_groups)
+    n_elems = sum(p.numel() for g in param_groups for p in g['params'])
+    print(f'masked_adam: {n_params} params, {n_elems/1e6:.1f}M elements on {args.device}, '
+          f'{args.tv_steps} dense TV steps then {args.n_iters} steps hitting {args.grad_density:.0%} '
+          f'of the rows within {args.occupied:.0%} of the grid')
+    for name, kwargs in variants:
+        optimizer = MaskedAdam(make_params(args), **kwargs)
+        tv_nbytes, nbytes, eps_time = run_training(args, optimizer)
+        if name == 'sparse_cold':
+            check_resume(name, optimizer)
+        print(f'{name:>11s}: {eps_time*1e3:8.3f} ms, state {tv_nbytes/2**20:8.1f} MB after TV, '
+              f'{nbytes/2**20:8.1f} MB at the end')
+
+
+if __name__ == '__main__':
+    main()
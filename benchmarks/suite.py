@@ -0,0 +1,359 @@
+'''Benchmark suite of the render and segmentation hot paths.
+
+Times the ray sampling, the mask cache, the density activation, the
+transmittance accumulation, the grid lookups, the full forward per chunk of
+rays and the segmentation step (self-prompting with a stub SAM predictor and
+sam3d.optim) on a synthetic scene: random density / k0 grids around a sphere
+seen by synthetic cameras. Runs on cpu (the ray marching kernels fall back to
+torch) or cuda, and writes the timings, rays/s, samples/s and peak memory as
+json so that runs of different commits can be compared.
+
+    python benchmarks/suite.py --out bench.json
+    python benchmarks/suite.py --only forward,alphas2weights --compare bench.json --tolerance 0.1
+'''
+import os, sys, json, time, argparse, platform, resource, contextlib, subprocess
+
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from lib import dvgo, seg_dvgo, grid, utils
+from lib.config_loader import Config
+from lib.render_core import Raw2Alpha, Alphas2Weights
+from benchmarks.common import timeit
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rays', type=int, default=8192,
+                        help='rays per chunk, as render_viewpoints and the training batches')
+    parser.add_argument('--num_voxels', type=int, default=96**3)
+    parser.add_argument('--stepsize', type=float, default=0.5)
+    parser.add_argument('--HW', type=int, default=128,
+                        help='size of the synthetic views of the segmentation benchmarks')
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=777)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--only', type=str, default='',
+                        help='comma separated names of the benchmarks to run')
+    parser.add_argument('--out', type=str, default='',
+                        help='path of the json report')
+    parser.add_argument('--compare', type=str, default='',
+                        help='json report of a baseline run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown w.r.t. the baseline reported as a regression')
+    return parser
+
+
+def peak_memory_mb(device):
+    '''Peak allocated cuda memory since the last reset, or the peak rss of the process on cpu'''
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+''' Synthetic scene
+'''
+class Scene:
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+        torch.manual_seed(args.seed)
+        self.model = self.create_model(dvgo.DirectVoxGO)
+        self.rays_o, self.rays_d, self.viewdirs = self.create_rays(args.n_rays)
+        self.render_kwargs = {
+            'near': 0.1, 'far': 6., 'stepsize': args.stepsize, 'bg': 1.,
+            'inverse_y': False, 'flip_x': False, 'flip_y': False,
+        }
+
+    def create_model(self, model_class, **kwargs):
+        model = model_class(
+                xyz_min=[-1, -1, -1], xyz_max=[1, 1, 1],
+                num_voxels=self.args.num_voxels, num_voxels_base=self.args.num_voxels,
+                alpha_init=1e-2, fast_color_thres=1e-4,
+                rgbnet_dim=12, rgbnet_width=128, **kwargs).to(self.device)
+        with torch.no_grad():
+            # a noisy sphere of radius 0.6, so that the rays terminate early
+            xyz = torch.stack(torch.meshgrid(*[
+                torch.linspace(-1, 1, int(n), device=self.device) for n in model.world_size]), -1)
+            radius = xyz.norm(dim=-1)
+            density = 40 * (0.6 - radius) + torch.randn_like(radius)
+            model.density.grid.copy_(density[None, None])
+            model.k0.grid.normal_()
+            # the free space outside the sphere is known
+            model.mask_cache.mask.copy_(radius < 0.7)
+        return model
+
+    def create_rays(self, n_rays):
+        '''Rays from cameras on a sphere of radius 2.5 looking at random points of the scene'''
+        cam = torch.randn([n_rays, 3], device=self.device)
+        rays_o = 2.5 * cam / cam.norm(dim=-1, keepdim=True)
+        target = (torch.rand([n_rays, 3], device=self.device) * 2 - 1) * 0.8
+        rays_d = target - rays_o
+        viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+        return rays_o.contiguous(), rays_d.contiguous(), viewdirs.contiguous()
+
+    def samples(self):
+        '''The in-bbox samples of the rays, as seen by the density and the mask cache'''
+        samples, _ = self.model.sample_points(self.rays_o, self.rays_d, **self.render_kwargs)
+        return samples
+
+
+class StubPredictor:
+    '''SamPredictor.predict returning a disk around the prompt points'''
+    def __init__(self, H, W, radius):
+        self.H, self.W, self.radius = H, W, radius
+        self.n_calls = 0
+
+    def predict(self, point_coords=None, point_labels=None, multimask_output=False, **kwargs):
+        self.n_calls += 1
+        ys, xs = np.mgrid[:self.H, :self.W]
+        mask = np.zeros([self.H, self.W], dtype=bool)
+        for x, y in point_coords:
+            mask |= (xs - int(x))**2 + (ys - int(y))**2 <= self.radius**2
+        return mask[None], np.ones([1]), np.zeros([1, 256, 256])
+
+
+''' Benchmarks
+Each returns the function to time with the number of rays (pixels for the
+prompting) and of samples it processes per call (the samples surviving the
+filters for the full forward), or raises Skip when it cannot run here, e.g. when
+an optional dependency of the segmentation stage is not installed.
+'''
+class Skip(Exception):
+    pass
+
+
+def bench_sample_ray(scene):
+    model, kw = scene.model, scene.render_kwargs
+    n_samples = len(scene.samples()['ray_id'])
+    @torch.no_grad()
+    def fn():
+        model.sample_ray(scene.rays_o, scene.rays_d, **kw)
+    return fn, len(scene.rays_o), n_samples
+
+
+def bench_mask_cache(scene):
+    ray_pts = scene.samples()['ray_pts']
+    @torch.no_grad()
+    def fn():
+        scene.model.mask_cache(ray_pts)
+    return fn, len(scene.rays_o), len(ray_pts)
+
+
+def bench_raw2alpha(scene):
+    model = scene.model
+    with torch.no_grad():
+        density = model.density(scene.samples()['ray_pts'])
+    density.requires_grad_()
+    interval = scene.args.stepsize * model.voxel_size_ratio
+    def fn():
+        alpha = Raw2Alpha.apply(density.flatten(), model.act_shift, interval)
+        alpha.sum().backward()
+    return fn, len(scene.rays_o), len(density)
+
+
+def bench_alphas2weights(scene):
+    model = scene.model
+    samples = scene.samples()
+    with torch.no_grad():
+        interval = scene.args.stepsize * model.voxel_size_ratio
+        alpha = model.activate_density(model.density(samples['ray_pts']), interval)
+    alpha.requires_grad_()
+    ray_id, N = samples['ray_id'], len(scene.rays_o)
+    def fn():
+        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
+        (weights.sum() + alphainv_last.sum()).backward()
+    return fn, N, len(alpha)
+
+
+def bench_dense_grid(scene):
+    ray_pts = scene.samples()['ray_pts']
+    k0 = scene.model.k0
+    def fn():
+        k0(ray_pts).sum().backward()
+    return fn, len(scene.rays_o), len(ray_pts)
+
+
+def bench_tensorf_grid(scene):
+    model = scene.model
+    ray_pts = scene.samples()['ray_pts']
+    tensorf = grid.create_grid(
+            'TensoRFGrid', channels=12, world_size=model.world_size,
+            xyz_min=model.xyz_min, xyz_max=model.xyz_max,
+            config={'n_comp': 48}).to(scene.device)
+    def fn():
+        tensorf(ray_pts).sum().backward()
+    return fn, len(scene.rays_o), len(ray_pts)
+
+
+def bench_forward(scene):
+    model, kw = scene.model, scene.render_kwargs
+    with torch.no_grad():
+        n_samples = len(model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)['ray_id'])
+    @torch.no_grad()
+    def fn():
+        model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)
+    return fn, len(scene.rays_o), n_samples
+
+
+def bench_forward_backward(scene):
+    model, kw = scene.model, scene.render_kwargs
+    with torch.no_grad():
+        n_samples = len(model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)['ray_id'])
+    def fn():
+        render_result = model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)
+        render_result['rgb_marched'].square().sum().backward()
+    return fn, len(scene.rays_o), n_samples
+
+
+def bench_mask_to_prompt(scene):
+    try:
+        from lib.self_prompting import mask_to_prompt
+    except ImportError as e:
+        raise Skip(f'lib.self_prompting: {e}')
+    H = W = scene.args.HW
+    ys, xs = torch.meshgrid(torch.arange(H, device=scene.device), torch.arange(W, device=scene.device))
+    radius = ((xs - W/2)**2 + (ys - H/2)**2).sqrt()
+    rendered_mask_score = (H/4 - radius).unsqueeze(-1).float()
+    depth = (radius / H).unsqueeze(-1).float()
+    index_matrix = torch.cat([
+        torch.stack([ys / H, xs / W], -1).float(), depth], -1)
+    predictor = StubPredictor(H, W, radius=H//8)
+    def fn():
+        # the prompt search prints its progress
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            mask_to_prompt(predictor, rendered_mask_score, index_matrix, num_prompts=3)
+    return fn, H * W, 0
+
+
+def bench_sam3d_optim(scene):
+    try:
+        from lib.sam3d import optim, seg_loss
+    except ImportError as e:
+        raise Skip(f'lib.sam3d: {e}')
+    cfg_train = Config({'lrate_seg_mask_grid': 1., 'lrate_dual_seg_mask_grid': 1.})
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        model = scene.create_model(seg_dvgo.DirectVoxGO, num_objects=1)
+        optimizer = utils.create_segmentation_optimizer(model, cfg_train)
+    # the nerf is frozen as in Sam3D.init_model
+    for name, param in model.named_parameters():
+        if ('density' in name) or ('rgbnet' in name) or ('k0' in name):
+            param.requires_grad = False
+    kw = scene.render_kwargs
+    mask = (torch.rand([len(scene.rays_o)], device=scene.device) > 0.5).float()
+    with torch.no_grad():
+        n_samples = len(model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)['ray_id'])
+    def fn():
+        render_result = model(scene.rays_o, scene.rays_d, scene.viewdirs, **kw)
+        loss = seg_loss(mask, None, render_result['seg_mask_marched'])
+        optim(optimizer, loss, model=model)
+    return fn, len(scene.rays_o), n_samples
+
+
+BENCHMARKS = [
+    ('sample_ray', bench_sample_ray),
+    ('mask_cache', bench_mask_cache),
+    ('raw2alpha', bench_raw2alpha),
+    ('alphas2weights', bench_alphas2weights),
+    ('dense_grid', bench_dense_grid),
+    ('tensorf_grid', bench_tensorf_grid),
+    ('forward', bench_forward),
+    ('forward_backward', bench_forward_backward),
+    ('mask_to_prompt', bench_mask_to_prompt),
+    ('sam3d_optim', bench_sam3d_optim),
+]
+
+
+def run_benchmark(name, bench, scene, args):
+    try:
+        fn, n_rays, n_samples = bench(scene)
+    except Skip as e:
+        return {'name': name, 'skipped': str(e)}
+    sec = timeit(fn, args.n_iters, scene.device, n_warmup=2)
+    return {
+        'name': name,
+        'ms': sec * 1e3,
+        'n_rays': n_rays,
+        'n_samples': n_samples,
+        'rays_per_sec': n_rays / sec,
+        'samples_per_sec': n_samples / sec,
+        'peak_memory_mb': peak_memory_mb(scene.device),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    '''Print the benchmarks slower than in the baseline by more than tolerance; return their names'''
+    with open(baseline_path) as f:
+        baseline = {res['name']: res for res in json.load(f)['results']}
+    regressions = []
+    print(f'{"benchmark":>18s} {"baseline ms":>12s} {"ms":>10s} {"ratio":>7s}')
+    for res in results:
+        base = baseline.get(res['name'])
+        if 'ms' not in res or base is None or 'ms' not in base:
+            continue
+        ratio = res['ms'] / base['ms']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(res['name'])
+            flag = '  <- regression'
+        print(f'{res["name"]:>18s} {base["ms"]:12.3f} {res["ms"]:10.3f} {ratio:7.3f}{flag}')
+    return regressions
+
+
+def main():
+    args = config_parser().parse_args()
+    device = torch.device(args.device)
+    only = [name for name in args.only.split(',') if name]
+    unknown = set(only) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        raise ValueError(f'unknown benchmarks {sorted(unknown)}')
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        scene = Scene(args, device)
+    print(f'suite: {args.n_rays} rays, world size {scene.model.world_size.tolist()} on {device}')
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if only and name not in only:
+            continue
+        res = run_benchmark(name, bench, scene, args)
+        results.append(res)
+        if 'skipped' in res:
+            print(f'{name:>18s}: skipped ({res["skipped"]})')
+        else:
+            print(f'{name:>18s}: {res["ms"]:10.3f} ms  {res["rays_per_sec"]:12.4g} rays/s  '
+                  f'{res["samples_per_sec"]:12.4g} samples/s  {res["peak_memory_mb"]:9.1f} MB')
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'device': str(device),
+        'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+        'torch': torch.__version__,
+        'args': vars(args),
+        'results': results,
+    }
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('suite: report saved to', args.out)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print('suite: regressions in', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -49,7 +49,10 @@ coarse_train = dict(
     lrate_decay=20,               # lr decay by 0.1 after every lrate_decay*1000 steps
     pervoxel_lr=True,             # view-count-based lr
     pervoxel_lr_downrate=1,       # downsampled image for computing view-count-based lr
-    ray_sampler='random',         # ray sampling strategies
+    ray_sampler='random',         # ray sampling strategies: random | flatten | in_maskcache | stratified | importance
+    importance_tile=64,           # importance sampler: number of consecutive rays sharing a running error
+    importance_rebuild_every=500, # importance sampler: rebuild the sampling distribution every given steps
+    importance_uniform_frac=0.2,  # importance sampler: fraction of the uniform distribution mixed in
     weight_main=1.0,              # weight of photometric loss
     weight_entropy_last=0.01,     # weight of background entropy loss
     weight_nearclip=0,
@@ -64,6 +67,10 @@ coarse_train = dict(
     pg_scale=[],                  # checkpoints for progressive scaling
     decay_after_scale=1.0,        # decay act_shift after scaling
     skip_zero_grad_fields=[],     # the variable name to skip optimizing parameters w/ zero grad in each iteration
+    sparse_optim_state=False,     # allocate the Adam moments of the skip_zero_grad voxel grids on demand
+    sparse_optim_cold_steps=500,  # sparse_optim_state: free the moments of the rows w/o grad for this many steps (0: never)
+    prefetch_rays=True,           # gather and upload the next ray batch in background (load2gpu_on_the_fly)
+    amp=None,                     # mixed precision training of the model forward: None | 'fp16' | 'bf16'
     maskout_lt_nviews=0,
 )
 
@@ -98,6 +105,7 @@ coarse_model_and_render = dict(
     rgbnet_direct=True,           # set to False to treat the first 3 dim of feature voxel grid as diffuse rgb
     rgbnet_depth=3,               # depth of the colors MLP (there are rgbnet_depth-1 intermediate features)
     rgbnet_width=128,             # width of the colors MLP
+    rgbnet_jit=False,             # run the colors MLP through TorchScript
     alpha_init=1e-6,              # set the alpha values everywhere at the begin of training
     fast_color_thres=1e-7,        # threshold of alpha value to skip the fine stage sampled point
     maskout_near_cam_vox=True,    # maskout grid points that between cameras and their near planes
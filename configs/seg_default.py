@@ -67,6 +67,8 @@ coarse_train = dict(
     pg_scale=[],                  # checkpoints for progressive scaling
     decay_after_scale=1.0,        # decay act_shift after scaling
     skip_zero_grad_fields=[],     # the variable name to skip optimizing parameters w/ zero grad in each iteration
+    sparse_optim_state=False,     # allocate the Adam moments of the skip_zero_grad voxel grids on demand
+    sparse_optim_cold_steps=500,  # sparse_optim_state: free the moments of the rows w/o grad for this many steps (0: never)
     maskout_lt_nviews=0,
 )
 
@@ -0,0 +1,392 @@
+import os
+import copy
+import json
+import queue
+import hashlib
+import shutil
+import struct
+import argparse
+import threading
+
+import numpy as np
+import torch
+
+
+''' Memory-mapped checkpoint format
+A checkpoint file is laid out as
+    MAGIC | uint64 header size | JSON header | raw tensor blobs
+The header holds the checkpoint structure (model_kwargs, global_step, ...) with
+every tensor replaced by a reference to the tensor table, which records the
+dtype, shape and byte range of each blob. Blobs are mapped lazily from the file
+so loading only reads the pages that are used, and whole sections (e.g. the
+optimizer_state_dict) or state dict entries can be skipped.
+Legacy torch.save (.tar) checkpoints are still readable, files are recognized
+by their magic bytes regardless of their extension.
+'''
+MAGIC = b'SA3DCKPT'
+ALIGN = 64
+
+_DTYPES = {
+    str(dtype): dtype for dtype in [
+        torch.float64, torch.float32, torch.float16, torch.bfloat16,
+        torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]
+}
+
+
+def _encode(obj, path, tensors):
+    '''Replace the tensors of a nested structure by references to `tensors`.'''
+    if isinstance(obj, torch.Tensor):
+        tensors[path] = obj.detach()
+        return {'__tensor__': path}
+    if isinstance(obj, np.ndarray):
+        tensors[path] = torch.from_numpy(np.ascontiguousarray(obj))
+        return {'__ndarray__': path}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) and not k.startswith('__') for k in obj.keys()):
+            return {k: _encode(v, f'{path}/{k}', tensors) for k, v in obj.items()}
+        return {'__dict__': [[k, _encode(v, f'{path}/{k}', tensors)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_encode(v, f'{path}/{i}', tensors) for i, v in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [_encode(v, f'{path}/{i}', tensors) for i, v in enumerate(obj)]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise TypeError(f'checkpoint: cannot serialize {type(obj)} at {path}')
+
+
+def _decode(obj, load_tensor):
+    if isinstance(obj, list):
+        return [_decode(v, load_tensor) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if '__tensor__' in obj:
+        return load_tensor(obj['__tensor__'])
+    if '__ndarray__' in obj:
+        return load_tensor(obj['__ndarray__']).numpy()
+    if '__tuple__' in obj:
+        return tuple(_decode(v, load_tensor) for v in obj['__tuple__'])
+    if '__dict__' in obj:
+        return {k: _decode(v, load_tensor) for k, v in obj['__dict__']}
+    return {k: _decode(v, load_tensor) for k, v in obj.items()}
+
+
+def is_mmap_checkpoint(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_checkpoint(ckpt, path):
+    '''Write a checkpoint dict in the memory-mapped format.
+    The file is written next to `path` and renamed, so `path` is never left truncated.
+    '''
+    tensors = {}
+    tree = _encode(ckpt, '', tensors)
+    table = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        table[name] = {'dtype': str(tensor.dtype), 'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes}
+        offset += (nbytes + ALIGN - 1) // ALIGN * ALIGN
+    header = json.dumps({'version': 1, 'tree': tree, 'tensors': table}).encode()
+    data_start = (len(MAGIC) + 8 + len(header) + ALIGN - 1) // ALIGN * ALIGN
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            f.seek(data_start + table[name]['offset'])
+            tensor = tensor.cpu().contiguous()
+            if tensor.numel() > 0:
+                f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def _read_mmap_header(path):
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, f'{path} is not a memory-mapped checkpoint'
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    header['data_start'] = (len(MAGIC) + 8 + header_size + ALIGN - 1) // ALIGN * ALIGN
+    return header
+
+
+def _read_mmap_checkpoint(path, header, sections, state_keys):
+    data_start = header['data_start']
+    table = header['tensors']
+
+    def load_tensor(name):
+        entry = table[name]
+        dtype = _DTYPES[entry['dtype']]
+        if entry['nbytes'] == 0:
+            return torch.empty(entry['shape'], dtype=dtype, device='cpu')
+        # copy-on-write mapping: the tensors are writable, the file is never modified
+        buf = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start+entry['offset'], shape=(entry['nbytes'],))
+        return torch.from_numpy(buf).view(dtype).reshape(entry['shape'])
+
+    tree = header['tree']
+    ckpt = {}
+    for section, sub in tree.items():
+        if sections is not None and section not in sections:
+            continue
+        if section == 'model_state_dict' and state_keys is not None:
+            sub = {k: v for k, v in sub.items() if k in state_keys}
+        ckpt[section] = _decode(sub, load_tensor)
+    return ckpt
+
+
+_cache = {}
+
+def read_checkpoint(path, sections=None, state_keys=None, cache=True):
+    '''Load (part of) a checkpoint.
+    @sections:   top-level entries to load, e.g. ['model_kwargs', 'model_state_dict'];
+                 None for all of them.
+    @state_keys: only load these entries of model_state_dict; None for all of them.
+    @cache:      share the parsing of the file with the other call sites reading it
+                 (e.g. load_model, load_checkpoint and MaskGrid all read the reload
+                 checkpoint); the cache is keyed by the file's mtime and size.
+    Tensors are loaded on cpu. Every call returns its own tensors, so in-place edits
+    never reach the cache or the other callers: the memory-mapped checkpoints only
+    cache their header and map the blobs copy-on-write per call, the legacy ones
+    cache the unpickled checkpoint and return copies of it.
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    entry = _cache.get(key) if cache else None
+    if entry is None:
+        if is_mmap_checkpoint(path):
+            entry = {'header': _read_mmap_header(path)}
+        else:
+            # legacy torch.save checkpoint: unpickled in full
+            entry = {'ckpt': torch.load(path, map_location='cpu')}
+        if cache:
+            for k in [k for k in _cache if k[0] == key[0]]:
+                del _cache[k]
+            _cache[key] = entry
+
+    if 'header' in entry:
+        return _read_mmap_checkpoint(path, entry['header'], sections, state_keys)
+    ckpt = {k: v for k, v in entry['ckpt'].items() if sections is None or k in sections}
+    if state_keys is not None and 'model_state_dict' in ckpt:
+        ckpt['model_state_dict'] = {k: v for k, v in ckpt['model_state_dict'].items() if k in state_keys}
+    return copy.deepcopy(ckpt) if cache else ckpt
+
+
+def clear_cache(path=None):
+    '''Drop the cached checkpoints, only those under the directory `path` if given'''
+    if path is None:
+        _cache.clear()
+        return
+    path = os.path.join(os.path.abspath(path), '')
+    for k in [k for k in _cache if k[0].startswith(path)]:
+        del _cache[k]
+
+
+def convert_checkpoint(src_path, dst_path=None):
+    '''Convert a torch.save checkpoint into the memory-mapped format (in place by default).'''
+    dst_path = dst_path if dst_path is not None else src_path
+    if is_mmap_checkpoint(src_path):
+        print(f'checkpoint: {src_path} is already memory-mapped, skip')
+        return
+    ckpt = torch.load(src_path, map_location='cpu')
+    write_checkpoint(ckpt, dst_path)
+    print(f'checkpoint: converted {src_path} => {dst_path} '
+          f'({os.path.getsize(src_path)/2**20:.1f}MB => {os.path.getsize(dst_path)/2**20:.1f}MB)')
+
+
+''' Segmentation-delta checkpoints
+The segmentation stage only optimizes the mask grids, so a segmentation checkpoint
+stores just seg_mask_grid, dual_seg_mask_grid and mask_view_counts on top of the
+NeRF checkpoint it was trained from. The grids are stored sparse (flat indices of
+the voxels occupied in any channel + fp16 values), together with the path and
+sha1 of the base checkpoint, and composed with the base at load time.
+'''
+SEG_DELTA_GRIDS = ['seg_mask_grid.grid', 'dual_seg_mask_grid.grid', 'mask_view_counts']
+
+_sha1_cache = {}
+
+def file_sha1(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _sha1_cache:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**24), b''):
+                sha1.update(chunk)
+        _sha1_cache[key] = sha1.hexdigest()
+    return _sha1_cache[key]
+
+
+def _get_seg_grid(model, name):
+    if name == 'mask_view_counts':
+        return model.mask_view_counts
+    return getattr(model, name.split('.')[0]).grid
+
+
+def read_seg_delta(path):
+    '''Return the seg_delta entry of `path`, None if it is a regular checkpoint.'''
+    if not is_mmap_checkpoint(path):
+        return None
+    return read_checkpoint(path, sections=['seg_delta']).get('seg_delta')
+
+
+def resolve_seg_delta(path):
+    '''Return (base checkpoint path, seg_delta or None) for the checkpoint at `path`.'''
+    seg_delta = read_seg_delta(path)
+    if seg_delta is None:
+        return path, None
+    base_path = os.path.join(os.path.dirname(path), seg_delta['base_path'])
+    if not os.path.isfile(base_path):
+        raise FileNotFoundError(f'{path}: base checkpoint {base_path} not found')
+    if file_sha1(base_path) != seg_delta['base_sha1']:
+        raise RuntimeError(f'{path}: base checkpoint {base_path} changed since the segmentation was saved')
+    return base_path, seg_delta
+
+
+def write_seg_delta(model, base_path, path):
+    '''Save the mask grids of `model` as a delta on top of the checkpoint at `base_path`.'''
+    base_path, _ = resolve_seg_delta(base_path)
+    grids = {}
+    for name in SEG_DELTA_GRIDS:
+        grid = _get_seg_grid(model, name).detach()
+        flat = grid.reshape(grid.shape[1], -1)
+        index = (flat != 0).any(0).nonzero().squeeze(1)
+        grids[name] = {
+            'shape': list(grid.shape),
+            'index': index.int().cpu(),
+            'values': flat[:, index].t().half().cpu(),
+        }
+    write_checkpoint({'seg_delta': {
+        'base_path': os.path.relpath(base_path, os.path.dirname(os.path.abspath(path))),
+        'base_sha1': file_sha1(base_path),
+        'num_objects': model.seg_mask_grid.grid.shape[1],
+        'grids': grids,
+    }}, path)
+
+
+@torch.no_grad()
+def apply_seg_delta(model, seg_delta):
+    '''Fill the mask grids of `model` (loaded from the base checkpoint) from `seg_delta`.'''
+    if model.seg_mask_grid.grid.shape[1] != seg_delta['num_objects']:
+        model.change_num_objects(seg_delta['num_objects'])
+    for name, entry in seg_delta['grids'].items():
+        grid = _get_seg_grid(model, name)
+        if list(grid.shape) != entry['shape']:
+            if name == 'mask_view_counts':
+                model.mask_view_counts = grid = torch.zeros(entry['shape'], device=grid.device)
+            else:
+                raise RuntimeError(f'apply_seg_delta: {name} has shape {list(grid.shape)} != {entry["shape"]}')
+        flat = grid.view(grid.shape[1], -1)
+        flat.zero_()
+        index = entry['index'].to(grid.device).long()
+        flat[:, index] = entry['values'].to(grid.device, grid.dtype).t()
+
+
+class AsyncCheckpointWriter:
+    '''Write checkpoints in a background thread.
+    save() snapshots the tensors of a checkpoint into (pinned) host buffers with
+    non-blocking copies and returns immediately; the worker thread writes the file
+    once, then hard-links (or copies) it to the `*_last` paths. Every file is
+    written under a temporary name and renamed, so a crash never leaves a
+    truncated checkpoint behind. Only the last `keep_last` numbered checkpoints
+    written by this writer are kept (keep_last <= 0 keeps all of them).
+    '''
+    def __init__(self, keep_last=0):
+        self.keep_last = keep_last
+        self.history = []
+        self.buffers = {}
+        self.error = None
+        self.tasks = queue.Queue(maxsize=1)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _snapshot(self, obj, path=''):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            buf = self.buffers.get(path)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, device='cpu', pin_memory=obj.is_cuda)
+                self.buffers[path] = buf
+            buf.copy_(obj, non_blocking=obj.is_cuda)
+            return buf
+        if isinstance(obj, np.ndarray):
+            return obj.copy()
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, f'{path}/{k}')) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, f'{path}/{i}') for i, v in enumerate(obj))
+        return obj
+
+    def save(self, ckpt, path, last_paths=(), numbered=True):
+        '''Snapshot `ckpt` and queue it for writing to `path` and `last_paths`.
+        @numbered: whether `path` counts towards the `keep_last` retention.
+        '''
+        # the host buffers are reused, so the previous checkpoint must be on disk first
+        self.wait()
+        snapshot = self._snapshot(ckpt)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.tasks.put((snapshot, event, path, list(last_paths), numbered))
+
+    def wait(self):
+        '''Block until all queued checkpoints are written.'''
+        self.tasks.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.tasks.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+            snapshot, event, path, last_paths, numbered = task
+            try:
+                if event is not None:
+                    event.synchronize()
+                write_checkpoint(snapshot, path)
+                for last_path in last_paths:
+                    tmp_path = last_path + '.tmp'
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    try:
+                        os.link(path, tmp_path)
+                    except OSError:
+                        shutil.copyfile(path, tmp_path)
+                    os.replace(tmp_path, last_path)
+                if numbered:
+                    self.history.append(path)
+                    while self.keep_last > 0 and len(self.history) > self.keep_last:
+                        old_path = self.history.pop(0)
+                        if os.path.isfile(old_path):
+                            os.remove(old_path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.tasks.task_done()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert torch.save (.tar) checkpoints into the memory-mapped format.')
+    parser.add_argument('paths', nargs='+', help='checkpoints to convert in place')
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help='write the converted checkpoints into this directory instead')
+    args = parser.parse_args()
+    for path in args.paths:
+        dst_path = None
+        if args.out_dir is not None:
+            os.makedirs(args.out_dir, exist_ok=True)
+            dst_path = os.path.join(args.out_dir, os.path.basename(path))
+        convert_checkpoint(path, dst_path)
@@ -1,18 +1,15 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-import ast
 import copy
+import json
 import os
 import os.path as osp
 import platform
-import shutil
-import sys
 import tempfile
 import types
 import uuid
 import warnings
 from argparse import Action, ArgumentParser
 from collections import abc
-from importlib import import_module
 from pathlib import Path
 
 from addict import Dict
@@ -31,6 +28,12 @@ DELETE_KEY = '_delete_'
 DEPRECATION_KEY = '_deprecation_'
 RESERVED_KEYS = ['filename', 'text', 'pretty_text']
 
+# The config files are executed in memory rather than imported from a
+# temporary copy. The parsed files are memoised by path and mtime, so that the
+# bases shared by the configs of a sweep are parsed once per process.
+# (path, use_predefined_variables) -> (mtime, (cfg_dict, base_var_dict, text))
+_PARSE_CACHE = {}
+
 
 class ConfigDict(Dict):
 
@@ -69,6 +72,26 @@ def add_args(parser, cfg, prefix=''):
     return parser
 
 
+def _json_default(obj):
+    if isinstance(obj, (set, range)):
+        return list(obj)
+    elif hasattr(obj, 'tolist'):
+        # numpy arrays and scalars
+        return obj.tolist()
+    raise TypeError(f'{type(obj)} is unsupported for json dump')
+
+
+def _dumps(cfg_dict, file_format):
+    """Serialize a config dict to json/yaml without mmcv."""
+    if file_format == 'json':
+        return json.dumps(cfg_dict, default=_json_default)
+    elif file_format in ['yaml', 'yml']:
+        import yaml
+        return yaml.dump(
+            cfg_dict, Dumper=getattr(yaml, 'CDumper', yaml.Dumper))
+    raise TypeError(f'Unsupported format: {file_format}')
+
+
 class Config:
     """A facility for config and config files.
 
@@ -95,18 +118,7 @@ class Config:
     """
 
     @staticmethod
-    def _validate_py_syntax(filename):
-        with open(filename, encoding='utf-8') as f:
-            # Setting encoding explicitly to resolve coding issue on windows
-            content = f.read()
-        try:
-            ast.parse(content)
-        except SyntaxError as e:
-            raise SyntaxError('There are syntax errors in config '
-                              f'file {filename}: {e}')
-
-    @staticmethod
-    def _substitute_predefined_vars(filename, temp_config_name):
+    def _substitute_predefined_vars(filename, config_file):
         file_dirname = osp.dirname(filename)
         file_basename = osp.basename(filename)
         file_basename_no_extension = osp.splitext(file_basename)[0]
@@ -116,23 +128,16 @@ class Config:
             fileBasename=file_basename,
             fileBasenameNoExtension=file_basename_no_extension,
             fileExtname=file_extname)
-        with open(filename, encoding='utf-8') as f:
-            # Setting encoding explicitly to resolve coding issue on windows
-            config_file = f.read()
         for key, value in support_templates.items():
             regexp = r'\{\{\s*' + str(key) + r'\s*\}\}'
             value = value.replace('\\', '/')
             config_file = re.sub(regexp, value, config_file)
-        with open(temp_config_name, 'w', encoding='utf-8') as tmp_config_file:
-            tmp_config_file.write(config_file)
+        return config_file
 
     @staticmethod
-    def _pre_substitute_base_vars(filename, temp_config_name):
+    def _pre_substitute_base_vars(config_file):
         """Substitute base variable placehoders to string, so that parsing
         would work."""
-        with open(filename, encoding='utf-8') as f:
-            # Setting encoding explicitly to resolve coding issue on windows
-            config_file = f.read()
         base_var_dict = {}
         regexp = r'\{\{\s*' + BASE_KEY + r'\.([\w\.]+)\s*\}\}'
         base_vars = set(re.findall(regexp, config_file))
@@ -141,9 +146,64 @@ class Config:
             base_var_dict[randstr] = base_var
             regexp = r'\{\{\s*' + BASE_KEY + r'\.' + base_var + r'\s*\}\}'
             config_file = re.sub(regexp, f'"{randstr}"', config_file)
-        with open(temp_config_name, 'w', encoding='utf-8') as tmp_config_file:
-            tmp_config_file.write(config_file)
-        return base_var_dict
+        return config_file, base_var_dict
+
+    @staticmethod
+    def _exec_py(filename, config_file):
+        """Execute the source of a python config into a fresh namespace and
+        return its variables."""
+        try:
+            code = compile(config_file, filename, 'exec')
+        except SyntaxError as e:
+            raise SyntaxError('There are syntax errors in config '
+                              f'file {filename}: {e}')
+        namespace = {
+            '__name__': osp.splitext(osp.basename(filename))[0],
+            '__file__': filename,
+        }
+        exec(code, namespace)
+        return {
+            name: value
+            for name, value in namespace.items()
+            if not name.startswith('__')
+            and not isinstance(value, types.ModuleType)
+            and not isinstance(value, types.FunctionType)
+        }
+
+    @staticmethod
+    def _parse_file(filename, use_predefined_variables=True):
+        """Parse a single config file, without resolving its bases.
+
+        Returns the variables of the file (with the base variables as
+        placeholder strings), the placeholders and the text of the file. The
+        parsed files are memoised by path and mtime, a copy is returned.
+        """
+        mtime = os.stat(filename).st_mtime_ns
+        key = (filename, use_predefined_variables)
+        cached = _PARSE_CACHE.get(key)
+        if cached is None or cached[0] != mtime:
+            with open(filename, encoding='utf-8') as f:
+                # Setting encoding explicitly to resolve coding issue on windows
+                text = f.read()
+            config_file = text
+            if use_predefined_variables:
+                config_file = Config._substitute_predefined_vars(
+                    filename, config_file)
+            # Substitute base variables from placeholders to strings
+            config_file, base_var_dict = Config._pre_substitute_base_vars(
+                config_file)
+            if filename.endswith('.py'):
+                cfg_dict = Config._exec_py(filename, config_file)
+            elif filename.endswith('.json'):
+                cfg_dict = json.loads(config_file)
+            else:
+                import yaml
+                cfg_dict = yaml.load(
+                    config_file,
+                    Loader=getattr(yaml, 'CLoader', yaml.Loader))
+            cached = (mtime, (cfg_dict, base_var_dict, text))
+            _PARSE_CACHE[key] = cached
+        return copy.deepcopy(cached[1])
 
     @staticmethod
     def _substitute_base_vars(cfg, base_var_dict, base_cfg):
@@ -185,42 +245,8 @@ class Config:
         if fileExtname not in ['.py', '.json', '.yaml', '.yml']:
             raise OSError('Only py/yml/yaml/json type are supported now!')
 
-        with tempfile.TemporaryDirectory() as temp_config_dir:
-            temp_config_file = tempfile.NamedTemporaryFile(
-                dir=temp_config_dir, suffix=fileExtname)
-            if platform.system() == 'Windows':
-                temp_config_file.close()
-            temp_config_name = osp.basename(temp_config_file.name)
-            # Substitute predefined variables
-            if use_predefined_variables:
-                Config._substitute_predefined_vars(filename,
-                                                   temp_config_file.name)
-            else:
-                shutil.copyfile(filename, temp_config_file.name)
-            # Substitute base variables from placeholders to strings
-            base_var_dict = Config._pre_substitute_base_vars(
-                temp_config_file.name, temp_config_file.name)
-
-            if filename.endswith('.py'):
-                temp_module_name = osp.splitext(temp_config_name)[0]
-                sys.path.insert(0, temp_config_dir)
-                Config._validate_py_syntax(filename)
-                mod = import_module(temp_module_name)
-                sys.path.pop(0)
-                cfg_dict = {
-                    name: value
-                    for name, value in mod.__dict__.items()
-                    if not name.startswith('__')
-                    and not isinstance(value, types.ModuleType)
-                    and not isinstance(value, types.FunctionType)
-                }
-                # delete imported module
-                del sys.modules[temp_module_name]
-            elif filename.endswith(('.yml', '.yaml', '.json')):
-                import mmcv
-                cfg_dict = mmcv.load(temp_config_file.name)
-            # close temp file
-            temp_config_file.close()
+        cfg_dict, base_var_dict, text = Config._parse_file(
+            filename, use_predefined_variables)
 
         # check deprecation information
         if DEPRECATION_KEY in cfg_dict:
@@ -235,10 +261,7 @@ class Config:
                     f'{deprecation_info["reference"]}'
             warnings.warn(warning_msg, DeprecationWarning)
 
-        cfg_text = filename + '\n'
-        with open(filename, encoding='utf-8') as f:
-            # Setting encoding explicitly to resolve coding issue on windows
-            cfg_text += f.read()
+        cfg_text = filename + '\n' + text
 
         if BASE_KEY in cfg_dict:
             cfg_dir = osp.dirname(filename)
@@ -583,20 +606,20 @@ class Config:
             file (str, optional): Path of the output file where the config
                 will be dumped. Defaults to None.
         """
-        import mmcv
         cfg_dict = super().__getattribute__('_cfg_dict').to_dict()
         if file is None:
             if self.filename is None or self.filename.endswith('.py'):
                 return self.pretty_text
             else:
                 file_format = self.filename.split('.')[-1]
-                return mmcv.dump(cfg_dict, file_format=file_format)
+                return _dumps(cfg_dict, file_format)
         elif file.endswith('.py'):
             with open(file, 'w', encoding='utf-8') as f:
                 f.write(self.pretty_text)
         else:
             file_format = file.split('.')[-1]
-            return mmcv.dump(cfg_dict, file=file, file_format=file_format)
+            with open(file, 'w', encoding='utf-8') as f:
+                f.write(_dumps(cfg_dict, file_format))
 
     def merge_from_dict(self, options, allow_list_keys=True):
         """Merge list into cfg_dict.
@@ -100,6 +100,12 @@ def config_parser():
     parser.add_argument("--save_ckpt", action='store_true',
                         help='save segmentation ckpt')
     parser.add_argument("--mobile_sam", action='store_true', help='Replace the original SAM encoder with MobileSAM to accelerate segmentation')
+    parser.add_argument("--render_stats", action='store_true',
+                        help='dump the per-view sample counts of the pruning stages to render_stats_<seg_type>.json')
+    parser.add_argument("--trace_seg", action='store_true',
+                        help='record the per-stage timings and counters of the segmentation steps')
+    parser.add_argument("--trace_chrome", action='store_true',
+                        help='with --trace_seg, also export a chrome://tracing file')
     return parser
 
 
@@ -26,6 +26,20 @@ void adam_upd_with_perlr_cuda(
     torch::Tensor perlr,
     int step, float beta1, float beta2, float lr, float eps);
 
+void adam_upd_multi_cuda(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<int> steps, std::vector<float> lrs,
+    float beta1, float beta2, float eps, bool masked);
+
+void running_avg_sgd_upd_cuda(
+    torch::Tensor param,
+    torch::Tensor grad,
+    torch::Tensor counts,
+    float lr);
+
 
 // C++ interface
 
@@ -76,6 +90,39 @@ void adam_upd_with_perlr(
           step, beta1, beta2, lr, eps);
 }
 
+void adam_upd_multi(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<int> steps, std::vector<float> lrs,
+    float beta1, float beta2, float eps, bool masked) {
+  const size_t n = params.size();
+  TORCH_CHECK(grads.size() == n && exp_avgs.size() == n && exp_avg_sqs.size() == n &&
+              steps.size() == n && lrs.size() == n, "adam_upd_multi: size mismatch");
+  for(size_t i=0; i<n; ++i) {
+    CHECK_INPUT(params[i]);
+    CHECK_INPUT(grads[i]);
+    CHECK_INPUT(exp_avgs[i]);
+    CHECK_INPUT(exp_avg_sqs[i]);
+    TORCH_CHECK(params[i].scalar_type() == params[0].scalar_type(), "adam_upd_multi: mixed dtypes");
+    TORCH_CHECK(params[i].device() == params[0].device(), "adam_upd_multi: mixed devices");
+  }
+  adam_upd_multi_cuda(params, grads, exp_avgs, exp_avg_sqs,
+          steps, lrs, beta1, beta2, eps, masked);
+}
+
+void running_avg_sgd_upd(
+    torch::Tensor param,
+    torch::Tensor grad,
+    torch::Tensor counts,
+    float lr) {
+  CHECK_INPUT(param);
+  CHECK_INPUT(grad);
+  CHECK_INPUT(counts);
+  running_avg_sgd_upd_cuda(param, grad, counts, lr);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("adam_upd", &adam_upd,
           "Adam update");
@@ -83,5 +130,9 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
           "Adam update ignoring zero grad");
   m.def("adam_upd_with_perlr", &adam_upd_with_perlr,
           "Adam update ignoring zero grad with per-voxel lr");
+  m.def("adam_upd_multi", &adam_upd_multi,
+          "Adam update of a list of tensors in a single launch");
+  m.def("running_avg_sgd_upd", &running_avg_sgd_upd,
+          "SGD update of the running average of the updates, ignoring zero grad");
 }
 
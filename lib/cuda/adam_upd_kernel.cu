@@ -57,6 +57,53 @@ __global__ void adam_upd_with_perlr_cuda_kernel(
   }
 }
 
+template <typename scalar_t, bool masked>
+__global__ void adam_upd_multi_cuda_kernel(
+    const int64_t* __restrict__ ptrs,       // [4, n_tensors] param, grad, exp_avg, exp_avg_sq
+    const int64_t* __restrict__ offsets,    // [n_tensors+1] cumulated numel
+    const float* __restrict__ step_sizes,   // [n_tensors]
+    const int n_tensors,
+    const float beta1, const float beta2, const float eps) {
+
+  const int64_t index = (int64_t)blockIdx.x * blockDim.x + threadIdx.x;
+  if(index>=offsets[n_tensors]) return;
+  // find the tensor the element belongs to
+  int lo = 0, hi = n_tensors-1;
+  while(lo<hi) {
+    const int mid = (lo+hi+1) >> 1;
+    if(offsets[mid]<=index) lo = mid;
+    else hi = mid-1;
+  }
+  const int64_t i = index - offsets[lo];
+  scalar_t* param = reinterpret_cast<scalar_t*>(ptrs[lo]);
+  const scalar_t* grad = reinterpret_cast<const scalar_t*>(ptrs[n_tensors+lo]);
+  scalar_t* exp_avg = reinterpret_cast<scalar_t*>(ptrs[2*n_tensors+lo]);
+  scalar_t* exp_avg_sq = reinterpret_cast<scalar_t*>(ptrs[3*n_tensors+lo]);
+  const scalar_t g = grad[i];
+  if(masked && g==0) return;
+  exp_avg[i] = beta1 * exp_avg[i] + (1-beta1) * g;
+  exp_avg_sq[i] = beta2 * exp_avg_sq[i] + (1-beta2) * g * g;
+  param[i] -= step_sizes[lo] * exp_avg[i] / (sqrt(exp_avg_sq[i]) + eps);
+}
+
+template <typename scalar_t>
+__global__ void running_avg_sgd_upd_cuda_kernel(
+    scalar_t* __restrict__ param,
+    const scalar_t* __restrict__ grad,
+    scalar_t* __restrict__ counts,
+    const size_t N,
+    const float lr) {
+
+  const size_t index = blockIdx.x * blockDim.x + threadIdx.x;
+  if(index<N && grad[index]!=0) {
+    const scalar_t sum = param[index] * counts[index];
+    const scalar_t new_sum = sum - lr * grad[index];
+    const scalar_t cnt = counts[index] + (new_sum != sum);
+    counts[index] = cnt;
+    param[index] = new_sum / (cnt + (scalar_t)1e-9);
+  }
+}
+
 void adam_upd_cuda(
     torch::Tensor param,
     torch::Tensor grad,
@@ -131,3 +178,72 @@ void adam_upd_with_perlr_cuda(
   }));
 }
 
+
+void adam_upd_multi_cuda(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<int> steps, std::vector<float> lrs,
+    const float beta1, const float beta2, const float eps, const bool masked) {
+
+  const int n_tensors = params.size();
+  if(n_tensors == 0) return;
+
+  // pointer / offset / step size tables, uploaded in one copy per table
+  auto ptrs = torch::empty({4, n_tensors}, torch::dtype(torch::kInt64).pinned_memory(true));
+  auto offsets = torch::empty({n_tensors+1}, torch::dtype(torch::kInt64).pinned_memory(true));
+  auto step_sizes = torch::empty({n_tensors}, torch::dtype(torch::kFloat32).pinned_memory(true));
+  int64_t* ptrs_a = ptrs.data_ptr<int64_t>();
+  int64_t* offsets_a = offsets.data_ptr<int64_t>();
+  float* step_sizes_a = step_sizes.data_ptr<float>();
+  offsets_a[0] = 0;
+  for(int i=0; i<n_tensors; ++i) {
+    ptrs_a[i] = reinterpret_cast<int64_t>(params[i].data_ptr());
+    ptrs_a[n_tensors+i] = reinterpret_cast<int64_t>(grads[i].data_ptr());
+    ptrs_a[2*n_tensors+i] = reinterpret_cast<int64_t>(exp_avgs[i].data_ptr());
+    ptrs_a[3*n_tensors+i] = reinterpret_cast<int64_t>(exp_avg_sqs[i].data_ptr());
+    offsets_a[i+1] = offsets_a[i] + params[i].numel();
+    // same as the single tensor kernels
+    step_sizes_a[i] = lrs[i] * sqrt(1 - pow(beta2, (float)steps[i])) / (1 - pow(beta1, (float)steps[i]));
+  }
+  const int64_t N = offsets_a[n_tensors];
+  const auto device = params[0].device();
+  ptrs = ptrs.to(device, /*non_blocking=*/true);
+  offsets = offsets.to(device, /*non_blocking=*/true);
+  step_sizes = step_sizes.to(device, /*non_blocking=*/true);
+
+  const int threads = 256;
+  const int64_t blocks = (N + threads - 1) / threads;
+
+  AT_DISPATCH_FLOATING_TYPES(params[0].type(), "adam_upd_multi_cuda", ([&] {
+    if(masked)
+      adam_upd_multi_cuda_kernel<scalar_t,true><<<blocks, threads>>>(
+          ptrs.data_ptr<int64_t>(), offsets.data_ptr<int64_t>(), step_sizes.data_ptr<float>(),
+          n_tensors, beta1, beta2, eps);
+    else
+      adam_upd_multi_cuda_kernel<scalar_t,false><<<blocks, threads>>>(
+          ptrs.data_ptr<int64_t>(), offsets.data_ptr<int64_t>(), step_sizes.data_ptr<float>(),
+          n_tensors, beta1, beta2, eps);
+  }));
+}
+
+void running_avg_sgd_upd_cuda(
+    torch::Tensor param,
+    torch::Tensor grad,
+    torch::Tensor counts,
+    const float lr) {
+
+  const size_t N = param.numel();
+
+  const int threads = 256;
+  const int blocks = (N + threads - 1) / threads;
+
+  AT_DISPATCH_FLOATING_TYPES(param.type(), "running_avg_sgd_upd_cuda", ([&] {
+    running_avg_sgd_upd_cuda_kernel<scalar_t><<<blocks, threads>>>(
+        param.data<scalar_t>(),
+        grad.data<scalar_t>(),
+        counts.data<scalar_t>(),
+        N, lr);
+  }));
+}
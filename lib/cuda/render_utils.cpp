@@ -41,6 +41,12 @@ torch::Tensor alpha2weight_backward_cuda(
         torch::Tensor i_start, torch::Tensor i_end, const int n_rays,
         torch::Tensor grad_weights, torch::Tensor grad_last);
 
+torch::Tensor segment_march_cuda(torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, const int n_rays);
+
+std::vector<torch::Tensor> segment_march_backward_cuda(
+        torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, torch::Tensor grad_out,
+        torch::Tensor wgrad_mask, torch::Tensor sgrad_mask);
+
 // C++ interface
 
 #define CHECK_CUDA(x) TORCH_CHECK(x.type().is_cuda(), #x " must be a CUDA tensor")
@@ -166,6 +172,28 @@ torch::Tensor alpha2weight_backward(
           grad_weights, grad_last);
 }
 
+torch::Tensor segment_march(torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, const int n_rays) {
+  CHECK_INPUT(weight);
+  CHECK_INPUT(src);
+  CHECK_INPUT(ray_id);
+  assert(weight.dim()==1);
+  assert(src.dim()==2);
+  assert(ray_id.dim()==1);
+  return segment_march_cuda(weight, src, ray_id, n_rays);
+}
+
+std::vector<torch::Tensor> segment_march_backward(
+        torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, torch::Tensor grad_out,
+        torch::Tensor wgrad_mask, torch::Tensor sgrad_mask) {
+  CHECK_INPUT(weight);
+  CHECK_INPUT(src);
+  CHECK_INPUT(ray_id);
+  CHECK_INPUT(grad_out);
+  CHECK_INPUT(wgrad_mask);
+  CHECK_INPUT(sgrad_mask);
+  return segment_march_backward_cuda(weight, src, ray_id, grad_out, wgrad_mask, sgrad_mask);
+}
+
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("infer_t_minmax", &infer_t_minmax, "Inference t_min and t_max of ray-bbox intersection");
@@ -181,5 +209,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("raw2alpha_nonuni_backward", &raw2alpha_nonuni_backward, "Backward pass of the raw to alpha");
   m.def("alpha2weight", &alpha2weight, "Per-point alpha to accumulated blending weight");
   m.def("alpha2weight_backward", &alpha2weight_backward, "Backward pass of alpha2weight");
+  m.def("segment_march", &segment_march, "Alpha-composite multi-channel point values along the rays");
+  m.def("segment_march_backward", &segment_march_backward, "Backward pass of segment_march");
 }
 
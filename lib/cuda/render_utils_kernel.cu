@@ -706,3 +706,129 @@ torch::Tensor alpha2weight_backward_cuda(
   return grad;
 }
 
+
+/*
+   Alpha-composite multi-channel per-point values along the rays in one pass.
+   ray_id must be sorted (the points of a ray are contiguous).
+*/
+template <typename scalar_t>
+__global__ void segment_march_cuda_kernel(
+    scalar_t* __restrict__ weight,
+    scalar_t* __restrict__ src,
+    int64_t* __restrict__ i_start,
+    int64_t* __restrict__ i_end,
+    const int n_rays,
+    const int n_channels,
+    scalar_t* __restrict__ out) {
+
+  const int index = blockIdx.x * blockDim.x + threadIdx.x;
+  if(index<n_rays*n_channels) {
+    const int i_ray = index / n_channels;
+    const int i_c = index - i_ray * n_channels;
+    const int i_s = i_start[i_ray];
+    const int i_e = i_end[i_ray];
+    scalar_t acc = 0;
+    for(int i=i_s; i<i_e; ++i) {
+      acc += weight[i] * src[i*n_channels+i_c];
+    }
+    out[index] = acc;
+  }
+}
+
+torch::Tensor segment_march_cuda(torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, const int n_rays) {
+
+  const int n_pts = src.size(0);
+  const int n_channels = src.size(1);
+  const int threads = 256;
+
+  auto out = torch::zeros({n_rays, n_channels}, src.options());
+  if(n_pts==0 || n_channels==0) {
+    return out;
+  }
+
+  auto i_start = torch::zeros({n_rays}, torch::dtype(torch::kInt64).device(torch::kCUDA));
+  auto i_end = torch::zeros({n_rays}, torch::dtype(torch::kInt64).device(torch::kCUDA));
+  __set_i_for_segment_start_end<<<(n_pts+threads-1)/threads, threads>>>(
+          ray_id.data<int64_t>(), n_pts, i_start.data<int64_t>(), i_end.data<int64_t>());
+  i_end[ray_id[n_pts-1]] = n_pts;
+
+  const int blocks = (n_rays * n_channels + threads - 1) / threads;
+
+  AT_DISPATCH_FLOATING_TYPES(src.type(), "segment_march_cuda", ([&] {
+    segment_march_cuda_kernel<scalar_t><<<blocks, threads>>>(
+        weight.data<scalar_t>(),
+        src.data<scalar_t>(),
+        i_start.data<int64_t>(),
+        i_end.data<int64_t>(),
+        n_rays,
+        n_channels,
+        out.data<scalar_t>());
+  }));
+
+  return out;
+}
+
+template <typename scalar_t>
+__global__ void segment_march_backward_cuda_kernel(
+    scalar_t* __restrict__ weight,
+    scalar_t* __restrict__ src,
+    int64_t* __restrict__ ray_id,
+    scalar_t* __restrict__ grad_out,
+    bool* __restrict__ wgrad_mask,
+    bool* __restrict__ sgrad_mask,
+    const int n_pts,
+    const int n_channels,
+    scalar_t* __restrict__ grad_weight,
+    scalar_t* __restrict__ grad_src) {
+
+  const int i_pt = blockIdx.x * blockDim.x + threadIdx.x;
+  if(i_pt<n_pts) {
+    const scalar_t w = weight[i_pt];
+    const int offset_out = ray_id[i_pt] * n_channels;
+    const int offset_src = i_pt * n_channels;
+    scalar_t gw = 0;
+    for(int i_c=0; i_c<n_channels; ++i_c) {
+      const scalar_t g = grad_out[offset_out+i_c];
+      if(sgrad_mask[i_c]) {
+        grad_src[offset_src+i_c] = w * g;
+      }
+      if(wgrad_mask[i_c]) {
+        gw += src[offset_src+i_c] * g;
+      }
+    }
+    grad_weight[i_pt] = gw;
+  }
+}
+
+std::vector<torch::Tensor> segment_march_backward_cuda(
+        torch::Tensor weight, torch::Tensor src, torch::Tensor ray_id, torch::Tensor grad_out,
+        torch::Tensor wgrad_mask, torch::Tensor sgrad_mask) {
+
+  const int n_pts = src.size(0);
+  const int n_channels = src.size(1);
+
+  auto grad_weight = torch::zeros_like(weight);
+  auto grad_src = torch::zeros_like(src);
+  if(n_pts==0 || n_channels==0) {
+    return {grad_weight, grad_src};
+  }
+
+  const int threads = 256;
+  const int blocks = (n_pts + threads - 1) / threads;
+
+  AT_DISPATCH_FLOATING_TYPES(src.type(), "segment_march_backward_cuda", ([&] {
+    segment_march_backward_cuda_kernel<scalar_t><<<blocks, threads>>>(
+        weight.data<scalar_t>(),
+        src.data<scalar_t>(),
+        ray_id.data<int64_t>(),
+        grad_out.data<scalar_t>(),
+        wgrad_mask.data<bool>(),
+        sgrad_mask.data<bool>(),
+        n_pts,
+        n_channels,
+        grad_weight.data<scalar_t>(),
+        grad_src.data<scalar_t>());
+  }));
+
+  return {grad_weight, grad_src};
+}
@@ -0,0 +1,35 @@
+import os
+
+from torch.utils.cpp_extension import load
+
+
+''' CUDA extensions
+The extensions are JIT-compiled (ninja + nvcc) on their first call instead of at
+import time, so the modules importing them, and their torch fallbacks for
+non-cuda tensors, stay usable on machines without a CUDA toolchain.
+'''
+parent_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class LazyExtension:
+    def __init__(self, name, sources):
+        self.name = name
+        self.sources = [os.path.join(parent_dir, path) for path in sources]
+        self.module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr in ['name', 'sources', 'module']:
+            raise AttributeError(attr)
+        if self.module is None:
+            self.module = load(name=self.name, sources=self.sources, verbose=True)
+        return getattr(self.module, attr)
+
+
+render_utils_cuda = LazyExtension(
+        'render_utils_cuda', ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu'])
+total_variation_cuda = LazyExtension(
+        'total_variation_cuda', ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu'])
+ub360_utils_cuda = LazyExtension(
+        'ub360_utils_cuda', ['cuda/ub360_utils.cpp', 'cuda/ub360_utils_kernel.cu'])
+adam_upd_cuda = LazyExtension(
+        'adam_upd_cuda', ['cuda/adam_upd.cpp', 'cuda/adam_upd_kernel.cu'])
@@ -1,31 +1,24 @@
-import os
 import time
-import functools
 import numpy as np
 
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-
-from torch_scatter import segment_coo
 
 from . import grid
-from .dvgo import Raw2Alpha, Alphas2Weights
+from .render_core import VoxelRenderer, FieldHead, rgb_head
 from .dmpigo import create_full_step_id
+from .cuda_ext import ub360_utils_cuda
+
 
-from torch.utils.cpp_extension import load
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-ub360_utils_cuda = load(
-        name='ub360_utils_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/ub360_utils.cpp', 'cuda/ub360_utils_kernel.cu']],
-        verbose=True)
+wsum_mid_head = FieldHead('wsum_mid', lambda model, samples, viewdirs: samples['inner_mask'])
+s_depth_head = FieldHead('depth', lambda model, samples, viewdirs: samples['s'], detach=True)
 
 
 #TODO ORIGINAL bg_len=0.2
 '''Model'''
-class DirectContractedVoxGO(nn.Module):
+class DirectContractedVoxGO(VoxelRenderer):
+    _log_prefix = 'dcvgo'
+    depth_head = s_depth_head
+
     def __init__(self, xyz_min, xyz_max,
                  num_voxels=0, num_voxels_base=0,
                  alpha_init=None,
@@ -35,7 +28,7 @@ class DirectContractedVoxGO(nn.Module):
                  density_type='DenseGrid', k0_type='DenseGrid',
                  density_config={}, k0_config={},
                  rgbnet_dim=0,
-                 rgbnet_depth=3, rgbnet_width=128,
+                 rgbnet_depth=3, rgbnet_width=128, rgbnet_jit=False,
                  viewbase_pe=4,
                  **kwargs):
         super(DirectContractedVoxGO, self).__init__()
@@ -47,12 +40,7 @@ class DirectContractedVoxGO(nn.Module):
         self.register_buffer('scene_radius', (xyz_max - xyz_min) * 0.5)
         self.register_buffer('xyz_min', torch.Tensor([-1,-1,-1]) - bg_len)
         self.register_buffer('xyz_max', torch.Tensor([1,1,1]) + bg_len)
-        if isinstance(fast_color_thres, dict):
-            self._fast_color_thres = fast_color_thres
-            self.fast_color_thres = fast_color_thres[0]
-        else:
-            self._fast_color_thres = None
-            self.fast_color_thres = fast_color_thres
+        self._set_fast_color_thres(fast_color_thres)
         self.bg_len = bg_len
         self.contracted_norm = contracted_norm
 
@@ -76,44 +64,15 @@ class DirectContractedVoxGO(nn.Module):
             xyz_min=self.xyz_min, xyz_max=self.xyz_max,
             config=self.density_config)
 
-        # init color representation
+        # init color representation (the feature grid always feeds the mlp directly)
         self.rgbnet_kwargs = {
             'rgbnet_dim': rgbnet_dim,
             'rgbnet_depth': rgbnet_depth, 'rgbnet_width': rgbnet_width,
-            'viewbase_pe': viewbase_pe,
+            'viewbase_pe': viewbase_pe, 'rgbnet_jit': rgbnet_jit,
         }
-        self.k0_type = k0_type
-        self.k0_config = k0_config
-        
-        if rgbnet_dim <= 0:
-            # color voxel grid  (coarse stage)
-            self.k0_dim = 3
-            self.k0 = grid.create_grid(
-                k0_type, channels=self.k0_dim, world_size=self.world_size,
-                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
-                config=self.k0_config)
-            self.rgbnet = None
-        else:
-            # feature voxel grid + shallow MLP  (fine stage)
-            self.k0_dim = rgbnet_dim
-            self.k0 = grid.create_grid(
-                k0_type, channels=self.k0_dim, world_size=self.world_size,
-                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
-                config=self.k0_config)
-            self.register_buffer('viewfreq', torch.FloatTensor([(2**i) for i in range(viewbase_pe)]))
-            dim0 = (3+3*viewbase_pe*2)
-            dim0 += self.k0_dim
-            self.rgbnet = nn.Sequential(
-                nn.Linear(dim0, rgbnet_width), nn.ReLU(inplace=True),
-                *[
-                    nn.Sequential(nn.Linear(rgbnet_width, rgbnet_width), nn.ReLU(inplace=True))
-                    for _ in range(rgbnet_depth-2)
-                ],
-                nn.Linear(rgbnet_width, 3),
-            )
-            nn.init.constant_(self.rgbnet[-1].bias, 0)
-            print('dcvgo: feature voxel grid', self.k0)
-            print('dcvgo: mlp', self.rgbnet)
+        self._init_color(
+                k0_type, k0_config, rgbnet_direct=True, rgbnet_full_implicit=False,
+                **self.rgbnet_kwargs)
 
         # Using the coarse geometry if provided (used to determine known free space and unknown space)
         # Re-implement as occupancy grid (2021/1/31)
@@ -124,19 +83,6 @@ class DirectContractedVoxGO(nn.Module):
             path=None, mask=mask,
             xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
-    def _set_grid_resolution(self, num_voxels):
-        # Determine grid resolution
-        self.num_voxels = num_voxels
-        self.voxel_size = ((self.xyz_max - self.xyz_min).prod() / num_voxels).pow(1/3)
-        self.world_size = ((self.xyz_max - self.xyz_min) / self.voxel_size).long()
-        self.world_len = self.world_size[0].item()
-        self.voxel_size_ratio = self.voxel_size / self.voxel_size_base
-
-        print('dcvgo: voxel_size      ', self.voxel_size)
-        print('dcvgo: world_size      ', self.world_size)
-        print('dcvgo: voxel_size_base ', self.voxel_size_base)
-        print('dcvgo: voxel_size_ratio', self.voxel_size_ratio)
-
     def get_kwargs(self):
         return {
             'xyz_min': self.xyz_min.cpu().numpy(),
@@ -155,44 +101,6 @@ class DirectContractedVoxGO(nn.Module):
             **self.rgbnet_kwargs,
         }
 
-    @torch.no_grad()
-    def scale_volume_grid(self, num_voxels):
-        print('dcvgo: scale_volume_grid start')
-        ori_world_size = self.world_size
-        self._set_grid_resolution(num_voxels)
-        print('dcvgo: scale_volume_grid scale world_size from', ori_world_size.tolist(), 'to', self.world_size.tolist())
-
-        self.density.scale_volume_grid(self.world_size)
-        self.k0.scale_volume_grid(self.world_size)
-
-        if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
-            self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
-            self.mask_cache = grid.MaskGrid(
-                path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
-                xyz_min=self.xyz_min, xyz_max=self.xyz_max)
-
-        print('dcvgo: scale_volume_grid finish')
-
-    @torch.no_grad()
-    def update_occupancy_cache(self):
-        ori_p = self.mask_cache.mask.float().mean().item()
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
-        cache_grid_alpha = self.activate_density(cache_grid_density)
-        cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
-        self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
-        new_p = self.mask_cache.mask.float().mean().item()
-        print(f'dcvgo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
-
     def update_occupancy_cache_lt_nviews(self, rays_o_tr, rays_d_tr, imsz, render_kwargs, maskout_lt_nviews):
         print('dcvgo: update mask_cache lt_nviews start')
         eps_time = time.time()
@@ -213,19 +121,6 @@ class DirectContractedVoxGO(nn.Module):
         eps_time = time.time() - eps_time
         print(f'dcvgo: update mask_cache lt_nviews finish (eps time:', eps_time, 'sec)')
 
-    def density_total_variation_add_grad(self, weight, dense_mode):
-        w = weight * self.world_size.max() / 128
-        self.density.total_variation_add_grad(w, w, w, dense_mode)
-
-    def k0_total_variation_add_grad(self, weight, dense_mode):
-        w = weight * self.world_size.max() / 128
-        self.k0.total_variation_add_grad(w, w, w, dense_mode)
-
-    def activate_density(self, density, interval=None):
-        interval = interval if interval is not None else self.voxel_size_ratio
-        shape = density.shape
-        return Raw2Alpha.apply(density.flatten(), self.act_shift, interval).reshape(shape)
-
     def sample_ray(self, ori_rays_o, ori_rays_d, stepsize, is_train=False, **render_kwargs):
         '''Sample query points on rays.
         All the output points are sorted from near to far.
@@ -262,151 +157,52 @@ class DirectContractedVoxGO(nn.Module):
         )
         return ray_pts, inner_mask.squeeze(-1), t
 
-    def forward(self, rays_o, rays_d, viewdirs, global_step=None, is_train=False, render_fct=0.0, **render_kwargs):
-        '''Volume rendering
-        @rays_o:   [N, 3] the starting point of the N shooting rays.
-        @rays_d:   [N, 3] the shooting direction of the N rays.
-        @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
+    def sample_points(self, rays_o, rays_d, global_step=None, with_distance=False, stats=None, **render_kwargs):
+        '''Contracted sampler: the unbounded scene is contracted into the bbox
+        and the oversampled points outside the scene are skipped.
+        @with_distance: also track the distance from ray_o to each point.
         '''
-        assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
-        if isinstance(self._fast_color_thres, dict) and global_step in self._fast_color_thres:
-            print(f'dcvgo: update fast_color_thres {self.fast_color_thres} => {self._fast_color_thres[global_step]}')
-            self.fast_color_thres = self._fast_color_thres[global_step]
-
-        ret_dict = {}
         N = len(rays_o)
-
-        # sample points on rays
-        ray_pts, inner_mask, t = self.sample_ray( # ray_pts: [8192, num_sample, 3]
-                ori_rays_o=rays_o, ori_rays_d=rays_d, is_train=global_step is not None, **render_kwargs) 
+        ray_pts, inner_mask, t = self.sample_ray(
+                ori_rays_o=rays_o, ori_rays_d=rays_d, is_train=global_step is not None, **render_kwargs)
         n_max = len(t)
-        interval = render_kwargs['stepsize'] * self.voxel_size_ratio
         ray_id, step_id = create_full_step_id(ray_pts.shape[:2])
 
-        # cumsum ray_pts to get distance from ray_o to any ray_pt in a ray
-        ray_distance = torch.zeros_like(ray_pts)
-        ray_distance[:, 1:] = torch.abs(ray_pts[:, 1:] - ray_pts[:, :-1])
-        ray_distance = torch.cumsum(ray_distance, dim=1)
-
         # skip oversampled points outside scene bbox
         mask = inner_mask.clone()
         dist_thres = (2+2*self.bg_len) / self.world_len * render_kwargs['stepsize'] * 0.95
         dist = (ray_pts[:,1:] - ray_pts[:,:-1]).norm(dim=-1)
         mask[:, 1:] |= ub360_utils_cuda.cumdist_thres(dist, dist_thres)
-        ray_pts = ray_pts[mask]
-        ray_distance = ray_distance[mask]
-        inner_mask = inner_mask[mask]
-        t = t[None].repeat(N,1)[mask]
-        ray_id = ray_id[mask.flatten()]
-        step_id = step_id[mask.flatten()]
-
-        # skip known free space
-        mask = self.mask_cache(ray_pts)
-        ray_pts = ray_pts[mask]
-        ray_distance = ray_distance[mask]
-        inner_mask = inner_mask[mask]
-        t = t[mask]
-        ray_id = ray_id[mask]
-        step_id = step_id[mask]
-
-        render_fct = max(render_fct, self.fast_color_thres)
-
-        # query for alpha w/ post-activation
-        density = self.density(ray_pts)
-        alpha = self.activate_density(density, interval)
-        if render_fct > 0:
-            mask = (alpha > render_fct)
-            ray_pts = ray_pts[mask]
-            ray_distance = ray_distance[mask]
-            inner_mask = inner_mask[mask]
-            t = t[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            alpha = alpha[mask]
-
-        # compute accumulated transmittance
-        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
-        if render_fct > 0:
-            mask = (weights > render_fct)
-            ray_pts = ray_pts[mask]
-            ray_distance = ray_distance[mask]
-            inner_mask = inner_mask[mask]
-            t = t[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            alpha = alpha[mask]
-            weights = weights[mask]
-
-        # query for color
-        k0 = self.k0(ray_pts)
-        if self.rgbnet is None:
-            # no view-depend effect
-            rgb = torch.sigmoid(k0)
-        else:
-            # view-dependent color emission
-            viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
-            viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
-            viewdirs_emb = viewdirs_emb.flatten(0,-2)[ray_id]
-            rgb_feat = torch.cat([k0, viewdirs_emb], -1)
-            rgb_logit = self.rgbnet(rgb_feat)
-            rgb = torch.sigmoid(rgb_logit)
-
-        # Ray marching
-        rgb_marched = segment_coo(
-                src=(weights.unsqueeze(-1) * rgb),
-                index=ray_id,
-                out=torch.zeros([N, 3]),
-                reduce='sum')
-
-        if render_kwargs.get('rand_bkgd', False) and is_train:
-            rgb_marched += (alphainv_last.unsqueeze(-1) * torch.rand_like(rgb_marched))
-        else:
-            rgb_marched += (alphainv_last.unsqueeze(-1) * render_kwargs['bg'])
-        wsum_mid = segment_coo(
-                src=weights[inner_mask],
-                index=ray_id[inner_mask],
-                out=torch.zeros([N]),
-                reduce='sum')
-
-        s = 1 - 1/(1+t)  # [0, inf] => [0, 1]
-        ret_dict.update({
-            'alphainv_last': alphainv_last,
-            'weights': weights,
-            'wsum_mid': wsum_mid,
-            'rgb_marched': rgb_marched,
-            'raw_density': density,
-            'raw_alpha': alpha,
-            'raw_rgb': rgb,
-            'ray_id': ray_id,
-            'step_id': step_id,
-            'n_max': n_max,
+        t = t[None].expand(N,-1)[mask]
+        if stats is not None:
+            stats.add('generated', ray_id, N)
+            stats.add('bbox', ray_id[mask.flatten()], N)
+        samples = {
+            'ray_pts': ray_pts[mask],
+            'ray_id': ray_id[mask.flatten()],
+            'step_id': step_id[mask.flatten()],
+            'inner_mask': inner_mask[mask],
             't': t,
-            's': s,
-            'density': density,
-            'ray_pts': ray_pts
-        })
-
+            's': 1 - 1/(1+t),  # [0, inf] => [0, 1]
+        }
+        if with_distance:
+            # cumsum ray_pts to get distance from ray_o to any ray_pt in a ray
+            ray_distance = torch.zeros_like(ray_pts)
+            ray_distance[:, 1:] = torch.abs(ray_pts[:, 1:] - ray_pts[:, :-1])
+            ray_distance = torch.cumsum(ray_distance, dim=1)
+            samples['ray_distance'] = ray_distance[mask].norm(dim=-1)
+        return samples, {'n_max': n_max}
+
+    def field_heads(self, render_kwargs):
+        heads = [rgb_head, wsum_mid_head]
         if render_kwargs.get('render_depth', False):
-            with torch.no_grad():
-                depth = segment_coo(
-                        src=(weights * s),
-                        index=ray_id,
-                        out=torch.zeros([N]),
-                        reduce='sum')
-                # depth = segment_coo(
-                #         src=(weights * ray_distance.norm(dim=-1)),
-                #         index=ray_id,
-                #         out=torch.zeros([N]),
-                #         reduce='sum')
-            ret_dict.update({'depth': depth})
-
-        return ret_dict
+            heads.append(self.depth_head)
+        return heads
 
 
 class DistortionLoss(torch.autograd.Function):
     @staticmethod
+    @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, w, s, n_max, ray_id):
         n_rays = ray_id.max()+1
         interval = 1/n_max
@@ -419,6 +215,7 @@ class DistortionLoss(torch.autograd.Function):
 
     @staticmethod
     @torch.autograd.function.once_differentiable
+    @torch.cuda.amp.custom_bwd
     def backward(ctx, grad_back):
         w, s, w_prefix, w_total, ws_prefix, ws_total, ray_id = ctx.saved_tensors
         interval = ctx.interval
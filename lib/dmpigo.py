@@ -11,7 +11,7 @@ from einops import rearrange
 from torch_scatter import scatter_add, segment_coo
 
 from . import grid
-from .dvgo import Raw2Alpha, Alphas2Weights, render_utils_cuda
+from .render_core import Raw2Alpha, Alphas2Weights, render_utils_cuda
 
 
 '''Model'''
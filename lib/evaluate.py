@@ -1,6 +1,12 @@
 import os
+import csv
+import json
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import imageio
+import scipy.ndimage
 
 def cal_IoU(a, b):
     """Calculates the Intersection over Union (IoU) between two ndarrays.
@@ -47,19 +53,197 @@ def cal_IoU_from_paths(a_paths, b_paths):
     b = np.stack([imageio.imread(path) > 0 for path in b_paths])
     return cal_IoU(a, b)
 
+''' Multi-object segmentation evaluation
+Label maps hold a class id per pixel, 0 being the background and k the k-th
+object. The frames are streamed: each one only updates a [C, C] confusion
+matrix and the boundary match counts, and keeps a few per-class scores, so
+the memory does not grow with the resolution or with the masks held.
+'''
+def read_label_map(path, num_classes):
+    '''Read a mask image as a [H, W] label map.
+    Binary evaluation (num_classes == 2): any non-zero channel is foreground.
+    Otherwise a [H, W, K] image (mask_*.png of render_fn) has one channel per
+    object, and a [H, W] image holds the class ids.
+    '''
+    img = np.asarray(imageio.imread(path))
+    if num_classes == 2:
+        return (img.reshape(*img.shape[:2], -1) > 0).any(-1).astype(np.int64)
+    if img.ndim == 3:
+        return segs_to_label_map(img > 0, thres=0)
+    return img.astype(np.int64)
+
+
+def segs_to_label_map(seg, thres=0.1):
+    '''Winner-takes-all label map of a [H, W, K] (or [H, W]) mask logit / binary
+    render, as in render_fn: pixels whose max value is <= thres are background.
+    '''
+    seg = np.asarray(seg)
+    if seg.ndim == 2:
+        seg = seg[..., None]
+    seg = seg.astype(np.float32)
+    label = seg.argmax(-1) + 1
+    label[seg.max(-1) <= thres] = 0
+    return label
+
+
+def stream_label_maps(paths, num_classes, n_workers=8, prefetch=16):
+    '''Read the label maps in parallel, in order, with at most `prefetch` pending frames.'''
+    with ThreadPoolExecutor(n_workers) as pool:
+        pending = collections.deque()
+        for path in paths:
+            pending.append(pool.submit(read_label_map, path, num_classes))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
+
+
+def label_boundaries(label, num_classes):
+    '''[C, H, W] boundary pixels (pixels with a 4-neighbour of another class) of each class.'''
+    onehot = label[None] == np.arange(num_classes)[:, None, None]
+    cross = np.zeros([1, 3, 3], dtype=bool)
+    cross[0, 1, :] = cross[0, :, 1] = True
+    return onehot & ~scipy.ndimage.binary_erosion(onehot, cross, border_value=1)
+
+
+class SegEvaluator:
+    '''Accumulate the confusion matrix, per-frame IoU / accuracy and the boundary
+    F-score of predicted vs ground-truth label maps with num_classes classes.
+    @boundary_tol: distance (pixels) under which boundary pixels match.
+    '''
+    def __init__(self, num_classes, boundary_tol=2):
+        self.num_classes = num_classes
+        self.confusion = np.zeros([num_classes, num_classes], dtype=np.int64)
+        yy, xx = np.mgrid[-boundary_tol:boundary_tol+1, -boundary_tol:boundary_tol+1]
+        self.disk = (yy**2 + xx**2 <= boundary_tol**2)[None]
+        # boundary pixels of pred, of gt, and the matched ones of each, per class
+        self.boundary_counts = np.zeros([4, num_classes], dtype=np.int64)
+        self.frames = []
+
+    def _boundary_counts(self, pred, gt):
+        pred_b = label_boundaries(pred, self.num_classes)
+        gt_b = label_boundaries(gt, self.num_classes)
+        pred_match = pred_b & scipy.ndimage.binary_dilation(gt_b, self.disk)
+        gt_match = gt_b & scipy.ndimage.binary_dilation(pred_b, self.disk)
+        return np.stack([b.sum((1, 2)) for b in [pred_b, gt_b, pred_match, gt_match]])
+
+    def add(self, pred, gt, name=None):
+        '''Accumulate a frame, pred and gt are [H, W] integer label maps.'''
+        pred = np.asarray(pred, dtype=np.int64)
+        gt = np.asarray(gt, dtype=np.int64)
+        assert pred.shape == gt.shape, f'prediction {pred.shape} vs ground truth {gt.shape}'
+        C = self.num_classes
+        if pred.max() >= C or gt.max() >= C or pred.min() < 0 or gt.min() < 0:
+            raise ValueError(f'label out of [0, {C}) in frame {name}')
+        confusion = np.bincount((gt * C + pred).ravel(), minlength=C*C).reshape(C, C)
+        boundary_counts = self._boundary_counts(pred, gt)
+        self.confusion += confusion
+        self.boundary_counts += boundary_counts
+        iou, _ = confusion_iou(confusion)
+        bf = boundary_fscore(boundary_counts)
+        self.frames.append({
+            'frame': name if name is not None else len(self.frames),
+            'accuracy': float(np.trace(confusion) / max(confusion.sum(), 1)),
+            'iou': iou.tolist(),
+            'boundary_f': bf.tolist(),
+        })
+
+    def summary(self):
+        iou, present = confusion_iou(self.confusion)
+        bf = boundary_fscore(self.boundary_counts)
+        return {
+            'num_classes': self.num_classes,
+            'n_frames': len(self.frames),
+            'accuracy': float(np.trace(self.confusion) / max(self.confusion.sum(), 1)),
+            'mIoU': float(iou[present].mean()) if present.any() else float('nan'),
+            'iou': iou.tolist(),
+            'boundary_f': bf.tolist(),
+            'mean_boundary_f': float(np.nanmean(bf)) if np.isfinite(bf).any() else float('nan'),
+            'confusion': self.confusion.tolist(),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'frames': self.frames}, f, indent=2)
+
+    def write_csv(self, path):
+        '''One row per frame and class.'''
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'class', 'iou', 'boundary_f', 'frame_accuracy'])
+            for frame in self.frames:
+                for c in range(self.num_classes):
+                    writer.writerow([frame['frame'], c, frame['iou'][c], frame['boundary_f'][c], frame['accuracy']])
+
+
+def confusion_iou(confusion):
+    '''Per-class IoU of a [C, C] (gt, pred) confusion matrix, NaN for the absent classes.'''
+    inter = np.diag(confusion).astype(np.float64)
+    union = confusion.sum(0) + confusion.sum(1) - inter
+    present = union > 0
+    iou = np.full(len(confusion), np.nan)
+    iou[present] = inter[present] / union[present]
+    return iou, present
+
+
+def boundary_fscore(counts):
+    '''Per-class boundary F-score from the [4, C] boundary counts, NaN if no boundary.'''
+    n_pred, n_gt, pred_match, gt_match = counts.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.where(n_pred > 0, pred_match / n_pred, 0.)
+        recall = np.where(n_gt > 0, gt_match / n_gt, 0.)
+        f = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.)
+    f[(n_pred == 0) & (n_gt == 0)] = np.nan
+    return f
+
+
+def evaluate_paths(mask_paths, gt_paths, num_classes, boundary_tol=2, n_workers=8):
+    '''Stream and score the mask images against the ground-truth ones.'''
+    assert len(mask_paths) == len(gt_paths)
+    evaluator = SegEvaluator(num_classes, boundary_tol)
+    preds = stream_label_maps(mask_paths, num_classes, n_workers)
+    gts = stream_label_maps(gt_paths, num_classes, n_workers)
+    for path, pred, gt in zip(mask_paths, preds, gts):
+        evaluator.add(pred, gt, name=os.path.basename(path))
+    return evaluator
+
+
+def evaluate_segs(segs, gt_label_maps, num_classes, thres=0.1, boundary_tol=2):
+    '''Score the in-memory [N, H, W, K] segs of render_viewpoints against label maps.'''
+    evaluator = SegEvaluator(num_classes, boundary_tol)
+    for seg, gt in zip(segs, gt_label_maps):
+        evaluator.add(segs_to_label_map(seg, thres), gt)
+    return evaluator
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--mask_path', type=str, required=True)
     parser.add_argument('--gt_path', type=str, required=True)
+    parser.add_argument('--num_classes', type=int, default=2,
+                        help='background + number of objects, 2 for the binary IoU')
+    parser.add_argument('--boundary_tol', type=int, default=2)
+    parser.add_argument('--n_workers', type=int, default=8)
+    parser.add_argument('--out', type=str, default=None,
+                        help='write the <out>.json and <out>.csv reports')
     args = parser.parse_args()
 
     if os.path.isdir(args.mask_path):
         assert(os.path.isdir(args.gt_path))
         mask_paths = [os.path.join(args.mask_path, f) for f in sorted(os.listdir(args.mask_path))]
         gt_paths = [os.path.join(args.gt_path, f) for f in sorted(os.listdir(args.gt_path))]
-        iou = cal_IoU_from_paths(mask_paths, gt_paths)
     else:
-        iou = cal_IoU_from_path(args.mask_path, args.gt_path)
-    
-    print('IoU: ', iou)
\ No newline at end of file
+        mask_paths, gt_paths = [args.mask_path], [args.gt_path]
+    evaluator = evaluate_paths(mask_paths, gt_paths, args.num_classes, args.boundary_tol, args.n_workers)
+    summary = evaluator.summary()
+
+    if args.num_classes == 2:
+        # pooled foreground IoU
+        print('IoU: ', summary['iou'][1])
+    for c, (iou, bf) in enumerate(zip(summary['iou'], summary['boundary_f'])):
+        print(f'class {c}: IoU {iou:.4f} / boundary F {bf:.4f}')
+    print(f"mIoU: {summary['mIoU']:.4f} / accuracy: {summary['accuracy']:.4f} / "
+          f"boundary F: {summary['mean_boundary_f']:.4f}")
+    if args.out is not None:
+        evaluator.write_json(args.out + '.json')
+        evaluator.write_csv(args.out + '.csv')
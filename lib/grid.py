@@ -1,4 +1,3 @@
-import os
 import time
 import numpy as np
 
@@ -8,21 +7,8 @@ import torch.nn.functional as F
 
 import time
 
-from torch.utils.cpp_extension import load
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-render_utils_cuda = load(
-        name='render_utils_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu']],
-        verbose=True)
-
-total_variation_cuda = load(
-        name='total_variation_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu']],
-        verbose=True)
+from .checkpoint import read_checkpoint
+from .cuda_ext import render_utils_cuda, total_variation_cuda
 
 
 def create_grid(type, **kwargs):
@@ -157,6 +143,9 @@ class DenseGrid(nn.Module):
 ''' Vector-Matrix decomposited grid
 See TensoRF: Tensorial Radiance Fields (https://arxiv.org/abs/2203.09517)
 '''
+# bound of the number of voxel values materialized per slab by get_dense_grid
+DENSE_SLAB_NUMEL = 2**26
+
 class TensoRFGrid(nn.Module):
     def __init__(self, channels, world_size, xyz_min, xyz_max, config):
         super(TensoRFGrid, self).__init__()
@@ -223,20 +212,46 @@ class TensoRFGrid(nn.Module):
         loss /= 6
         loss.backward()
 
-    def get_dense_grid(self):
+    def get_dense_grid(self, slab_size=None, out=None):
+        '''Materialize the [1, C, X, Y, Z] dense grid slab by slab along X.
+        @slab_size: number of X slices per slab (default: ~DENSE_SLAB_NUMEL values per slab).
+        @out:       preallocated [1, C, X, Y, Z] output, e.g. on cpu or memory-mapped.
+        '''
+        X, Y, Z = self.dense_shape()
+        C = max(self.channels, 1)
+        if slab_size is None:
+            slab_size = max(1, DENSE_SLAB_NUMEL // (C * Y * Z))
+        if out is None:
+            out = torch.empty([1, C, X, Y, Z], dtype=self.x_vec.dtype, device=self.x_vec.device)
+        for start_x in range(0, X, slab_size):
+            end_x = min(start_x + slab_size, X)
+            out[0, :, start_x:end_x] = self.get_dense_slab(start_x, end_x).to(out.device)
+        return out
+
+    def get_dense_slab(self, start_x, end_x):
+        '''Dense [C, end_x-start_x, Y, Z] values of the X range [start_x, end_x).
+        f_vec is folded into the vectors first, so each plane-vector product is a
+        single contraction over the components and no [R, x, Y, Z] tensor is built.
+        '''
+        xy_plane = self.xy_plane[0, :, start_x:end_x]
+        xz_plane = self.xz_plane[0, :, start_x:end_x]
+        yz_plane = self.yz_plane[0]
+        x_vec = self.x_vec[0, :, start_x:end_x, 0]
+        y_vec = self.y_vec[0, :, :, 0]
+        z_vec = self.z_vec[0, :, :, 0]
         if self.channels > 1:
-            feat = torch.cat([
-                torch.einsum('rxy,rz->rxyz', self.xy_plane[0], self.z_vec[0,:,:,0]),
-                torch.einsum('rxz,ry->rxyz', self.xz_plane[0], self.y_vec[0,:,:,0]),
-                torch.einsum('ryz,rx->rxyz', self.yz_plane[0], self.x_vec[0,:,:,0]),
-            ])
-            grid = torch.einsum('rxyz,rc->cxyz', feat, self.f_vec)[None]
-        else:
-            grid = torch.einsum('rxy,rz->xyz', self.xy_plane[0], self.z_vec[0,:,:,0]) + \
-                   torch.einsum('rxz,ry->xyz', self.xz_plane[0], self.y_vec[0,:,:,0]) + \
-                   torch.einsum('ryz,rx->xyz', self.yz_plane[0], self.x_vec[0,:,:,0])
-            grid = grid[None,None]
-        return grid
+            f_xy, f_xz, f_yz = self.f_vec.split([len(xy_plane), len(xz_plane), len(yz_plane)])
+            return torch.einsum('rxy,rcz->cxyz', xy_plane, torch.einsum('rz,rc->rcz', z_vec, f_xy)) + \
+                   torch.einsum('rxz,rcy->cxyz', xz_plane, torch.einsum('ry,rc->rcy', y_vec, f_xz)) + \
+                   torch.einsum('ryz,rcx->cxyz', yz_plane, torch.einsum('rx,rc->rcx', x_vec, f_yz))
+        slab = torch.einsum('rxy,rz->xyz', xy_plane, z_vec) + \
+               torch.einsum('rxz,ry->xyz', xz_plane, y_vec) + \
+               torch.einsum('ryz,rx->xyz', yz_plane, x_vec)
+        return slab[None]
+
+    def dense_shape(self):
+        # world_size is not updated by scale_volume_grid, read it from the planes
+        return self.xy_plane.shape[2], self.xy_plane.shape[3], self.xz_plane.shape[3]
 
     def extra_repr(self):
         return f'channels={self.channels}, world_size={self.world_size.tolist()}, n_comp={self.config["n_comp"]}'
@@ -278,7 +293,8 @@ class MaskGrid(nn.Module):
     def __init__(self, path=None, mask_cache_thres=None, mask=None, xyz_min=None, xyz_max=None):
         super(MaskGrid, self).__init__()
         if path is not None:
-            st = torch.load(path)
+            st = read_checkpoint(path, sections=['model_kwargs', 'model_state_dict'],
+                                 state_keys=['density.grid', 'act_shift'])
             self.mask_cache_thres = mask_cache_thres
             density = F.max_pool3d(st['model_state_dict']['density.grid'], kernel_size=3, padding=1, stride=1)
             alpha = 1 - torch.exp(-F.softplus(density + st['model_state_dict']['act_shift']) * st['model_kwargs']['voxel_size_ratio'])
@@ -302,7 +318,14 @@ class MaskGrid(nn.Module):
         '''
         shape = xyz.shape[:-1]
         xyz = xyz.reshape(-1, 3)
-        mask = render_utils_cuda.maskcache_lookup(self.mask, xyz, self.xyz2ijk_scale, self.xyz2ijk_shift)
+        if xyz.is_cuda:
+            mask = render_utils_cuda.maskcache_lookup(self.mask, xyz, self.xyz2ijk_scale, self.xyz2ijk_shift)
+        else:
+            ijk = torch.round(xyz * self.xyz2ijk_scale + self.xyz2ijk_shift).long()
+            inside = ((ijk >= 0) & (ijk < torch.tensor(self.mask.shape, device=xyz.device))).all(-1)
+            mask = torch.zeros([len(xyz)], dtype=torch.bool, device=xyz.device)
+            ijk = ijk[inside]
+            mask[inside] = self.mask[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
         mask = mask.reshape(shape)
         return mask
 
@@ -310,73 +333,73 @@ class MaskGrid(nn.Module):
         return f'mask.shape=list(self.mask.shape)'
 
 
-def get_dense_grid_batch_processing(tensorf: TensoRFGrid):
+@torch.no_grad()
+def get_dense_grid_batch_processing(tensorf: TensoRFGrid, slab_size=None, device=None, mmap_path=None):
     '''
-    Expects the tensorf to be already on device and processes it on device batchwise.
-    Not transferring from cpu to avoid repeated transfers from cpu to device
-    Returns the grid which is also on device
+    Materialize the dense grid of a TensoRFGrid slab by slab along X.
+    The slabs are computed on the device of the tensorf and written into a
+    preallocated [1, C, X, Y, Z] output with the channel count of the grid.
+    @device:    device of the output (default: the device of the tensorf).
+    @mmap_path: write the output into a memory-mapped file on cpu instead.
     '''
-    # we will construct it 3d column wise
-    # result_grid = torch.zeros([1, tensorf.channels, *tensorf.world_size], dtype=tensorf.xy_plane.dtype).cpu()
+    X, Y, Z = tensorf.dense_shape()
+    C = max(tensorf.channels, 1)
+    dtype = tensorf.x_vec.dtype
     start_time = time.time()
-    # result_grid = torch.stack([torch.zeros([1, *tensorf.world_size], dtype=tensorf.x_vec.dtype).cpu() for _ in range(tensorf.channels)], dim=1)
-#     print(tensorf.channels, tensorf.world_size)
-#     result_grid = torch.zeros([1, tensorf.channels, *tensorf.world_size], dtype=tensorf.x_vec.dtype)
-    # debugging
-    result_grid = torch.zeros([1, 64, *tensorf.world_size], dtype=tensorf.x_vec.dtype)
-    print("Time taken for initializing the grid", time.time() - start_time)
-
-    # created y batches just in case if needed
-
-    batch_size_x = 35
-    batch_size_y = 35
-    batch_size_z = 35
-    for start_x in range(0, tensorf.world_size[0], batch_size_x):
-        end_x = start_x + batch_size_x
-        for start_y in range(0, tensorf.world_size[1], batch_size_y):
-            end_y = start_y + batch_size_y
-            for start_z in range(0, tensorf.world_size[2], batch_size_z):
-                end_z = start_z + batch_size_z
-                feat = torch.cat([
-                    torch.einsum('rxy,rz->rxyz', tensorf.xy_plane[0, :, start_x:end_x, start_y:end_y], tensorf.z_vec[0,:,start_z:end_z,0]),
-                    torch.einsum('rxz,ry->rxyz', tensorf.xz_plane[0, :, start_x:end_x, start_z:end_z], tensorf.y_vec[0,:,start_y:end_y,0]),
-                    torch.einsum('ryz,rx->rxyz', tensorf.yz_plane[0, :, start_y:end_y, start_z:end_z], tensorf.x_vec[0,:,start_x:end_x,0]),
-                ])
-                sub_grid = torch.einsum('rxyz,rc->cxyz', feat, tensorf.f_vec)[None]
-                result_grid[:, :, start_x:end_x, start_y:end_y, start_z:end_z] = sub_grid[:,:64,:,:,:]
-    return result_grid
+    if mmap_path is not None:
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        out = torch.from_numpy(np.memmap(mmap_path, dtype=np_dtype, mode='w+', shape=(1, C, X, Y, Z)))
+    else:
+        device = device if device is not None else tensorf.x_vec.device
+        out = torch.empty([1, C, X, Y, Z], dtype=dtype, device=device)
+    tensorf.get_dense_grid(slab_size=slab_size, out=out)
+    if tensorf.x_vec.is_cuda:
+        torch.cuda.synchronize()
+    eps_time = time.time() - start_time
+    print(f'get_dense_grid: {C}x{X}x{Y}x{Z} grid in {eps_time:.2f}s ({X*Y*Z/max(eps_time, 1e-9)/1e6:.1f}M voxels/s)')
+    return out
 
 @torch.no_grad()
 def reconstruct_feature_grid(render_viewpoints_kwargs):
     model = render_viewpoints_kwargs['model']
 
     f_k0 = model.f_k0.cuda()
-    fg = get_dense_grid_batch_processing(f_k0).cuda()
+    fg = get_dense_grid_batch_processing(f_k0)
 
-    fg_kmeans = fg.clone()
-    fg_kmeans = fg_kmeans.squeeze(0).permute(1, 2, 3, 0) # x, y, z, 64
-    fg_kmeans = fg_kmeans.reshape(-1, 64)
+    fg_kmeans = fg[0].flatten(1).T # x*y*z, channels
     fg_kmeans = fg_kmeans.cpu().contiguous()
 
     return torch.nn.functional.pad(fg, [1] * 6), fg_kmeans
 
 if __name__ == "__main__":
+    def reference_dense_grid(tensorf):
+        # full-volume einsum, only feasible for small grids
+        if tensorf.channels > 1:
+            feat = torch.cat([
+                torch.einsum('rxy,rz->rxyz', tensorf.xy_plane[0], tensorf.z_vec[0,:,:,0]),
+                torch.einsum('rxz,ry->rxyz', tensorf.xz_plane[0], tensorf.y_vec[0,:,:,0]),
+                torch.einsum('ryz,rx->rxyz', tensorf.yz_plane[0], tensorf.x_vec[0,:,:,0]),
+            ])
+            return torch.einsum('rxyz,rc->cxyz', feat, tensorf.f_vec)[None]
+        grid = torch.einsum('rxy,rz->xyz', tensorf.xy_plane[0], tensorf.z_vec[0,:,:,0]) + \
+               torch.einsum('rxz,ry->xyz', tensorf.xz_plane[0], tensorf.y_vec[0,:,:,0]) + \
+               torch.einsum('ryz,rx->xyz', tensorf.yz_plane[0], tensorf.x_vec[0,:,:,0])
+        return grid[None,None]
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
     with torch.no_grad():
         print("Testing whether the outputted grid is the correct or not.")
-        tensorf = TensoRFGrid(64, torch.tensor([100, 100, 100]), 0, 1, {'n_comp': 64})
-        tensorf = tensorf.cuda()
-        start_time = time.time()
-        grid1 = tensorf.get_dense_grid().cpu()
-        print("Time taken for full gpu implementation", time.time() - start_time)
-        grid2 = get_dense_grid_batch_processing(tensorf)
-        assert grid1.isclose(grid2, atol=1e-7).all()
-        del grid1, grid2, tensorf
-
-        torch.cuda.empty_cache()
-
-        tensorf = TensoRFGrid(64, torch.tensor([320, 320, 320]), 0, 1, {'n_comp': 64})
-        tensorf = tensorf.cuda()
-        start_time = time.time()
-        grid = get_dense_grid_batch_processing(tensorf)
-        print("Time taken to reconstruct the grid", time.time() - start_time)
-        print("Program over.")
\ No newline at end of file
+        for channels in [1, 12, 64]:
+            tensorf = TensoRFGrid(channels, torch.tensor([50, 60, 70]), [0,0,0], [1,1,1], {'n_comp': 16, 'n_comp_xy': 24}).to(device)
+            grid1 = reference_dense_grid(tensorf)
+            grid2 = get_dense_grid_batch_processing(tensorf, slab_size=7)
+            assert grid1.shape == grid2.shape and torch.allclose(grid1, grid2, atol=1e-4)
+            grid3 = get_dense_grid_batch_processing(tensorf, device='cpu')
+            assert torch.allclose(grid1.cpu(), grid3, atol=1e-4)
+        del grid1, grid2, grid3, tensorf
+
+        if device == 'cuda':
+            torch.cuda.empty_cache()
+            tensorf = TensoRFGrid(64, torch.tensor([320, 320, 320]), [0,0,0], [1,1,1], {'n_comp': 64}).cuda()
+            grid = get_dense_grid_batch_processing(tensorf, device='cpu')
+        print("Program over.")
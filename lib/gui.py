@@ -7,6 +7,9 @@ import os
 import cv2
 import imageio
 import time
+import queue
+import base64
+import threading
 import matplotlib.pyplot as plt
 import numpy as np
 import plotly.express as px
@@ -15,6 +18,8 @@ import dash
 from dash import Dash, Input, Output, dcc, html, State
 from dash.exceptions import PreventUpdate
 from .self_prompting import grounding_dino_prompt
+from .render_utils import fetch_render_params
+from .sam3d import fetch_seg_poses
 
 def mark_image(_img, points):
     assert(len(points) > 0)
@@ -37,6 +42,123 @@ def draw_figure(fig, title, animation_frame=None):
     return fig
 
 
+def encode_image(img, max_side=512, quality=85):
+    '''[H, W, 3] uint8 image as a downscaled JPEG data URI for html.Img'''
+    H, W = img.shape[:2]
+    scale = max_side / max(H, W)
+    if scale < 1:
+        img = cv2.resize(img, (int(W*scale), int(H*scale)), interpolation=cv2.INTER_AREA)
+    _, buf = cv2.imencode('.jpg', cv2.cvtColor(np.ascontiguousarray(img), cv2.COLOR_RGB2BGR),
+                          [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return 'data:image/jpeg;base64,' + base64.b64encode(buf).decode()
+
+
+def image_panel(id, title, img):
+    return html.Div(children=[
+        html.H6(title),
+        html.Img(id=id, src=encode_image(img), style={'width': '100%'}),
+    ], style={'display': 'inline-block', 'width': '40%', 'padding': '1%', 'vertical-align': 'top'})
+
+
+class TrainingWorker:
+    '''Run the cross-view training, save_ckpt and render_test of a Sam3D in a
+    background thread, so that the Dash callbacks return immediately.
+    The progress is put in `events` as dicts with a `kind`:
+        step:   the view trained, with the seg_rgb / sam_mask JPEG previews,
+        status: training / saving / previewing / rendering / finished / cancelled / failed,
+        videos: the JPEG frames of the masked_rgb / seged_rgb videos of render_test.
+    cancel() stops after the view in flight and drops the pending previews; the
+    checkpoint is only saved once every view is trained. A worker started at
+    train_idx > 0 resumes the training of a cancelled one.
+    '''
+    def __init__(self, Seg3d, sam_mask, train_idx=0, preview_factors=(8, 4), max_side=512):
+        self.Seg3d = Seg3d
+        self.sam_mask = sam_mask
+        self.train_idx = train_idx
+        self.n_views = len(fetch_seg_poses(Seg3d.args.seg_poses, Seg3d.data_dict)[0])
+        self.preview_factors = preview_factors
+        self.max_side = max_side
+        self.events = queue.Queue()
+        self.status = 'idle'
+        self.preview = None
+        self.cancelled = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+        if self.preview is not None:
+            self.preview.cancel()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def poll(self):
+        '''The events put since the last poll'''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _set_status(self, status):
+        self.status = status
+        self.events.put({'kind': 'status', 'status': status})
+
+    def _run(self):
+        try:
+            self._set_status('training')
+            is_finished = self.train_idx >= self.n_views
+            while not is_finished:
+                if self.cancelled:
+                    self._set_status('cancelled')
+                    return
+                # optim in the first view with the selected mask, then cross-view training
+                sam_mask = self.sam_mask if self.train_idx == 0 else None
+                rgb, sam_prompt, is_finished = self.Seg3d.train_step(self.train_idx, sam_mask=sam_mask)
+                self.train_idx += 1
+                self.events.put({
+                    'kind': 'step', 'idx': self.train_idx, 'n_views': self.n_views,
+                    'seg_rgb': encode_image(rgb, self.max_side),
+                    'sam_mask': encode_image(sam_prompt, self.max_side) if sam_prompt is not None else None,
+                })
+            self._set_status('saving')
+            self.Seg3d.save_ckpt()
+
+            # stream the coarse previews of the shown view, then stop the previewer
+            # before the full resolution videos, which also modify the density
+            # grid for seg_density
+            self._set_status('previewing')
+            self.preview = self.Seg3d.preview_renderer(factors=self.preview_factors)
+            if self.cancelled:
+                self.preview.cancel()
+            self.preview.start().wait_selected()
+            self.preview.stop()
+            if self.cancelled:
+                self._set_status('cancelled')
+                return
+            self._set_status('rendering')
+            videos = self.Seg3d.render_test()
+            self.events.put({
+                'kind': 'videos',
+                'videos': [[encode_image(frame, self.max_side) for frame in video] for video in videos],
+            })
+            self._set_status('finished')
+        except Exception as e:
+            logging.exception('TrainingWorker failed')
+            self.events.put({'kind': 'status', 'status': 'failed', 'error': f'{type(e).__name__}: {e}'})
+            self.status = 'failed'
+        finally:
+            # save the trace of the views trained when cancelled or failed
+            self.Seg3d.tracer.close()
+
+
 class Sam3dGUI:
     def __init__(self, Seg3d, debug=False):
         ctx = {
@@ -46,17 +168,18 @@ class Sam3dGUI:
             'btn_clear': 0, 
             'btn_text': 0, 
             'prompt_type': 'point',
-            'show_rgb': False
             }
         self.ctx = ctx
         self.Seg3d = Seg3d
         self.debug = debug
 
-        self.train_idx = 0
+        # training, saving and rendering run in the background worker
+        self.worker = None
 
     def run(self):
         init_rgb = self.Seg3d.init_model()
         self.ctx['cur_img'] = init_rgb
+        self.ctx['n_preview_views'] = len(fetch_render_params(self.Seg3d.args.render_opt, self.Seg3d.data_dict)[0])
         self.run_app(sam_pred=self.Seg3d.predictor, ctx=self.ctx, init_rgb=init_rgb)
 
 
@@ -108,10 +231,8 @@ class Sam3dGUI:
         self.ctx['fig1'] = draw_figure(np.zeros_like(init_rgb), 'mask0')
         self.ctx['fig2'] = draw_figure(np.zeros_like(init_rgb), 'mask1')
         self.ctx['fig3'] = draw_figure(np.zeros_like(init_rgb), 'mask2')
-        self.ctx['fig_seg_rgb'] = draw_figure(np.zeros_like(init_rgb), 'Masked image in Training')
-        self.ctx['fig_sam_mask'] = draw_figure(np.zeros_like(init_rgb), 'SAM Mask with Prompts in Training')
-        self.ctx['fig_masked_rgb'] = draw_figure(np.zeros_like(init_rgb), 'Masked RGB')
-        self.ctx['fig_seged_rgb'] = draw_figure(np.zeros_like(init_rgb), 'Seged RGB')
+        # the training and rendering results are shown as downscaled JPEGs
+        blank = np.zeros_like(init_rgb)
         
         app = dash.Dash(
             __name__, meta_tags=[{"name": "viewport", "content": "width=device-width"}]
@@ -183,17 +304,15 @@ class Sam3dGUI:
                         html.Br(),
 
                         html.Button('Start Training', id='btn-nclicks-training', n_clicks=0),
+                        html.Button('Cancel', id='btn-nclicks-cancel', n_clicks=0),
                         html.Div(id='container-button-training', style={'display': 'inline-block'}),
+                        html.Div(id='container-button-cancel'),
+                        html.Div(id='training-status'),
                         ]),
 
                     html.Div(className="ten columns",children=[
-                        html.Div(children=[
-                            dcc.Graph(id='seg_rgb', figure=self.ctx['fig_seg_rgb'])
-                        ], style={'display': 'inline-block', 'width': '40%'}),
-
-                        html.Div(children=[
-                            dcc.Graph(id='sam_mask', figure=self.ctx['fig_sam_mask'])
-                        ], style={'display': 'inline-block', 'width': '40%'}),
+                        image_panel('seg_rgb', 'Masked image in Training', blank),
+                        image_panel('sam_mask', 'SAM Mask with Prompts in Training', blank),
                     ]),
 
                     dcc.Interval(
@@ -208,16 +327,16 @@ class Sam3dGUI:
                     html.Div(className="two columns",style={"padding-bottom": "5%"},children=[
                         html.Div([html.H3(['SA3D Rendering Results'])]),
                         html.Br(),
+
+                        html.H5('Preview View:'),
+                        dcc.Slider(0, self.ctx.get('n_preview_views', 1)-1, 1, value=0, id='preview_view',
+                                   marks=None, tooltip={'placement': 'bottom'}),
+                        html.Div(id='preview-status'),
                         ]),
 
                     html.Div(className="ten columns",children=[
-                        html.Div(children=[
-                            dcc.Graph(id='masked_rgb', figure=self.ctx['fig_masked_rgb'])
-                        ], style={'display': 'inline-block', 'width': '40%'}),
-
-                        html.Div(children=[
-                            dcc.Graph(id='seged_rgb', figure=self.ctx['fig_seged_rgb'])
-                        ], style={'display': 'inline-block', 'width': '40%'}),
+                        image_panel('masked_rgb', 'Masked RGB', blank),
+                        image_panel('seged_rgb', 'Seged RGB', blank),
                     ]),
                 ])
             ])
@@ -248,6 +367,9 @@ class Sam3dGUI:
             '''
             update mask
             '''
+            if self.worker is not None and self.worker.running:
+                # the predictor is used by the training
+                raise PreventUpdate
             if self.ctx['prompt_type'] == 'point':
                 if clickData is None and btn_point == self.ctx['btn_clear']:
                     raise PreventUpdate
@@ -298,49 +420,93 @@ class Sam3dGUI:
                 raise PreventUpdate
             
         @app.callback(
-            Output('seg_rgb', 'figure'),
-            Output('sam_mask', 'figure'),
+            Output('seg_rgb', 'src'),
+            Output('sam_mask', 'src'),
+            Output('training-status', 'children'),
             Input('interval-component', 'n_intervals')
         )
         def displaySeg(n):
-            if self.ctx['show_rgb']:
-                self.ctx['show_rgb'] = False
-                fig_seg_rgb = draw_figure(self.ctx['fig_seg_rgb'], 'Masked image in Training')
-                fig_sam_mask = draw_figure(self.ctx['fig_sam_mask'], 'SAM Mask with Prompts in Training')
-                return fig_seg_rgb, fig_sam_mask
-            else:
+            '''
+            drain the progress of the worker, show the last trained view
+            '''
+            if self.worker is None:
+                raise PreventUpdate
+            events = self.worker.poll()
+            if len(events) == 0:
                 raise PreventUpdate
+            seg_rgb, sam_mask = dash.no_update, dash.no_update
+            for event in events:
+                if event['kind'] == 'step':
+                    ctx['progress'] = f"view {event['idx']}/{event['n_views']}"
+                    seg_rgb = event['seg_rgb']
+                    if event['sam_mask'] is not None:
+                        sam_mask = event['sam_mask']
+                elif event['kind'] == 'status':
+                    ctx['status'] = event['status'] + (f": {event['error']}" if 'error' in event else '')
+                elif event['kind'] == 'videos':
+                    ctx['videos'] = event['videos']
+            return seg_rgb, sam_mask, f"{ctx.get('status', '')} ({ctx.get('progress', '')})"
         
 
+        @app.callback(
+            Output('masked_rgb', 'src'),
+            Output('seged_rgb', 'src'),
+            Output('preview-status', 'children'),
+            Input('interval-component', 'n_intervals'),
+            Input('preview_view', 'value')
+        )
+        def displayPreview(n, view):
+            '''
+            stream the coarse-to-fine previews, then the frames of the full resolution videos
+            '''
+            if ctx.get('videos') is not None:
+                if ctx.get('preview_shown') == (view, 'video'):
+                    raise PreventUpdate
+                ctx['preview_shown'] = (view, 'video')
+                masked_rgb, seged_rgb = [video[min(view, len(video)-1)] for video in ctx['videos']]
+                return masked_rgb, seged_rgb, f'view {view} of the full resolution videos'
+            preview = self.worker.preview if self.worker is not None else None
+            if preview is None:
+                raise PreventUpdate
+            # the shown view is rendered at every level, the renders of the other views are dropped
+            preview.select(view)
+            frames, factor = preview.get(view)
+            if frames is None or ctx.get('preview_shown') == (view, factor):
+                raise PreventUpdate
+            ctx['preview_shown'] = (view, factor)
+            desc = f'view {view} at ' + ('full resolution' if factor == 0 else f'1/{factor} resolution')
+            masked_rgb = encode_image(frames['masked_rgb'])
+            seged_rgb = encode_image(frames['seged_rgb']) if 'seged_rgb' in frames else dash.no_update
+            return masked_rgb, seged_rgb, f'preview: {desc}, rendering the full resolution videos after the previews'
+
         @app.callback(
             Output('container-button-training', 'children'),
-            Output('masked_rgb', 'figure'),
-            Output('seged_rgb', 'figure'),
             Input('btn-nclicks-training', 'n_clicks')
         )
         def start_training(btn):
             if btn < 1:
-                return html.Div("Press to start training"), self.ctx['fig_masked_rgb'], self.ctx['fig_seged_rgb']
-            else:
-                # optim in the first view
-                self.Seg3d.train_step(self.train_idx, sam_mask=ctx['masks'][ctx['select_mask_id']])
-                self.train_idx += 1
+                return html.Div("Press to start training")
+            if self.worker is not None and (self.worker.running or self.worker.status == 'finished'):
+                raise PreventUpdate
+            train_idx = 0
+            if self.worker is not None and self.worker.status == 'cancelled':
+                # resume after the last trained view
+                train_idx = self.worker.train_idx
+            elif 'masks' not in ctx or ctx.get('select_mask_id') is None:
+                return html.Div("Select a mask first")
+            sam_mask = ctx['masks'][ctx['select_mask_id']] if train_idx == 0 else None
+            self.worker = TrainingWorker(self.Seg3d, sam_mask, train_idx=train_idx).start()
+            return html.Div("Training in the background, Cancel stops after the current view")
 
-                # cross-view training
-                while True:
-                    rgb, sam_prompt, is_finished = self.Seg3d.train_step(self.train_idx)
-                    self.train_idx += 1
-                    self.ctx['fig_seg_rgb'] = rgb
-                    self.ctx['fig_sam_mask'] = sam_prompt
-                    self.ctx['show_rgb'] = True
-                    if is_finished:
-                        break
-                self.Seg3d.save_ckpt()
-                masked_rgb, seged_rgb = self.Seg3d.render_test()
-                fig_masked_rgb = draw_figure(masked_rgb, 'Masked RGB', animation_frame=0)
-                fig_seged_rgb = draw_figure(seged_rgb, 'Seged RGB', animation_frame=0)
-
-                return html.Div("Train Stage Finished! Press Ctrl+C to Exit!"), fig_masked_rgb, fig_seged_rgb
+        @app.callback(
+            Output('container-button-cancel', 'children'),
+            Input('btn-nclicks-cancel', 'n_clicks')
+        )
+        def cancel_training(btn):
+            if btn < 1 or self.worker is None or not self.worker.running:
+                raise PreventUpdate
+            self.worker.cancel()
+            return html.Div("Cancelling, press Start Training to resume")
             
         
         app.run_server(debug=self.debug)
@@ -1,22 +1,117 @@
-import os
+import math
 import torch
-from torch.utils.cpp_extension import load
 
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-sources=['cuda/adam_upd.cpp', 'cuda/adam_upd_kernel.cu']
-adam_upd_cuda = load(
-        name='adam_upd_cuda',
-        sources=[os.path.join(parent_dir, path) for path in sources],
-        verbose=True)
+from .cuda_ext import adam_upd_cuda
 
 
 ''' Extend Adam optimizer
 1. support per-voxel learning rate
 2. masked update (ignore zero grad) which speeduping training
+3. multi-tensor update: the cuda parameters sharing an update mode are updated in
+   a single kernel launch; the cpu ones keep the per-tensor update, as
+   torch._foreach_* runs a loop there and measured no faster
+4. sparse state (sparse_state=True): the moments of the masked dense voxel grids
+   are only allocated for the rows (last grid dim) receiving gradient. With
+   sparse_cold_steps > 0, the blocks of the rows without gradient during the
+   last sparse_cold_steps steps are freed (the row restarts from zero moments
+   if hit again), so the state follows the rows the batches keep hitting
+   instead of every row ever hit, e.g. by the dense total variation.
 '''
+def adam_upd_multi_torch(params, grads, exp_avgs, exp_avg_sqs, steps, lrs, beta1, beta2, eps, masked):
+    '''torch._foreach_* counterpart of adam_upd_cuda.adam_upd_multi'''
+    step_sizes = [lr * math.sqrt(1 - beta2**step) / (1 - beta1**step) for step, lr in zip(steps, lrs)]
+    if masked:
+        # zero grad entries keep their moments (x * 1 + 0) and receive no update
+        keep = [grad != 0 for grad in grads]
+        torch._foreach_mul_(exp_avgs, [torch.ones_like(grad).masked_fill_(k, beta1) for k, grad in zip(keep, grads)])
+        torch._foreach_mul_(exp_avg_sqs, [torch.ones_like(grad).masked_fill_(k, beta2) for k, grad in zip(keep, grads)])
+    else:
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+    torch._foreach_add_(exp_avgs, grads, alpha=1-beta1)
+    torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1-beta2)
+    denom = torch._foreach_sqrt(exp_avg_sqs)
+    torch._foreach_add_(denom, eps)
+    upd = torch._foreach_div(exp_avgs, denom)
+    if masked:
+        torch._foreach_mul_(upd, [k.to(u) for k, u in zip(keep, upd)])
+    torch._foreach_mul_(upd, step_sizes)
+    torch._foreach_sub_(params, upd)
+
+
+@torch.no_grad()
+def sparse_adam_upd(param, grad, state, lr, beta1, beta2, eps):
+    '''Masked Adam update of the rows of a dense grid with non-zero grad.
+    The moments live in row blocks allocated on the first non-zero grad of a row
+    (state['block_table'] maps a row to its block, -1 if not allocated yet), and
+    each block counts its own number of updates for the bias correction.
+    state['block_row'] is the row of a block and state['block_last'] the step of
+    its last update, for free_cold_blocks.
+    '''
+    row_len = param.shape[-1]
+    param_rows = param.view(-1, row_len)
+    grad_rows = grad.reshape(-1, row_len)
+    active = grad_rows.ne(0).any(1).nonzero().squeeze(1)
+    if len(active) == 0:
+        return
+
+    # materialize the blocks of the rows touched for the first time
+    table = state['block_table']
+    slots = table[active]
+    new = slots < 0
+    n_new = int(new.sum())
+    if n_new > 0:
+        n_blocks = state['n_blocks']
+        if n_blocks + n_new > len(state['block_step']):
+            capacity = max(n_blocks + n_new, int(len(state['block_step']) * 1.5))
+            for k in ['exp_avg_blocks', 'exp_avg_sq_blocks', 'block_step', 'block_row', 'block_last']:
+                old = state[k]
+                state[k] = old.new_zeros([capacity, *old.shape[1:]])
+                state[k][:n_blocks] = old[:n_blocks]
+        slots[new] = torch.arange(n_blocks, n_blocks+n_new, device=slots.device)
+        table[active[new]] = slots[new]
+        state['block_row'][slots[new]] = active[new]
+        state['n_blocks'] = n_blocks + n_new
+
+    g = grad_rows[active]
+    keep = g != 0
+    exp_avg = state['exp_avg_blocks'][slots]
+    exp_avg_sq = state['exp_avg_sq_blocks'][slots]
+    step = state['block_step'][slots] + 1
+    exp_avg.mul_(torch.ones_like(g).masked_fill_(keep, beta1)).add_(g, alpha=1-beta1)
+    exp_avg_sq.mul_(torch.ones_like(g).masked_fill_(keep, beta2)).addcmul_(g, g, value=1-beta2)
+    step_f = step.double()
+    step_size = lr * torch.sqrt(1 - torch.pow(beta2, step_f)) / (1 - torch.pow(beta1, step_f))
+    upd = step_size.to(g.dtype).unsqueeze(1) * exp_avg / (exp_avg_sq.sqrt() + eps)
+    param_rows.index_add_(0, active, upd.mul_(keep).neg_())
+    state['exp_avg_blocks'].index_copy_(0, slots, exp_avg)
+    state['exp_avg_sq_blocks'].index_copy_(0, slots, exp_avg_sq)
+    state['block_step'].index_copy_(0, slots, step)
+    state['block_last'].index_fill_(0, slots, state['step'])
+
+
+@torch.no_grad()
+def free_cold_blocks(state, cold_steps):
+    '''Free the blocks not updated during the last cold_steps steps and compact the others'''
+    n_blocks = state['n_blocks']
+    live = state['block_last'][:n_blocks] > state['step'] - cold_steps
+    live_slots = live.nonzero().squeeze(1)
+    n_live = len(live_slots)
+    if n_live == n_blocks:
+        return
+    rows = state['block_row'][:n_blocks]
+    state['block_table'][rows[~live]] = -1
+    state['block_table'][rows[live_slots]] = torch.arange(n_live, device=live_slots.device)
+    # the storage shrinks to the live blocks, it grows again on demand
+    for k in ['exp_avg_blocks', 'exp_avg_sq_blocks', 'block_step', 'block_row', 'block_last']:
+        state[k] = state[k][live_slots]
+    state['n_blocks'] = n_live
+
+
 class MaskedAdam(torch.optim.Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8, multi_tensor=True, sparse_state=False,
+                 sparse_cold_steps=0):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -28,18 +123,62 @@ class MaskedAdam(torch.optim.Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps)
         self.per_lr = None
         self.f_per_lr = None
+        self.multi_tensor = multi_tensor
+        self.sparse_state = sparse_state
+        self.sparse_cold_steps = sparse_cold_steps
         super(MaskedAdam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(MaskedAdam, self).__setstate__(state)
 
+    def load_state_dict(self, state_dict):
+        super(MaskedAdam, self).load_state_dict(state_dict)
+        # torch casts the state tensors to the param dtype, the sparse state indices must stay long
+        for state in self.state.values():
+            for k in ['block_table', 'block_step', 'block_row', 'block_last']:
+                if k in state:
+                    state[k] = state[k].long()
+
     def set_pervoxel_lr(self, count):
         assert self.param_groups[0]['params'][0].shape == count.shape
         self.per_lr = count.float() / count.max()
 
 
+    def _get_state(self, param, skip_zero_grad):
+        state = self.state[param]
+        # Lazy state initialization
+        if len(state) == 0 and self.sparse_state and skip_zero_grad and \
+                param.dim() == 5 and self._get_per_lr(param) is None:
+            state['step'] = 0
+            # Row -> block of the moments, blocks are allocated on demand
+            state['block_table'] = torch.full([param.numel() // param.shape[-1]], -1, dtype=torch.long, device=param.device)
+            state['exp_avg_blocks'] = param.new_zeros([0, param.shape[-1]])
+            state['exp_avg_sq_blocks'] = param.new_zeros([0, param.shape[-1]])
+            state['block_step'] = torch.zeros([0], dtype=torch.long, device=param.device)
+            state['block_row'] = torch.zeros([0], dtype=torch.long, device=param.device)
+            state['block_last'] = torch.zeros([0], dtype=torch.long, device=param.device)
+            state['n_blocks'] = 0
+        elif len(state) == 0:
+            state['step'] = 0
+            # Exponential moving average of gradient values
+            state['exp_avg'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+            # Exponential moving average of squared gradient values
+            state['exp_avg_sq'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+        return state
+
+    def _get_per_lr(self, param):
+        if self.per_lr is not None and param.shape == self.per_lr.shape:
+            return self.per_lr
+        if self.f_per_lr is not None and param.shape == self.f_per_lr.shape:
+            return self.f_per_lr
+        return None
+
     @torch.no_grad()
     def step(self):
+        if not self.multi_tensor:
+            return self.step_per_tensor()
+        # bucket the parameters by update mode, the per-tensor lr and step are handled in the kernel
+        buckets = {}
         for group in self.param_groups:
             lr = group['lr']
             beta1, beta2 = group['betas']
@@ -47,31 +186,52 @@ class MaskedAdam(torch.optim.Optimizer):
             skip_zero_grad = group['skip_zero_grad']
             for param in group['params']:
                 if param.grad is not None:
-                    state = self.state[param]
-                    # Lazy state initialization
-                    if len(state) == 0:
-                        state['step'] = 0
-                        # Exponential moving average of gradient values
-                        state['exp_avg'] = torch.zeros_like(param, memory_format=torch.preserve_format)
-                        # Exponential moving average of squared gradient values
-                        state['exp_avg_sq'] = torch.zeros_like(param, memory_format=torch.preserve_format)
-
+                    state = self._get_state(param, skip_zero_grad)
                     state['step'] += 1
+                    if 'block_table' in state or not param.is_cuda or self._get_per_lr(param) is not None:
+                        self._step_param(param, state, lr, beta1, beta2, eps, skip_zero_grad)
+                        continue
+                    key = (skip_zero_grad, beta1, beta2, eps, param.device, param.dtype)
+                    bucket = buckets.setdefault(key, ([], [], [], [], [], []))
+                    for lst, v in zip(bucket, [param, param.grad, state['exp_avg'], state['exp_avg_sq'], state['step'], lr]):
+                        lst.append(v)
+
+        for (masked, beta1, beta2, eps, _, _), bucket in buckets.items():
+            adam_upd_cuda.adam_upd_multi(*bucket, beta1, beta2, eps, masked)
 
-                    if self.per_lr is not None and param.shape == self.per_lr.shape:
-                        adam_upd_cuda.adam_upd_with_perlr(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], self.per_lr,
-                                state['step'], beta1, beta2, lr, eps)
-                    elif self.f_per_lr is not None and param.shape == self.f_per_lr.shape:
-                        adam_upd_cuda.adam_upd_with_perlr(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], self.f_per_lr,
-                                state['step'], beta1, beta2, lr, eps)
-                    elif skip_zero_grad:
-                        adam_upd_cuda.masked_adam_upd(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'],
-                                state['step'], beta1, beta2, lr, eps)
-                    else:
-                        adam_upd_cuda.adam_upd(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'],
-                                state['step'], beta1, beta2, lr, eps)
+    @torch.no_grad()
+    def step_per_tensor(self):
+        '''One kernel launch per parameter'''
+        for group in self.param_groups:
+            lr = group['lr']
+            beta1, beta2 = group['betas']
+            eps = group['eps']
+            skip_zero_grad = group['skip_zero_grad']
+            for param in group['params']:
+                if param.grad is not None:
+                    state = self._get_state(param, skip_zero_grad)
+                    state['step'] += 1
+                    self._step_param(param, state, lr, beta1, beta2, eps, skip_zero_grad)
 
+    def _step_param(self, param, state, lr, beta1, beta2, eps, skip_zero_grad):
+        per_lr = self._get_per_lr(param)
+        if 'block_table' in state:
+            sparse_adam_upd(param, param.grad, state, lr, beta1, beta2, eps)
+            if self.sparse_cold_steps > 0 and state['step'] % self.sparse_cold_steps == 0:
+                free_cold_blocks(state, self.sparse_cold_steps)
+        elif not param.is_cuda and per_lr is None:
+            adam_upd_multi_torch(
+                    [param], [param.grad], [state['exp_avg']], [state['exp_avg_sq']],
+                    [state['step']], [lr], beta1, beta2, eps, skip_zero_grad)
+        elif per_lr is not None:
+            adam_upd_cuda.adam_upd_with_perlr(
+                    param, param.grad, state['exp_avg'], state['exp_avg_sq'], per_lr,
+                    state['step'], beta1, beta2, lr, eps)
+        elif skip_zero_grad:
+            adam_upd_cuda.masked_adam_upd(
+                    param, param.grad, state['exp_avg'], state['exp_avg_sq'],
+                    state['step'], beta1, beta2, lr, eps)
+        else:
+            adam_upd_cuda.adam_upd(
+                    param, param.grad, state['exp_avg'], state['exp_avg_sq'],
+                    state['step'], beta1, beta2, lr, eps)
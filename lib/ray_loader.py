@@ -0,0 +1,94 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+''' Prefetching loader of the training ray batches
+The rgb / rays_o / rays_d / viewdirs of all the training rays are packed into one
+[N, 12] host table in pinned memory. A worker thread gathers the next batches
+into pinned buffers and copies them to the device on a side stream, so the
+gather and the H2D transfer of step k+1 overlap the compute of step k.
+'''
+class RayBatchLoader:
+    def __init__(self, rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, index_sampler, device, n_prefetch=2):
+        '''
+        @rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr: the training rays, [..., 3] each.
+        @index_sampler: returns the flat indices (into the first dims of the rays) of the next batch.
+        '''
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        n_rays = rgb_tr[..., 0].numel()
+        self.table = torch.empty([n_rays, 12], device='cpu', pin_memory=self.use_cuda)
+        for i, tensor in enumerate([rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr]):
+            self.table[:, i*3:(i+1)*3].copy_(tensor.reshape(-1, 3))
+        self.index_sampler = index_sampler
+
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        # queued batches + the one being consumed + the one being gathered
+        self.buffers = [None] * (n_prefetch + 2)
+        self.events = [None] * (n_prefetch + 2)
+        self.batches = queue.Queue(maxsize=n_prefetch)
+        self.wait_time = 0
+        self.stopped = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _gather(self, slot):
+        index = self.index_sampler().cpu()
+        if not self.use_cuda:
+            return torch.index_select(self.table, 0, index).view(-1, 4, 3).transpose(0, 1).contiguous(), None
+        # the previous copy from this buffer must be done before it is overwritten
+        if self.events[slot] is not None:
+            self.events[slot].synchronize()
+        buf = self.buffers[slot]
+        if buf is None or len(buf) != len(index):
+            buf = self.buffers[slot] = torch.empty([len(index), 12], device='cpu', pin_memory=True)
+        torch.index_select(self.table, 0, index, out=buf)
+        with torch.cuda.stream(self.stream):
+            # [4, B, 3] so that each of target / rays_o / rays_d / viewdirs is contiguous
+            batch = buf.to(self.device, non_blocking=True).view(-1, 4, 3).transpose(0, 1).contiguous()
+            event = self.events[slot] = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def _run(self):
+        slot = 0
+        while not self.stopped:
+            try:
+                item = self._gather(slot)
+            except Exception as e:
+                item = e
+            while not self.stopped:
+                try:
+                    self.batches.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
+            slot = (slot + 1) % len(self.buffers)
+
+    def next(self):
+        '''Return the target, rays_o, rays_d and viewdirs of the next batch on the device.'''
+        eps_time = time.time()
+        item = self.batches.get()
+        self.wait_time += time.time() - eps_time
+        if isinstance(item, Exception):
+            raise item
+        batch, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            batch.record_stream(stream)
+        return batch[0], batch[1], batch[2], batch[3]
+
+    def pop_wait_time(self):
+        '''Time next() spent waiting for the worker since the last call.'''
+        wait_time, self.wait_time = self.wait_time, 0
+        return wait_time
+
+    def close(self):
+        self.stopped = True
+        self.worker.join()
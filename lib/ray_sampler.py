@@ -0,0 +1,242 @@
+import torch
+
+
+''' Samplers of the training ray batches (flattened ray tables)
+The batches are slices of a pseudo-random permutation of the rays evaluated on
+the fly: a Feistel network over the next power of 4 maps the position in the
+epoch to a ray index, and the out-of-range outputs are re-encrypted (cycle
+walking) until they fall in [0, N). It is a bijection on [0, N) for any key, so
+no permutation table is kept and the order is reproducible from the seed.
+1. PermutationSampler: uniform over all the rays without replacement per epoch.
+2. StratifiedSampler: each batch draws the same number of rays from every image,
+   each image walking its own permutation.
+3. ImportanceSampler: rays drawn proportionally to a running photometric error
+   (with replacement), the loss being reweighted to stay unbiased.
+'''
+MASK32 = 0xffffffff
+N_ROUNDS = 4
+
+
+def _mix32(x):
+    '''32-bit integer hash of a non-negative int64 tensor < 2**32'''
+    x = ((x ^ (x >> 16)) * 0x45d9f3b) & MASK32
+    x = ((x ^ (x >> 16)) * 0x45d9f3b) & MASK32
+    return x ^ (x >> 16)
+
+
+def derive_key(*ids, device='cpu'):
+    '''Hash the seed / epoch / stream ids (python ints or tensors) into a 32-bit key'''
+    key = torch.zeros([], dtype=torch.long, device=device)
+    for i in ids:
+        key = _mix32(((key ^ (torch.as_tensor(i, device=device) & MASK32)) + 0x9e3779b9) & MASK32)
+    return key
+
+
+def feistel_permute(index, n, key):
+    '''Map index in [0, n) to its image by the permutation of [0, n) defined by key.
+    n and key are python ints or tensors broadcastable to index.
+    '''
+    n = torch.as_tensor(n, device=index.device).expand_as(index)
+    key = torch.as_tensor(key, device=index.device).expand_as(index)
+    # half the number of bits of the smallest power of 4 >= n
+    half = ((n - 1).clamp(min=1).double().log2().floor().long() + 2) // 2
+    mask = (torch.ones_like(half) << half) - 1
+    round_keys = [_mix32(key ^ (r * 0x9e3779b9 & MASK32)) for r in range(N_ROUNDS)]
+
+    def encrypt(x, half, mask, round_keys):
+        left, right = x >> half, x & mask
+        for k in round_keys:
+            left, right = right, left ^ (_mix32(right ^ k) & mask)
+        return (left << half) | right
+
+    out = encrypt(index, half, mask, round_keys)
+    walk = (out >= n).nonzero().squeeze(1)
+    while len(walk):
+        # the domain is < 4n, so a few rounds of walking are enough in expectation
+        y = encrypt(out[walk], half[walk], mask[walk], [k[walk] for k in round_keys])
+        out[walk] = y
+        walk = walk[y >= n[walk]]
+    return out
+
+
+class PermutationSampler:
+    '''Batches of BS ray indices in [0, N), a new permutation every epoch.
+    The tail of an epoch shorter than BS is dropped as in batch_indices_generator.
+    '''
+    def __init__(self, N, BS, seed=0, device='cpu'):
+        assert 0 < BS <= N, f'batch size {BS} larger than the number of rays {N}'
+        self.N = N
+        self.BS = BS
+        self.seed = seed
+        self.device = torch.device(device)
+        self.epoch = 0
+        self.n_batches = 0
+        self.top = 0
+
+    def __call__(self):
+        if self.top + self.BS > self.N:
+            self.epoch += 1
+            self.top = 0
+        pos = torch.arange(self.top, self.top + self.BS, device=self.device)
+        self.top += self.BS
+        self.n_batches += 1
+        key = derive_key(self.seed, self.epoch, device=self.device)
+        return feistel_permute(pos, self.N, key)
+
+
+class StratifiedSampler:
+    '''Batches of BS ray indices into a table of the rays of consecutive images with
+    imsz[i] rays each. Every image contributes BS // n_images rays to each batch; the
+    remaining rays go to a window of images rotating over the batches. The epoch
+    counter is the number of full passes over the N rays.
+    '''
+    def __init__(self, imsz, BS, seed=0, device='cpu'):
+        self.device = torch.device(device)
+        sizes = torch.tensor([int(n) for n in imsz], dtype=torch.long, device='cpu')
+        offsets = torch.cumsum(sizes, 0) - sizes
+        # images without rays (in_maskcache) are never drawn
+        keep = sizes > 0
+        self.image_ids = torch.arange(len(sizes), device='cpu')[keep].to(self.device)
+        self.sizes = sizes[keep].to(self.device)
+        self.offsets = offsets[keep].to(self.device)
+        self.N = int(sizes.sum())
+        self.BS = BS
+        self.seed = seed
+        self.n_images = len(self.sizes)
+        assert 0 < BS <= self.N, f'batch size {BS} larger than the number of rays {self.N}'
+        # number of rays drawn from each image so far
+        self.cursors = torch.zeros_like(self.sizes)
+        self.window = 0
+        self.n_batches = 0
+
+    @property
+    def epoch(self):
+        return self.n_batches * self.BS // self.N
+
+    def __call__(self):
+        base, rest = divmod(self.BS, self.n_images)
+        counts = torch.full([self.n_images], base, dtype=torch.long, device='cpu')
+        counts[(torch.arange(rest, device='cpu') + self.window) % self.n_images] += 1
+        self.window = (self.window + rest) % self.n_images
+        counts = counts.to(self.device)
+
+        img = torch.repeat_interleave(torch.arange(self.n_images, device=self.device), counts, output_size=self.BS)
+        start = torch.cumsum(counts, 0) - counts
+        drawn = self.cursors[img] + torch.arange(self.BS, device=self.device) - start[img]
+        size = self.sizes[img]
+        # each image walks its own permutation, renewed after each pass over the image
+        key = derive_key(self.seed, drawn // size, self.image_ids[img], device=self.device)
+        self.cursors += counts
+        self.n_batches += 1
+        return self.offsets[img] + feistel_permute(drawn % size, size, key)
+
+
+class ImportanceSampler:
+    '''Error-driven sampling of the rays of a flattened table.
+    The table is cut into tiles of `tile` consecutive rays (row segments of an
+    image), each keeping a running average of the error of its sampled rays. Every
+    `rebuild_every` batches the sampling distribution is rebuilt: a tile is drawn
+    with probability (1-uniform_frac) * its share of the total error +
+    uniform_frac * its share of the rays, then a ray uniformly in the tile. The
+    CDF over the tiles is sampled with searchsorted, which is vectorised on device
+    unlike the sequential construction of an alias table. weights(index) gives the
+    1 / (N * p) factors making the mean weighted loss an unbiased estimate of the
+    mean loss over all the rays; the uniform part bounds them by 1 / uniform_frac.
+    '''
+    def __init__(self, N, BS, tile=64, rebuild_every=500, uniform_frac=0.2, decay=0.5, seed=0, device='cpu'):
+        assert 0 < BS <= N, f'batch size {BS} larger than the number of rays {N}'
+        assert 0 < uniform_frac <= 1
+        self.N = N
+        self.BS = BS
+        self.tile = tile
+        self.rebuild_every = rebuild_every
+        self.uniform_frac = uniform_frac
+        self.decay = decay
+        self.device = torch.device(device)
+        self.generator = torch.Generator(self.device)
+        self.generator.manual_seed(seed)
+        n_tiles = (N + tile - 1) // tile
+        self.tile_len = torch.full([n_tiles], tile, dtype=torch.long, device=self.device)
+        self.tile_len[-1] = N - (n_tiles - 1) * tile
+        # running error of the tiles, negative until the first sample
+        self.tile_err = torch.full([n_tiles], -1., device=self.device)
+        self.n_batches = 0
+        self.rebuild()
+
+    @property
+    def epoch(self):
+        return self.n_batches * self.BS // self.N
+
+    @torch.no_grad()
+    def rebuild(self):
+        err = self.tile_err
+        seen = err >= 0
+        # unseen tiles are assumed as bad as the worst seen one
+        err = torch.where(seen, err, err.max()) if seen.any() else torch.ones_like(err)
+        mass = err.clamp(min=1e-8) * self.tile_len
+        prob = (1 - self.uniform_frac) * mass / mass.sum() + self.uniform_frac * self.tile_len / self.N
+        self.cdf = torch.cumsum(prob.double(), 0)
+        self.tile_weight = (self.tile_len / (self.N * prob)).float()
+
+    def __call__(self):
+        if self.n_batches > 0 and self.n_batches % self.rebuild_every == 0:
+            self.rebuild()
+        self.n_batches += 1
+        u = torch.rand([self.BS], device=self.device, generator=self.generator, dtype=torch.float64)
+        tile = torch.searchsorted(self.cdf, u * self.cdf[-1], right=True).clamp_(max=len(self.cdf)-1)
+        offset = torch.rand([self.BS], device=self.device, generator=self.generator) * self.tile_len[tile]
+        return tile * self.tile + offset.long().minimum(self.tile_len[tile]-1)
+
+    def weights(self, index):
+        '''Per-ray loss weights of a batch returned by the last call'''
+        return self.tile_weight[index.to(self.device) // self.tile]
+
+    @torch.no_grad()
+    def update(self, index, err):
+        '''Accumulate the per-ray errors (e.g. the mse of rgb_marched) of a batch'''
+        tile = index.to(self.device) // self.tile
+        err = err.to(self.device, torch.float32)
+        # dense over the tiles, boolean indexing would sync with the host at every step
+        cnt = torch.zeros_like(self.tile_err).index_add_(0, tile, torch.ones_like(err))
+        mean = torch.zeros_like(self.tile_err).index_add_(0, tile, err) / cnt.clamp(min=1)
+        prev = self.tile_err
+        new = torch.where(prev >= 0, prev * self.decay + mean * (1 - self.decay), mean)
+        self.tile_err = torch.where(cnt > 0, new, prev)
+
+
+if __name__ == '__main__':
+    # bijectivity and stratification checks
+    for n in [1, 2, 3, 5, 16, 17, 1000, 4097, 123457]:
+        for key in [0, 1, 12345]:
+            perm = feistel_permute(torch.arange(n), n, derive_key(key))
+            assert torch.equal(perm.sort()[0], torch.arange(n)), f'not a permutation of [0, {n})'
+    sampler = PermutationSampler(1000, 128, seed=777)
+    epoch0 = torch.cat([sampler() for _ in range(7)])
+    assert len(epoch0.unique()) == len(epoch0) and sampler.epoch == 0
+    sampler()
+    assert sampler.epoch == 1
+    assert torch.equal(PermutationSampler(1000, 128, seed=777)(), epoch0[:128]), 'not reproducible'
+
+    imsz = [300, 0, 100, 257]
+    sampler = StratifiedSampler(imsz, 99, seed=777)
+    batches = [sampler() for _ in range(6)]
+    for batch in batches:
+        per_image = torch.bucketize(batch, torch.tensor([300, 300, 400]), right=True).bincount(minlength=4)
+        assert per_image[1] == 0 and per_image.max() - per_image[per_image > 0].min() <= 1, per_image
+    # the first pass over the smallest image draws each of its rays once
+    small = torch.cat(batches)
+    small = small[(small >= 300) & (small < 400)][:100]
+    assert len(small.unique()) == 100
+
+    # the weighted mean of the per-ray errors estimates the mean over all the rays
+    torch.manual_seed(0)
+    ray_err = torch.rand(5000) ** 4
+    sampler = ImportanceSampler(len(ray_err), 256, tile=16, rebuild_every=20, seed=777)
+    estimates = []
+    for i in range(400):
+        index = sampler()
+        estimates.append((ray_err[index] * sampler.weights(index)).mean())
+        sampler.update(index, ray_err[index])
+    estimate = torch.stack(estimates[200:]).mean()
+    assert abs(estimate / ray_err.mean() - 1) < 0.05, (estimate, ray_err.mean())
+    print('ray_sampler: checks passed')
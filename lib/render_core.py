@@ -0,0 +1,639 @@
+import contextlib
+import functools
+from typing import List, Optional
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+from . import grid
+from .cuda_ext import render_utils_cuda
+
+
+''' Field heads
+A field head is a per-sample quantity that is alpha-composited along the rays.
+The renderer queries all the requested heads on the surviving samples and
+marches them together, so adding a head costs channels instead of a pass.
+'''
+class FieldHead:
+    def __init__(self, name, query, detach=False):
+        '''
+        @name:   key of the marched result in the returned dict.
+        @query:  fn(model, samples, viewdirs) -> [M] or [M, C] per-sample values.
+                 [M] heads are marched into [N], [M, C] heads into [N, C].
+        @detach: composite with detached weights (the head never back-propagates
+                 into the geometry, e.g. depth).
+        '''
+        self.name = name
+        self.query = query
+        self.detach = detach
+
+    def __repr__(self):
+        return f'FieldHead({self.name})'
+
+
+def _query_rgb(model, samples, viewdirs):
+    return model.query_rgb(samples['ray_pts'], samples['ray_id'], viewdirs)
+
+def _mask_grid_grad_enabled(model):
+    # only the mask volume is optimized in the segmentation stage
+    return torch.is_grad_enabled() or model.seg_mask_grid.grid.requires_grad
+
+def _query_seg_mask(model, samples, viewdirs):
+    with torch.set_grad_enabled(_mask_grid_grad_enabled(model)):
+        return model.seg_mask_grid(samples['ray_pts']).reshape(len(samples['ray_pts']), model.seg_mask_grid.channels)
+
+def _query_dual_seg_mask(model, samples, viewdirs):
+    with torch.set_grad_enabled(_mask_grid_grad_enabled(model)):
+        return model.dual_seg_mask_grid(samples['ray_pts']).reshape(len(samples['ray_pts']), model.dual_seg_mask_grid.channels)
+
+rgb_head = FieldHead('rgb_marched', _query_rgb)
+seg_mask_head = FieldHead('seg_mask_marched', _query_seg_mask)
+dual_seg_mask_head = FieldHead('dual_seg_mask_marched', _query_dual_seg_mask)
+step_depth_head = FieldHead('depth', lambda model, samples, viewdirs: samples['step_id'], detach=True)
+
+
+def march_heads(vals, detach, weights, ray_id, N):
+    '''Alpha-composite all the field heads along the rays at once.
+    The per-sample values of every head are concatenated into one [M, C_total]
+    source and reduced by a single SegmentMarch pass over weights/ray_id.
+    @vals:    list of [M] or [M, C] per-sample values, one per head.
+    @detach:  list of bool, composite the head with detached weights.
+    Return a list of [N] or [N, C] marched tensors in the order of vals.
+    '''
+    if len(vals) == 0:
+        return []
+    marched = SegmentMarch.apply(weights, ray_id, N, tuple(not det for det in detach), *vals)
+    marched = marched.split([1 if val.dim() == 1 else val.shape[-1] for val in vals], -1)
+    return [m.squeeze(-1) if val.dim() == 1 else m for m, val in zip(marched, vals)]
+
+
+def rgbnet_split_forward(feat: Optional[torch.Tensor], viewdirs_emb: torch.Tensor, ray_id: torch.Tensor,
+                         weights: List[torch.Tensor], biases: List[torch.Tensor]) -> torch.Tensor:
+    '''Colors MLP with the first linear layer split into a per-ray term and a per-sample term.
+    Equivalent to the Linear/ReLU stack applied on cat([feat, viewdirs_emb[ray_id]], -1):
+    the view direction embedding goes through the first layer once per ray and only
+    its output is gathered per sample.
+    @feat:         [M, C] per-sample voxel features, None for the full implicit mlp.
+    @viewdirs_emb: [N, D] per-ray view direction embedding.
+    @weights/biases: the parameters of the linear layers of the mlp.
+    '''
+    n_feat = weights[0].shape[1] - viewdirs_emb.shape[1]
+    h = F.linear(viewdirs_emb, weights[0][:, n_feat:], biases[0])
+    if feat is None:
+        # nothing is per-sample, run the whole mlp per ray
+        for i in range(1, len(weights)):
+            h = F.linear(torch.relu_(h), weights[i], biases[i])
+        return h.index_select(0, ray_id)
+    h = torch.addmm(h.index_select(0, ray_id), feat, weights[0][:, :n_feat].t())
+    for i in range(1, len(weights)):
+        h = F.linear(torch.relu_(h), weights[i], biases[i])
+    return h
+
+@functools.lru_cache(maxsize=None)
+def rgbnet_split_forward_jit():
+    '''TorchScript version of rgbnet_split_forward, compiled on first use.'''
+    return torch.jit.script(rgbnet_split_forward)
+
+
+def filter_samples(samples, mask):
+    '''Keep the masked entries of all the per-sample tensors together.'''
+    return {k: v[mask] for k, v in samples.items()}
+
+
+''' Shared voxel-grid renderer
+Subclasses build `density`, `k0`, `rgbnet` and `mask_cache`, set `_log_prefix`
+and provide the sampler `sample_points`; the forward pass, color query and the
+grid maintenance below are shared by the bounded/NDC (dvgo) and the contracted
+unbounded (dcvgo) models.
+'''
+class VoxelRenderer(nn.Module):
+    _log_prefix = 'dvgo'
+
+    def _set_fast_color_thres(self, fast_color_thres):
+        if isinstance(fast_color_thres, dict):
+            self._fast_color_thres = fast_color_thres
+            self.fast_color_thres = fast_color_thres[0]
+        else:
+            self._fast_color_thres = None
+            self.fast_color_thres = fast_color_thres
+
+    def _set_grid_resolution(self, num_voxels):
+        # Determine grid resolution
+        self.num_voxels = num_voxels
+        self.voxel_size = ((self.xyz_max - self.xyz_min).prod() / num_voxels).pow(1/3)
+        self.world_size = ((self.xyz_max - self.xyz_min) / self.voxel_size).long()
+        self.world_len = self.world_size[0].item()
+        self.voxel_size_ratio = self.voxel_size / self.voxel_size_base
+
+        print(f'{self._log_prefix}: voxel_size      ', self.voxel_size)
+        print(f'{self._log_prefix}: world_size      ', self.world_size)
+        print(f'{self._log_prefix}: voxel_size_base ', self.voxel_size_base)
+        print(f'{self._log_prefix}: voxel_size_ratio', self.voxel_size_ratio)
+
+    def _init_color(self, k0_type, k0_config, rgbnet_dim, rgbnet_direct, rgbnet_full_implicit,
+                    rgbnet_depth, rgbnet_width, viewbase_pe, rgbnet_jit=False):
+        self.k0_type = k0_type
+        self.k0_config = k0_config
+        self.rgbnet_direct = rgbnet_direct
+        self.rgbnet_full_implicit = rgbnet_full_implicit
+        self.rgbnet_jit = rgbnet_jit
+
+        if rgbnet_dim <= 0:
+            # color voxel grid  (coarse stage)
+            self.k0_dim = 3
+            self.k0 = grid.create_grid(
+                k0_type, channels=self.k0_dim, world_size=self.world_size,
+                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                config=self.k0_config)
+            self.rgbnet = None
+        else:
+            # feature voxel grid + shallow MLP  (fine stage)
+            if self.rgbnet_full_implicit:
+                self.k0_dim = 0
+            else:
+                self.k0_dim = rgbnet_dim
+            self.k0 = grid.create_grid(
+                    k0_type, channels=self.k0_dim, world_size=self.world_size,
+                    xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                    config=self.k0_config)
+            self.register_buffer('viewfreq', torch.FloatTensor([(2**i) for i in range(viewbase_pe)]))
+            dim0 = (3+3*viewbase_pe*2)
+            if self.rgbnet_full_implicit:
+                pass
+            elif rgbnet_direct:
+                dim0 += self.k0_dim
+            else:
+                dim0 += self.k0_dim-3
+            self.rgbnet = nn.Sequential(
+                nn.Linear(dim0, rgbnet_width), nn.ReLU(inplace=True),
+                *[
+                    nn.Sequential(nn.Linear(rgbnet_width, rgbnet_width), nn.ReLU(inplace=True))
+                    for _ in range(rgbnet_depth-2)
+                ],
+                nn.Linear(rgbnet_width, 3),
+            )
+            nn.init.constant_(self.rgbnet[-1].bias, 0)
+            print(f'{self._log_prefix}: feature voxel grid', self.k0)
+            print(f'{self._log_prefix}: mlp', self.rgbnet)
+
+    @torch.no_grad()
+    def scale_volume_grid(self, num_voxels):
+        print(f'{self._log_prefix}: scale_volume_grid start')
+        ori_world_size = self.world_size
+        self._set_grid_resolution(num_voxels)
+        print(f'{self._log_prefix}: scale_volume_grid scale world_size from', ori_world_size.tolist(), 'to', self.world_size.tolist())
+
+        self.density.scale_volume_grid(self.world_size)
+        self.k0.scale_volume_grid(self.world_size)
+
+        if np.prod(self.world_size.tolist()) <= 256**3:
+            self_grid_xyz = torch.stack(torch.meshgrid(
+                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
+                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
+                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
+            ), -1)
+            self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
+            self.mask_cache = grid.MaskGrid(
+                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    xyz_min=self.xyz_min, xyz_max=self.xyz_max)
+
+        print(f'{self._log_prefix}: scale_volume_grid finish')
+
+    @torch.no_grad()
+    def update_occupancy_cache(self):
+        ori_p = self.mask_cache.mask.float().mean().item()
+        cache_grid_xyz = torch.stack(torch.meshgrid(
+            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
+            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
+            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
+        ), -1)
+        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        cache_grid_alpha = self.activate_density(cache_grid_density)
+        cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
+        self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
+        new_p = self.mask_cache.mask.float().mean().item()
+        print(f'{self._log_prefix}: update mask_cache {ori_p:.4f} => {new_p:.4f}')
+
+    def density_total_variation_add_grad(self, weight, dense_mode):
+        w = weight * self.world_size.max() / 128
+        self.density.total_variation_add_grad(w, w, w, dense_mode)
+
+    def k0_total_variation_add_grad(self, weight, dense_mode):
+        w = weight * self.world_size.max() / 128
+        self.k0.total_variation_add_grad(w, w, w, dense_mode)
+
+    def activate_density(self, density, interval=None):
+        interval = interval if interval is not None else self.voxel_size_ratio
+        shape = density.shape
+        return Raw2Alpha.apply(density.flatten(), self.act_shift, interval).reshape(shape)
+
+    def query_rgb(self, ray_pts, ray_id, viewdirs):
+        '''Query the emitted color of the sampled points.'''
+        if self.rgbnet_full_implicit:
+            k0 = None
+        else:
+            k0 = self.k0(ray_pts)
+
+        if self.rgbnet is None:
+            # no view-depend effect
+            return torch.sigmoid(k0)
+
+        # view-dependent color emission
+        viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
+        viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
+        viewdirs_emb = viewdirs_emb.flatten(0,-2)
+        if k0 is None:
+            feat = None
+        elif self.rgbnet_direct:
+            feat = k0
+        else:
+            feat = k0[:, 3:]
+        linears = [m for m in self.rgbnet.modules() if isinstance(m, nn.Linear)]
+        rgbnet_fn = rgbnet_split_forward_jit() if self.rgbnet_jit else rgbnet_split_forward
+        rgb_logit = rgbnet_fn(
+                feat, viewdirs_emb, ray_id,
+                [m.weight for m in linears], [m.bias for m in linears])
+        if feat is not None and not self.rgbnet_direct:
+            rgb_logit = rgb_logit + k0[:, :3]
+        return torch.sigmoid(rgb_logit)
+
+    def sample_points(self, rays_o, rays_d, **render_kwargs):
+        '''Sampler interface.
+        Return a dict of per-sample tensors holding at least `ray_pts`, `ray_id`
+        and `step_id`, plus a dict of per-batch outputs for the returned dict.
+        The generated and in-bbox samples go to the optional `stats`.
+        '''
+        raise NotImplementedError
+
+    def field_heads(self, render_kwargs):
+        '''The field heads marched by forward.'''
+        heads = [rgb_head]
+        if render_kwargs.get('render_depth', False):
+            heads.append(self.depth_head)
+        return heads
+
+    def forward(self, rays_o, rays_d, viewdirs, global_step=None, render_fct=0.0, **render_kwargs):
+        return self.render(
+                rays_o, rays_d, viewdirs, self.field_heads(render_kwargs),
+                global_step=global_step, render_fct=render_fct, **render_kwargs)
+
+    def render(self, rays_o, rays_d, viewdirs, heads, global_step=None, is_train=False, render_fct=0.0, stats=None, **render_kwargs):
+        '''Volume rendering
+        @rays_o:   [N, 3] the starting point of the N shooting rays.
+        @rays_d:   [N, 3] the shooting direction of the N rays.
+        @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
+        @heads:    the FieldHeads to march along the rays.
+        @stats:    optional RenderStats getting the samples surviving the pruning stages.
+        '''
+        assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
+        if isinstance(self._fast_color_thres, dict) and global_step in self._fast_color_thres:
+            print(f'{self._log_prefix}: update fast_color_thres {self.fast_color_thres} => {self._fast_color_thres[global_step]}')
+            self.fast_color_thres = self._fast_color_thres[global_step]
+
+        N = len(rays_o)
+
+        # sample points on rays
+        samples, ret_dict = self.sample_points(
+                rays_o=rays_o, rays_d=rays_d, global_step=global_step, stats=stats, **render_kwargs)
+        interval = render_kwargs['stepsize'] * self.voxel_size_ratio
+
+        # skip known free space
+        if self.mask_cache is not None:
+            samples = filter_samples(samples, self.mask_cache(samples['ray_pts']))
+        if stats is not None:
+            stats.add('mask_cache', samples['ray_id'], N)
+
+        render_fct = max(render_fct, self.fast_color_thres)
+
+        # query for alpha w/ post-activation
+        samples['density'] = self.density(samples['ray_pts'])
+        samples['alpha'] = self.activate_density(samples['density'], interval)
+        if render_fct > 0:
+            samples = filter_samples(samples, samples['alpha'] > render_fct)
+        if stats is not None:
+            stats.add('alpha', samples['ray_id'], N)
+
+        # compute accumulated transmittance
+        weights, alphainv_last = Alphas2Weights.apply(samples['alpha'], samples['ray_id'], N)
+        samples['weights'] = weights
+        if render_fct > 0:
+            samples = filter_samples(samples, samples['weights'] > render_fct)
+        if stats is not None:
+            stats.add('weights', samples['ray_id'], N)
+
+        # query the field heads and march them in a single pass
+        vals = [head.query(self, samples, viewdirs) for head in heads]
+        with torch.set_grad_enabled(torch.is_grad_enabled() or any(val.requires_grad for val in vals)):
+            marched = march_heads(
+                    vals, [head.detach for head in heads], samples['weights'], samples['ray_id'], N)
+        for head, val, m in zip(heads, vals, marched):
+            ret_dict[head.name] = m
+            if head is rgb_head:
+                ret_dict['raw_rgb'] = val
+
+        if 'rgb_marched' in ret_dict:
+            if render_kwargs.get('rand_bkgd', False) and is_train:
+                bg = torch.rand_like(ret_dict['rgb_marched'])
+            else:
+                bg = render_kwargs['bg']
+            ret_dict['rgb_marched'] = ret_dict['rgb_marched'] + alphainv_last.unsqueeze(-1) * bg
+
+        # the surviving per-sample tensors are returned under their own names
+        ret_dict.update(samples)
+        ret_dict.update({
+            'alphainv_last': alphainv_last,
+            'raw_density': samples['density'],
+            'raw_alpha': samples['alpha'],
+        })
+        return ret_dict
+
+
+''' Segmentation fields
+Mixin adding the (dual) segmentation mask grids to a VoxelRenderer. The mask
+grids are marched with the color by the same pass; only the mask volume is
+optimized in the segmentation stage.
+'''
+class SegFieldsMixin:
+    def _init_seg_grids(self, num_objects):
+        # The segmentation mode is initialized to coarse
+        self.mode = 'coarse'
+        self.num_objects = num_objects
+        self.seg_mask_grid = grid.create_grid(
+                self.density_type, channels=self.num_objects, world_size=self.world_size,
+                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                config=self.density_config)
+        self.mask_view_counts = torch.zeros_like(self.seg_mask_grid.grid, requires_grad=False)
+
+        self.dual_seg_mask_grid = grid.create_grid(
+                self.density_type, channels=self.num_objects, world_size=self.world_size,
+                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                config=self.density_config)
+
+    @torch.no_grad()
+    def change_num_objects(self, num_obj):
+        self.num_objects = num_obj
+        device = self.seg_mask_grid.grid.device
+        self.seg_mask_grid = grid.create_grid(
+                'DenseGrid', channels=self.num_objects, world_size=self.world_size,
+                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                config=self.density_config)
+        self.dual_seg_mask_grid = grid.create_grid(
+                'DenseGrid', channels=self.num_objects, world_size=self.world_size,
+                xyz_min=self.xyz_min, xyz_max=self.xyz_max,
+                config=self.density_config)
+        self.seg_mask_grid.to(device)
+        self.dual_seg_mask_grid.to(device)
+        print("Reset the seg_mask_grid with num_objects =", num_obj)
+
+    @torch.no_grad()
+    def segmentation_to_density(self):
+        assert self.seg_mask_grid.grid.shape[1] == 1 and "multi-object seg label cannot be applied directly to the density grid"
+        mask_grid = torch.zeros_like(self.seg_mask_grid.grid)
+        mask_grid[self.seg_mask_grid.grid > 0] = 1
+
+        self.density.grid *= mask_grid
+        self.density.grid[self.density.grid == 0] = -1e7
+
+    @contextlib.contextmanager
+    def segmented_density(self):
+        '''Apply segmentation_to_density temporarily, e.g. for previews.'''
+        density = self.density.grid.data.clone()
+        self.segmentation_to_density()
+        try:
+            yield self
+        finally:
+            self.density.grid.data.copy_(density)
+
+    @torch.no_grad()
+    def segmentation_only(self):
+        assert self.seg_mask_grid.grid.shape[1] == 1 and "multi-object seg label cannot be applied directly to the density grid"
+        pass
+
+    @torch.no_grad()
+    def change_to_fine_mode(self):
+        self.mode = 'fine'
+
+    @torch.no_grad()
+    def scale_volume_grid(self, num_voxels):
+        super().scale_volume_grid(num_voxels)
+        self.seg_mask_grid.scale_volume_grid(self.world_size)
+        self.dual_seg_mask_grid.scale_volume_grid(self.world_size)
+
+    def field_heads(self, render_kwargs):
+        heads = super().field_heads(render_kwargs) + [seg_mask_head]
+        if self.mode == 'fine':
+            heads.append(dual_seg_mask_head)
+        return heads
+
+    @torch.no_grad()
+    def forward(self, rays_o, rays_d, viewdirs, global_step=None, distill_active=False, render_fct=0.0, **render_kwargs):
+        ret_dict = self.render(
+                rays_o, rays_d, viewdirs, self.field_heads(render_kwargs),
+                global_step=global_step, render_fct=render_fct, **render_kwargs)
+        ret_dict.setdefault('dual_seg_mask_marched', None)
+        return ret_dict
+
+    @torch.no_grad()
+    def forward_mask(self, rays_o, rays_d, render_fct=0.0, **render_kwargs):
+        '''Render the segmentation mask only'''
+        ret_dict = self.render(
+                rays_o, rays_d, None, [seg_mask_head], render_fct=render_fct, **render_kwargs)
+        return {'seg_mask_marched': ret_dict['seg_mask_marched']}
+
+
+''' Misc
+The custom autograd functions always run in fp32 (inputs are cast under
+autocast): the alpha activation, the transmittance accumulation and the
+marching keep full precision in the mixed-precision training.
+'''
+class Raw2Alpha(torch.autograd.Function):
+    @staticmethod
+    @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, density, shift, interval):
+        '''
+        alpha = 1 - exp(-softplus(density + shift) * interval)
+              = 1 - exp(-log(1 + exp(density + shift)) * interval)
+              = 1 - exp(log(1 + exp(density + shift)) ^ (-interval))
+              = 1 - (1 + exp(density + shift)) ^ (-interval)
+        '''
+        if density.is_cuda:
+            exp, alpha = render_utils_cuda.raw2alpha(density, shift, interval)
+        else:
+            exp = torch.exp(density + shift)
+            alpha = 1 - (1 + exp).pow(-interval)
+        if density.requires_grad:
+            ctx.save_for_backward(exp)
+            ctx.interval = interval
+        return alpha
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_back):
+        '''
+        alpha' = interval * ((1 + exp(density + shift)) ^ (-interval-1)) * exp(density + shift)'
+               = interval * ((1 + exp(density + shift)) ^ (-interval-1)) * exp(density + shift)
+        '''
+        exp = ctx.saved_tensors[0]
+        interval = ctx.interval
+        if not exp.is_cuda:
+            return exp.clamp(max=1e10) * (1 + exp).pow(-interval - 1) * interval * grad_back, None, None
+        return render_utils_cuda.raw2alpha_backward(exp, grad_back.contiguous(), interval), None, None
+
+class Raw2Alpha_nonuni(torch.autograd.Function):
+    @staticmethod
+    @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, density, shift, interval):
+        if density.is_cuda:
+            exp, alpha = render_utils_cuda.raw2alpha_nonuni(density, shift, interval)
+        else:
+            exp = torch.exp(density + shift)
+            alpha = 1 - (1 + exp).pow(-interval)
+        if density.requires_grad:
+            ctx.save_for_backward(exp)
+            ctx.interval = interval
+        return alpha
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_back):
+        exp = ctx.saved_tensors[0]
+        interval = ctx.interval
+        if not exp.is_cuda:
+            return exp.clamp(max=1e10) * (1 + exp).pow(-interval - 1) * interval * grad_back, None, None
+        return render_utils_cuda.raw2alpha_nonuni_backward(exp, grad_back.contiguous(), interval), None, None
+
+class SegmentMarch(torch.autograd.Function):
+    @staticmethod
+    @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, weights, ray_id, N, wgrad, *vals):
+        '''
+        out[r] = sum_{i: ray_id[i]==r} weights[i] * cat(vals)[i]
+        @wgrad: per val, whether its channels back-propagate into weights.
+        Gradients are only computed for the vals (and channels) requiring them,
+        e.g. only the mask channels in the segmentation stage.
+        '''
+        src = torch.cat([(val.flatten(1) if val.dim() > 1 else val.unsqueeze(-1)).to(weights.dtype) for val in vals], -1).contiguous()
+        if weights.is_cuda:
+            out = render_utils_cuda.segment_march(weights.contiguous(), src, ray_id, N)
+        else:
+            out = torch.zeros([N, src.shape[-1]], dtype=src.dtype, device=src.device)
+            out.index_add_(0, ray_id, weights.unsqueeze(-1) * src)
+        if any(ctx.needs_input_grad):
+            ctx.save_for_backward(weights, ray_id, src)
+            ctx.wgrad = wgrad
+            ctx.val_meta = [(val.shape, val.dtype) for val in vals]
+        return out
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_out):
+        weights, ray_id, src = ctx.saved_tensors
+        need_w = ctx.needs_input_grad[0]
+        need_vals = ctx.needs_input_grad[4:]
+        widths = [shape[1] if len(shape) > 1 else 1 for shape, _ in ctx.val_meta]
+        wgrad_mask = torch.tensor(
+                sum([[need_w and wg] * c for wg, c in zip(ctx.wgrad, widths)], []),
+                dtype=torch.bool, device=src.device)
+        sgrad_mask = torch.tensor(
+                sum([[need] * c for need, c in zip(need_vals, widths)], []),
+                dtype=torch.bool, device=src.device)
+        grad_out = grad_out.contiguous()
+        if weights.is_cuda:
+            grad_w, grad_src = render_utils_cuda.segment_march_backward(
+                    weights.contiguous(), src, ray_id, grad_out, wgrad_mask, sgrad_mask)
+            grad_src = grad_src.split(widths, -1)
+        else:
+            # only gather the rows of the channels requiring gradients
+            grad_w = None
+            if wgrad_mask.any():
+                grad_w = (src[:, wgrad_mask] * grad_out[:, wgrad_mask][ray_id]).sum(-1)
+            grad_out = grad_out.split(widths, -1)
+            grad_src = [
+                weights.unsqueeze(-1) * g[ray_id] if need else None
+                for g, need in zip(grad_out, need_vals)]
+        grad_vals = [
+            grad.reshape(shape).to(dtype) if need else None
+            for grad, need, (shape, dtype) in zip(grad_src, need_vals, ctx.val_meta)]
+        return (grad_w if need_w else None), None, None, None, *grad_vals
+
+class Alphas2Weights(torch.autograd.Function):
+    @staticmethod
+    @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, alpha, ray_id, N):
+        if alpha.is_cuda:
+            weights, T, alphainv_last, i_start, i_end = render_utils_cuda.alpha2weight(alpha, ray_id, N)
+        else:
+            weights, T, alphainv_last, i_start, i_end = alpha2weight_torch(alpha, ray_id, N)
+        if alpha.requires_grad:
+            ctx.save_for_backward(alpha, weights, T, alphainv_last, i_start, i_end, ray_id)
+            ctx.n_rays = N
+        return weights, alphainv_last
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_weights, grad_last):
+        alpha, weights, T, alphainv_last, i_start, i_end, ray_id = ctx.saved_tensors
+        if not alpha.is_cuda:
+            grad = alpha2weight_backward_torch(
+                    alpha, weights, T, alphainv_last, i_start, i_end, ray_id, grad_weights, grad_last)
+            return grad, None, None
+        grad = render_utils_cuda.alpha2weight_backward(
+                alpha, weights, T, alphainv_last,
+                i_start, i_end, ctx.n_rays, grad_weights, grad_last)
+        return grad, None, None
+
+
+''' torch counterparts of the ray marching kernels (non-cuda tensors)
+'''
+def _segment_cumsum(x, ray_id, n_rays):
+    '''Inclusive cumsum of x within the segments of the sorted ray_id (float64).'''
+    x = x.double()
+    cum = torch.cumsum(x, 0)
+    seg_start = torch.zeros([n_rays], dtype=torch.long, device=x.device).scatter_reduce_(
+            0, ray_id, torch.arange(len(x), device=x.device), reduce='amin', include_self=False)
+    return cum - (cum - x)[seg_start][ray_id]
+
+
+def alpha2weight_torch(alpha, ray_id, N):
+    '''render_utils_cuda.alpha2weight, i_start/i_end being the segment of the
+    processed samples (the marching of a ray stops once its transmittance < 1e-3).
+    '''
+    n_pts = len(alpha)
+    i_start = torch.zeros([N], dtype=torch.long, device=alpha.device)
+    i_end = torch.zeros([N], dtype=torch.long, device=alpha.device)
+    if n_pts == 0:
+        return torch.zeros_like(alpha), torch.ones_like(alpha), torch.ones([N], dtype=alpha.dtype, device=alpha.device), i_start, i_end
+    log_1m = torch.log((1 - alpha.double()).clamp(min=1e-30))
+    log_T_incl = _segment_cumsum(log_1m, ray_id, N)
+    T_excl = torch.exp(log_T_incl - log_1m)
+    processed = T_excl >= 1e-3
+    T = torch.where(processed, T_excl, torch.ones_like(T_excl)).to(alpha.dtype)
+    weights = (T_excl * alpha * processed).to(alpha.dtype)
+    alphainv_last = torch.exp(torch.zeros([N], dtype=torch.float64, device=alpha.device).index_add_(
+            0, ray_id, log_1m * processed)).to(alpha.dtype)
+    index = torch.arange(n_pts, device=alpha.device)
+    i_start.scatter_reduce_(0, ray_id, index, reduce='amin', include_self=False)
+    i_end.scatter_reduce_(0, ray_id, torch.where(processed, index + 1, index[:1]), reduce='amax', include_self=False)
+    i_end = torch.maximum(i_end, i_start)
+    return weights, T, alphainv_last, i_start, i_end
+
+
+def alpha2weight_backward_torch(alpha, weights, T, alphainv_last, i_start, i_end, ray_id, grad_weights, grad_last):
+    '''render_utils_cuda.alpha2weight_backward'''
+    processed = torch.arange(len(alpha), device=alpha.device) < i_end[ray_id]
+    gw = grad_weights * weights * processed
+    N = len(i_start)
+    total = torch.zeros([N], dtype=torch.float64, device=alpha.device).index_add_(0, ray_id, gw.double())
+    # grad_last * alphainv_last + the sum of gw over the processed samples after i
+    back = (grad_last * alphainv_last).double()[ray_id] + total[ray_id] - _segment_cumsum(gw, ray_id, N)
+    grad = grad_weights * T - back.to(alpha.dtype) / (1 - alpha + 1e-10)
+    return grad * processed
+
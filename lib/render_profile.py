@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import contextlib
+
+import numpy as np
+import torch
+
+from .render_utils import render_image
+from .render_stats import RenderStats
+
+
+''' Render profiles
+The stepsize and fast_color_thres trade the render speed against the quality.
+tune_render_settings renders a few held-out views at candidate (stepsize,
+fast_color_thres) pairs, scores them against a reference rendered with a finer
+stepsize and no pruning (psnr of the rgb, IoU of the masks when the model holds
+a segmentation), times them, and keeps the fastest setting of the Pareto front
+meeting the quality targets. The setting depends on the grids, so it is written
+as the render profile of the checkpoint it was tuned on
+(<basedir>/<expname>/render_profile_<ckpt name>.json) along with the mtime of
+the checkpoint, and render_fn only applies it while the checkpoint is unchanged.
+'''
+def profile_path(cfg, ckpt_name):
+    return os.path.join(cfg.basedir, cfg.expname, f'render_profile_{ckpt_name}.json')
+
+
+def load_render_profile(cfg, ckpt_name):
+    '''The render profile of the checkpoint, None if not tuned or tuned on a former version'''
+    path = profile_path(cfg, ckpt_name)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    if not os.path.isfile(profile['ckpt']) or os.path.getmtime(profile['ckpt']) != profile['ckpt_mtime']:
+        print(f'render_profile: {profile["ckpt"]} changed since the tuning, ignoring {path}')
+        return None
+    return profile
+
+
+def write_render_profile(cfg, ckpt_path, profile):
+    path = profile_path(cfg, os.path.splitext(os.path.basename(ckpt_path))[0])
+    profile = {**profile, 'ckpt': ckpt_path, 'ckpt_mtime': os.path.getmtime(ckpt_path)}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    return path
+
+
+@contextlib.contextmanager
+def model_fast_color_thres(model, fast_color_thres):
+    '''Set the fast_color_thres of the model within the block'''
+    model_fct = model.fast_color_thres
+    model.fast_color_thres = fast_color_thres
+    try:
+        yield model
+    finally:
+        model.fast_color_thres = model_fct
+
+
+@contextlib.contextmanager
+def apply_render_profile(profile, model, render_kwargs):
+    '''Within the block the model uses the profile fast_color_thres, yield the
+    render_kwargs with the profile stepsize (unchanged if profile is None)'''
+    if profile is None:
+        yield render_kwargs
+        return
+    with model_fast_color_thres(model, profile['fast_color_thres']):
+        yield {**render_kwargs, 'stepsize': profile['stepsize']}
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def render_views(model, views, ndc, render_kwargs, cfg, stepsize, fast_color_thres):
+    '''Render the rgb (and mask) of the views (c2w, H, W, K) with a setting.
+    Return the frames, the time and the RenderStats of the renders.
+    '''
+    keys = ['rgb_marched', 'seg_mask_marched']
+    render_kwargs = {**render_kwargs, 'stepsize': stepsize}
+    stats = RenderStats()
+    frames = []
+    with model_fast_color_thres(model, fast_color_thres):
+        _sync()
+        eps_time = time.time()
+        for c2w, H, W, K in views:
+            frames.append(render_image(model, c2w, H, W, K, ndc, render_kwargs, cfg, keys, stats=stats))
+        _sync()
+        eps_time = time.time() - eps_time
+    return frames, eps_time, stats
+
+
+def _score(frames, ref_frames):
+    mse = np.mean([torch.mean(torch.square(f['rgb_marched'] - r['rgb_marched'])).item()
+                   for f, r in zip(frames, ref_frames)])
+    psnr = float(-10. * np.log10(max(mse, 1e-20)))
+    inter, union = 0, 0
+    for f, r in zip(frames, ref_frames):
+        if 'seg_mask_marched' not in r:
+            continue
+        mask, ref_mask = f['seg_mask_marched'] > 0, r['seg_mask_marched'] > 0
+        inter += (mask & ref_mask).sum().item()
+        union += (mask | ref_mask).sum().item()
+    # no mask to compare to without a segmentation
+    iou = inter / union if union else None
+    return psnr, iou
+
+
+def pareto_front(results):
+    '''The results not dominated in (rays_per_sec, psnr, iou)'''
+    def key(res):
+        return (res['rays_per_sec'], res['psnr'], res['iou'] if res['iou'] is not None else 0)
+    front = []
+    for res in results:
+        k = key(res)
+        dominated = any(
+            all(a >= b for a, b in zip(key(other), k)) and key(other) != k
+            for other in results)
+        if not dominated:
+            front.append(res)
+    return front
+
+
+def select_setting(results, min_psnr, min_iou):
+    '''The fastest setting of the Pareto front meeting the quality targets, else the best psnr'''
+    front = pareto_front(results)
+    ok = [res for res in front
+          if res['psnr'] >= min_psnr and (res['iou'] is None or res['iou'] >= min_iou)]
+    if len(ok):
+        return max(ok, key=lambda res: res['rays_per_sec']), front
+    print('render_profile: no setting meets the targets, keeping the best psnr')
+    return max(front, key=lambda res: res['psnr']), front
+
+
+def tune_render_settings(model, views, ndc, render_kwargs, cfg, stepsizes, fast_color_threses,
+                         ref_stepsize, min_psnr=35., min_iou=0.98):
+    '''Render the views at every (stepsize, fast_color_thres) candidate and select the setting.'''
+    ref_frames, ref_time, _ = render_views(model, views, ndc, render_kwargs, cfg, ref_stepsize, 0)
+    n_rays = sum(H * W for _, H, W, _ in views)
+    print(f'render_profile: reference (stepsize {ref_stepsize}) {n_rays / ref_time:.0f} rays/s')
+    results = []
+    for stepsize in stepsizes:
+        for fct in fast_color_threses:
+            frames, eps_time, stats = render_views(model, views, ndc, render_kwargs, cfg, stepsize, fct)
+            psnr, iou = _score(frames, ref_frames)
+            res = {
+                'stepsize': stepsize,
+                'fast_color_thres': fct,
+                'psnr': psnr,
+                'iou': iou,
+                'rays_per_sec': n_rays / eps_time,
+                'speedup': ref_time / eps_time,
+                'samples_per_ray': stats.summary()['stages']['weights']['samples_per_ray'],
+            }
+            results.append(res)
+            iou_str = f'{iou:.4f}' if iou is not None else '-'
+            print(f'render_profile: stepsize {stepsize:<6g} fast_color_thres {fct:<8g} psnr {psnr:6.2f} '
+                  f'iou {iou_str:>6s} {res["rays_per_sec"]:10.0f} rays/s ({res["speedup"]:.2f}x) '
+                  f'{res["samples_per_ray"]:7.2f} samples/ray')
+    best, front = select_setting(results, min_psnr, min_iou)
+    return {
+        'stepsize': best['stepsize'],
+        'fast_color_thres': best['fast_color_thres'],
+        'selected': best,
+        'pareto': front,
+        'candidates': results,
+        'reference': {'stepsize': ref_stepsize, 'rays_per_sec': n_rays / ref_time},
+        'targets': {'min_psnr': min_psnr, 'min_iou': min_iou},
+    }
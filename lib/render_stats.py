@@ -0,0 +1,81 @@
+import json
+
+import torch
+
+
+''' Render statistics
+The volume rendering prunes the samples of the rays in stages:
+1. generated:  the samples stepped along the rays by the sampler,
+2. bbox:       left inside the scene bbox (or, for the contracted models, once the
+               oversampled points outside the scene are skipped),
+3. mask_cache: left outside the known free space,
+4. alpha:      with alpha > render_fct (fast_color_thres),
+5. weights:    with weights > render_fct, i.e. the samples whose fields are queried.
+A RenderStats passed as `stats` to the forward of the voxel models gets the
+samples surviving each stage; it accumulates over the chunks of a view, and the
+views of a run are merged into the run total. The counts of rays without
+samples are kept on the device until summary() so that no sync is added.
+'''
+STAGES = ['generated', 'bbox', 'mask_cache', 'alpha', 'weights']
+
+
+class RenderStats:
+    def __init__(self):
+        self.rays = {}
+        self.samples = {}
+        self.empty_rays = {}
+
+    def add(self, stage, ray_id, n_rays):
+        '''Record the samples of n_rays rays (ray_id of each sample) surviving a stage'''
+        hit = torch.zeros([n_rays], dtype=torch.bool, device=ray_id.device)
+        hit[ray_id] = True
+        self.rays[stage] = self.rays.get(stage, 0) + n_rays
+        self.samples[stage] = self.samples.get(stage, 0) + len(ray_id)
+        self.empty_rays[stage] = self.empty_rays.get(stage, 0) + (n_rays - hit.sum())
+
+    def merge(self, other):
+        for stage in other.rays:
+            self.rays[stage] = self.rays.get(stage, 0) + other.rays[stage]
+            self.samples[stage] = self.samples.get(stage, 0) + other.samples[stage]
+            self.empty_rays[stage] = self.empty_rays.get(stage, 0) + other.empty_rays[stage]
+        return self
+
+    def summary(self):
+        '''Per stage: samples, samples per ray, fraction kept from the previous
+        stage, rays without samples and their fraction.
+        '''
+        stages = [s for s in STAGES if s in self.rays] + [s for s in self.rays if s not in STAGES]
+        ret = {'n_rays': max(self.rays.values(), default=0), 'stages': {}}
+        prev = None
+        for stage in stages:
+            n_rays, n_samples = self.rays[stage], self.samples[stage]
+            empty = int(self.empty_rays[stage])
+            ret['stages'][stage] = {
+                'samples': n_samples,
+                'samples_per_ray': n_samples / max(n_rays, 1),
+                'kept': n_samples / prev if prev else 1.,
+                'empty_rays': empty,
+                'empty_ratio': empty / max(n_rays, 1),
+            }
+            prev = n_samples
+        return ret
+
+
+def summary_table(summary):
+    lines = [f'render_stats: {summary["n_rays"]} rays',
+             f'{"stage":>12s} {"samples":>12s} {"/ray":>8s} {"kept":>7s} {"empty rays":>11s}']
+    for stage, s in summary['stages'].items():
+        lines.append(f'{stage:>12s} {s["samples"]:12d} {s["samples_per_ray"]:8.2f} '
+                     f'{s["kept"]*100:6.1f}% {s["empty_ratio"]*100:10.1f}%')
+    return '\n'.join(lines)
+
+
+def write_render_stats(path, view_stats):
+    '''Dump the per-view stats and their total as json'''
+    total = RenderStats()
+    for stats in view_stats:
+        total.merge(stats)
+    report = {'total': total.summary(), 'views': [stats.summary() for stats in view_stats]}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
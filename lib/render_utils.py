@@ -3,8 +3,12 @@ from tqdm import tqdm, trange
 import numpy as np
 from .dvgo import get_rays_of_a_view
 import os
+import threading
+import time
+import cv2
 import imageio
-from .utils import to8b, rgb_lpips, rgb_ssim, gen_rand_colors
+from .utils import to8b, gen_rand_colors, ImageMetrics
+from .render_stats import RenderStats, write_render_stats, summary_table as render_stats_table
 import matplotlib.pyplot as plt
 
 
@@ -13,8 +17,10 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, dump_images=False, cfg=None,
                       render_factor=0, render_video_flipy=False, render_video_rot90=0,
                       eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, 
-                      seg_mask=True, render_fct=0.0, seg_type='seg_density'):
-    '''Render images for the given viewpoints; run evaluation if gt given.'''
+                      seg_mask=True, render_fct=0.0, seg_type='seg_density', render_stats=False):
+    '''Render images for the given viewpoints; run evaluation if gt given.
+    @render_stats: dump the RenderStats of the views to savedir/render_stats.json.
+    '''
     assert len(render_poses) == len(HW) and len(HW) == len(Ks)
 
     if render_factor!=0:
@@ -23,28 +29,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
         HW = (HW/render_factor).astype(int)
         Ks[:, :2, :3] /= render_factor
 
-    rgbs, segs, depths, bgmaps, psnrs, ssims, lpips_alex, lpips_vgg = [], [], [], [], [], [], [], []
+    rgbs, segs, depths, bgmaps = [], [], [], []
+    metrics = ImageMetrics(eval_ssim, eval_lpips_alex, eval_lpips_vgg)
+    view_stats = []
 
     for i, c2w in enumerate(tqdm(render_poses, desc='Render {}...'.format(seg_type))):
         H, W = HW[i]
         K = Ks[i]
         c2w = torch.Tensor(c2w)
-        rays_o, rays_d, viewdirs = get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
         keys = ['rgb_marched', 'depth', 'alphainv_last']
         if seg_mask: keys.append('seg_mask_marched')
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
-        render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
-        ]
-        render_result = {
-            k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
-            for k in render_result_chunks[0].keys()
-        }
+        stats = RenderStats() if render_stats else None
+        render_result = render_image(
+                model, c2w, H, W, K, ndc, render_kwargs, cfg, keys, render_fct=render_fct, stats=stats)
+        if stats is not None:
+            view_stats.append(stats)
         
         rgb = render_result['rgb_marched'].cpu().numpy()
             
@@ -65,20 +64,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
             print('Testing, rgb shape: ', rgb.shape)
 
         if gt_imgs is not None and render_factor==0:
-            p = -10. * np.log10(np.mean(np.square(rgb - gt_imgs[i])))
-            psnrs.append(p)
-            if eval_ssim:
-                ssims.append(rgb_ssim(rgb, gt_imgs[i], max_val=1))
-            if eval_lpips_alex:
-                lpips_alex.append(rgb_lpips(rgb, gt_imgs[i], net_name='alex', device=c2w.device))
-            if eval_lpips_vgg:
-                lpips_vgg.append(rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
-
-    if len(psnrs):
-        print('Testing psnr', np.mean(psnrs), '(avg)')
-        if eval_ssim: print('Testing ssim', np.mean(ssims), '(avg)')
-        if eval_lpips_vgg: print('Testing lpips (vgg)', np.mean(lpips_vgg), '(avg)')
-        if eval_lpips_alex: print('Testing lpips (alex)', np.mean(lpips_alex), '(avg)')
+            # scored on the device of the render, gathered at the end
+            metrics.add(render_result['rgb_marched'], gt_imgs[i])
+
+    if len(metrics):
+        mean = metrics.summary()['mean']
+        print('Testing psnr', mean['psnr'], '(avg)')
+        if eval_ssim: print('Testing ssim', mean['ssim'], '(avg)')
+        if eval_lpips_vgg: print('Testing lpips (vgg)', mean['lpips_vgg'], '(avg)')
+        if eval_lpips_alex: print('Testing lpips (alex)', mean['lpips_alex'], '(avg)')
+        if savedir is not None:
+            metrics.write(os.path.join(savedir, 'metrics.json'))
+
+    if len(view_stats) and savedir is not None:
+        report = write_render_stats(os.path.join(savedir, f'render_stats_{seg_type}.json'), view_stats)
+        print(render_stats_table(report['total']))
 
     if render_video_flipy:
         for i in range(len(rgbs)):
@@ -116,6 +116,145 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     return rgbs, depths, bgmaps, segs
 
 
+def render_image(model, c2w, H, W, K, ndc, render_kwargs, cfg, keys, render_fct=0.0, chunk=8192, stats=None):
+    '''Render the `keys` outputs of one view, reshaped to [H, W, -1].'''
+    rays_o, rays_d, viewdirs = get_rays_of_a_view(
+            H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    rays_o = rays_o.flatten(0,-2)
+    rays_d = rays_d.flatten(0,-2)
+    viewdirs = viewdirs.flatten(0,-2)
+    render_result_chunks = [
+        {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, stats=stats, **render_kwargs).items() if k in keys}
+        for ro, rd, vd in zip(rays_o.split(chunk, 0), rays_d.split(chunk, 0), viewdirs.split(chunk, 0))
+    ]
+    return {
+        k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
+        for k in render_result_chunks[0].keys()
+    }
+
+
+class ProgressiveRenderer:
+    '''Render a set of views coarse-to-fine in a background thread.
+    Every view is rendered at each of the `factors` in turn, with the
+    render_video_factor semantics (H, W and the intrinsics are divided by the
+    factor, 0 for full resolution). The next frame is picked right before it
+    is rendered: the selected view first climbs all the levels, then the
+    other views are swept level by level. prioritize(idx) on another view
+    starts a new selection generation, which drops the pending renders of the
+    sweep: only the selected view is rendered from then on, the thread idles
+    once it is done and wakes up on the next selection. The frames rendered so
+    far are kept.
+    @render_frame: fn(c2w, H, W, K) -> dict of [H, W, 3] uint8 frames.
+    '''
+    def __init__(self, render_frame, render_poses, HW, Ks, factors=(8, 4, 0)):
+        self.render_frame = render_frame
+        self.render_poses = render_poses
+        self.HW = np.copy(HW)
+        self.Ks = np.copy(Ks)
+        self.factors = factors
+        self.frames = {}     # view index -> (level index, dict of frames)
+        self.selected = 0
+        self.generation = 0  # selection changes, the sweep only runs in the first generation
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        '''Drop the pending renders without waiting for the frame in flight.'''
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def stop(self):
+        '''Cancel the pending renders, the frame in flight is finished first.'''
+        self.cancel()
+        self.wait()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def select(self, idx):
+        '''Render the view next up to full resolution, dropping the pending renders of the other views.'''
+        with self.cond:
+            if int(idx) != self.selected:
+                self.selected = int(idx)
+                self.generation += 1
+            self.cond.notify_all()
+
+    def wait_selected(self):
+        '''Wait until the selected view (at the time it is done) has all its levels, or the renderer stops.'''
+        with self.cond:
+            while not self.stopped and self._done(self.selected) < len(self.factors) - 1 and \
+                    self.thread is not None and self.thread.is_alive():
+                self.cond.wait(0.1)
+
+    @property
+    def finished(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def get(self, idx):
+        '''The best frames rendered so far for the view (resized to full resolution) and their factor.'''
+        with self.lock:
+            if idx not in self.frames:
+                return None, None
+            level, frames = self.frames[idx]
+        H, W = self.HW[idx]
+        frames = {
+            k: cv2.resize(v, (int(W), int(H)), interpolation=cv2.INTER_NEAREST) if v.shape[:2] != (H, W) else v
+            for k, v in frames.items()}
+        return frames, self.factors[level]
+
+    def _done(self, idx):
+        return self.frames[idx][0] if idx in self.frames else -1
+
+    def _next_task(self):
+        '''(view, level) to render next, None if there is nothing left in this generation'''
+        if self._done(self.selected) < len(self.factors) - 1:
+            return self.selected, self._done(self.selected) + 1
+        if self.generation > 0:
+            # the sweep of the other views is stale once the selection changed
+            return None
+        pending = [
+            (self._done(idx) + 1, idx) for idx in range(len(self.render_poses))
+            if self._done(idx) < len(self.factors) - 1]
+        if len(pending) == 0:
+            return None
+        level, idx = min(pending)
+        return idx, level
+
+    def _run(self):
+        eps_time = time.time()
+        while True:
+            with self.cond:
+                task = self._next_task()
+                while task is None and not self.stopped and self.generation > 0:
+                    # idle until the next selection
+                    self.cond.wait()
+                    task = self._next_task()
+                if task is None or self.stopped:
+                    break
+            idx, level = task
+            H, W = self.HW[idx]
+            K = np.copy(self.Ks[idx])
+            factor = self.factors[level]
+            if factor != 0:
+                H, W = int(H/factor), int(W/factor)
+                K[:2, :3] /= factor
+            frames = self.render_frame(torch.Tensor(self.render_poses[idx]), H, W, K)
+            with self.cond:
+                self.frames[idx] = (level, frames)
+                self.cond.notify_all()
+        print(f'ProgressiveRenderer: {"stopped" if self.stopped else "finished"} in {time.time()-eps_time:.1f}s')
+
+
 def fetch_render_params(render_type, data_dict):
     if render_type == 'train':
         render_poses=data_dict['poses'][data_dict['i_train']]
@@ -145,13 +284,20 @@ def render_fn(args, cfg, ckpt_name, flag, e_flag, num_obj, data_dict, render_vie
     os.makedirs(testsavedir, exist_ok=True)
     print('All results are dumped into', testsavedir)
     render_poses, HW, Ks, gt_imgs = fetch_render_params(args.render_opt, data_dict)
-    rgbs, depths, bgmaps, segs = render_viewpoints(
-            render_poses=render_poses,
-            HW=HW, Ks=Ks, gt_imgs=gt_imgs,
-            cfg=cfg,savedir=testsavedir, dump_images=args.dump_images,
-            eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
-            seg_type=seg_type,
-            **render_viewpoints_kwargs)
+    # the stepsize / fast_color_thres selected by tune_render.py for this checkpoint
+    from .render_profile import load_render_profile, apply_render_profile
+    profile = load_render_profile(cfg, ckpt_name)
+    if profile is not None:
+        print(f'render_fn: render profile stepsize {profile["stepsize"]} fast_color_thres {profile["fast_color_thres"]}')
+    with apply_render_profile(profile, render_viewpoints_kwargs['model'],
+                              render_viewpoints_kwargs['render_kwargs']) as render_kwargs:
+        rgbs, depths, bgmaps, segs = render_viewpoints(
+                render_poses=render_poses,
+                HW=HW, Ks=Ks, gt_imgs=gt_imgs,
+                cfg=cfg,savedir=testsavedir, dump_images=args.dump_images,
+                eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
+                seg_type=seg_type, render_stats=args.render_stats,
+                **{**render_viewpoints_kwargs, 'render_kwargs': render_kwargs})
     
     imageio.mimwrite(os.path.join(testsavedir, 'video.rgb'+flag+e_flag+'_'+seg_type+'.mp4'), to8b(rgbs), fps=30, quality=8)
     imageio.mimwrite(os.path.join(testsavedir, 'video.seg'+flag+e_flag+'_'+seg_type+'.mp4'), to8b(segs>0), fps=30, quality=8)
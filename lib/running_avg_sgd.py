@@ -0,0 +1,83 @@
+import torch
+
+from .masked_adam import adam_upd_cuda
+
+
+''' SGD with view-count averaging for the segmentation mask grid
+The mask grid holds the average of the per-view updates: each voxel keeps the
+number of views that changed it, and an update g of a voxel with value v and
+count c results in (v * c - lr * g) / (c + 1). Only voxels with non-zero grad are
+read and written, in a single pass (one kernel on cuda).
+'''
+def running_avg_sgd_upd_torch(param, grad, counts, lr):
+    '''torch counterpart of adam_upd_cuda.running_avg_sgd_upd'''
+    index = grad.view(-1).nonzero().squeeze(1)
+    param_flat, counts_flat = param.view(-1), counts.view(-1)
+    cnt = counts_flat[index]
+    total = param_flat[index] * cnt
+    new_total = total.add(grad.view(-1)[index], alpha=-lr)
+    cnt += (new_total != total)
+    counts_flat[index] = cnt
+    param_flat[index] = new_total / (cnt + 1e-9)
+
+
+class RunningAverageSGD(torch.optim.Optimizer):
+    '''Plain SGD, except for the groups with a `view_counts` tensor, whose
+    params are updated as the running average of the per-view updates.
+    '''
+    def __init__(self, params, lr=1e-3):
+        if not 0.0 <= lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        defaults = dict(lr=lr, view_counts=None)
+        super(RunningAverageSGD, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self):
+        for group in self.param_groups:
+            lr = group['lr']
+            counts = group['view_counts']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                if counts is None:
+                    param.add_(param.grad, alpha=-lr)
+                elif param.is_cuda:
+                    adam_upd_cuda.running_avg_sgd_upd(param, param.grad, counts, lr)
+                else:
+                    running_avg_sgd_upd_torch(param, param.grad, counts, lr)
+
+
+if __name__ == '__main__':
+    # equivalence with the former scale / SGD / compare / divide sequence of sam3d.optim
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    shape = [1, 2, 24, 24, 24]
+    grid_ref = torch.zeros(shape, device=device, requires_grad=True)
+    dual_ref = torch.zeros(shape, device=device, requires_grad=True)
+    counts_ref = torch.zeros(shape, device=device)
+    grid = grid_ref.detach().clone().requires_grad_()
+    dual = dual_ref.detach().clone().requires_grad_()
+    counts = counts_ref.clone()
+    optimizer_ref = torch.optim.SGD([{'params': [grid_ref], 'lr': 1}, {'params': [dual_ref], 'lr': 1}])
+    optimizer = RunningAverageSGD([{'params': [grid], 'lr': 1, 'view_counts': counts}, {'params': [dual], 'lr': 1}])
+    for i in range(20):
+        # each view only touches part of the grid
+        touched = (torch.rand(shape, device=device) < 0.3).float()
+        target = torch.randn(shape, device=device)
+        for g, d, opt in [(grid_ref, dual_ref, optimizer_ref), (grid, dual, optimizer)]:
+            opt.zero_grad()
+            (((g - target) * touched).pow(2).sum() + (d * touched).sum()).backward()
+        with torch.no_grad():
+            grid_ref *= counts_ref
+            prev_grid = grid_ref.detach().clone()
+        optimizer_ref.step()
+        with torch.no_grad():
+            counts_ref += (grid_ref != prev_grid)
+            grid_ref /= (counts_ref + 1e-9)
+        optimizer.step()
+
+    print('running_avg_sgd: max abs diff of the mask grid', (grid - grid_ref).abs().max().item())
+    assert torch.equal(counts, counts_ref), 'view counts mismatch'
+    assert torch.allclose(grid, grid_ref, atol=1e-6, rtol=1e-5), 'mask grid mismatch'
+    assert torch.equal(dual, dual_ref), 'plain SGD group mismatch'
+    print('running_avg_sgd: matches the former view-count averaging on', device)
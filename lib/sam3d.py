@@ -17,13 +17,24 @@ from . import utils
 # from .scene_property import INPUT_BOX, INPUT_POINT
 from .self_prompting import mask_to_prompt
 from .prepare_prompts import get_prompt_points
-from .render_utils import render_fn
+from .render_utils import render_fn, fetch_render_params, ProgressiveRenderer
+from .checkpoint import write_seg_delta
+from .running_avg_sgd import RunningAverageSGD
+from .seg_trace import SegTracer
+
+
+def load_sam_predictor(device=torch.device('cuda')):
+    '''SAM ViT-H predictor'''
+    sam_checkpoint = "./dependencies/sam_ckpt/sam_vit_h_4b8939.pth"
+    model_type = "vit_h"
+    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint).to(device)
+    return SamPredictor(sam)
 
 
 class Sam3D(ABC):
     '''TODO, add discription'''
     def __init__(self, args, cfg, xyz_min, xyz_max, cfg_model, cfg_train, \
-                 data_dict, device=torch.device('cuda'), stage='coarse', coarse_ckpt_path=None):
+                 data_dict, device=torch.device('cuda'), stage='coarse', coarse_ckpt_path=None, predictor=None):
         self.cfg = cfg
         self.args = args
         # if args.mobile_sam:
@@ -39,11 +50,12 @@ class Sam3D(ABC):
         #     self.sam.eval()
 
         # else:
-        sam_checkpoint = "./dependencies/sam_ckpt/sam_vit_h_4b8939.pth"
-        model_type = "vit_h"
-        self.sam = sam_model_registry[model_type](checkpoint=sam_checkpoint).to(device)
-        self.predictor = SamPredictor(self.sam)
-        print("SAM initializd.")
+        # a predictor can be shared by the Sam3D of several jobs (see seg_batch)
+        if predictor is None:
+            predictor = load_sam_predictor(device)
+            print("SAM initializd.")
+        self.predictor = predictor
+        self.sam = predictor.model
         self.step_size = cfg.fine_model_and_render.stepsize
         self.device = device
         self.segment = args.segment
@@ -58,6 +70,13 @@ class Sam3D(ABC):
         self.stage = stage
         self.coarse_ckpt_path = coarse_ckpt_path
 
+        # per-stage timings and counters of the segmentation steps
+        self.tracer = SegTracer(
+                os.path.join(self.base_save_dir, f'seg_trace_{stage}'+self.e_flag),
+                enabled=getattr(args, 'trace_seg', False), chrome=getattr(args, 'trace_chrome', False))
+        self.predictor.set_image = self.tracer.wrap('set_image', self.predictor.set_image)
+        self.predictor.predict = self.tracer.wrap('predict', self.predictor.predict)
+
 
     def init_model(self):
         '''TODO, add discription'''
@@ -82,6 +101,7 @@ class Sam3D(ABC):
         # init model and optimizer
         assert reload_ckpt_path is not None and 'segmentation must based on a pretrained NeRF'
         print(f'scene_rep_reconstruction ({self.stage}): reload from {reload_ckpt_path}')
+        self.reload_ckpt_path = reload_ckpt_path
         model, optimizer, start = utils.load_existed_model(self.args, self.cfg, 
             self.cfg_train, reload_ckpt_path, self.device)
 
@@ -123,7 +143,7 @@ class Sam3D(ABC):
         return init_image
 
 
-    def render_view(self, idx, cam_params=None, render_fct=0.0):
+    def render_view(self, idx, cam_params=None, render_fct=0.0, stats=None):
         # Training seg
         if cam_params is None:
             render_poses, HW, Ks = fetch_seg_poses(self.args.seg_poses, self.data_dict)
@@ -145,7 +165,7 @@ class Sam3D(ABC):
         if self.stage == 'fine': keys.append('dual_seg_mask_marched')
         rays_o, rays_d, viewdirs = [arr.flatten(0, -2) for arr in [rays_o, rays_d, viewdirs]]
         render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, distill_active=False, render_fct=render_fct, **render_kwargs).items() if k in keys}
+            {k: v for k, v in model(ro, rd, vd, distill_active=False, render_fct=render_fct, stats=stats, **render_kwargs).items() if k in keys}
             for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
         ]
         render_result = {
@@ -171,21 +191,26 @@ class Sam3D(ABC):
             loss, sam_seg_show, _ = self.prompting_fine(H, W, seg_m, dual_seg_m, index_matrix, num_obj)
         else:
             raise NotImplementedError
-        optim(self.optimizer, loss, model=self.render_viewpoints_kwargs['model'])
+        with self.tracer.span('optim'):
+            optim(self.optimizer, loss, model=self.render_viewpoints_kwargs['model'])
 
         return sam_seg_show
 
 
     def inverse(self, seg_m, sam_mask):
-        loss = seg_loss(sam_mask, None, seg_m)
-        optim(self.optimizer, loss, model=self.render_viewpoints_kwargs['model'])
+        with self.tracer.span('seg_loss'):
+            loss = seg_loss(sam_mask, None, seg_m)
+        with self.tracer.span('optim'):
+            optim(self.optimizer, loss, model=self.render_viewpoints_kwargs['model'])
 
 
     def train_step(self, idx, sam_mask=None):
         render_poses, HW, Ks = fetch_seg_poses(self.args.seg_poses, self.data_dict)
         assert(idx < len(render_poses))
 
-        rgb, depth, bgmap, seg_m, dual_seg_m = self.render_view(idx, [render_poses, HW, Ks])
+        self.tracer.begin_view(idx)
+        with self.tracer.span('render_view'):
+            rgb, depth, bgmap, seg_m, dual_seg_m = self.render_view(idx, [render_poses, HW, Ks], stats=self.tracer.stats)
         if sam_mask is None:
             self.predictor.set_image(utils.to8b(rgb.cpu().numpy()))
             sam_seg_show = self.prompt_and_inverse(idx, HW, seg_m, dual_seg_m, depth)
@@ -198,18 +223,19 @@ class Sam3D(ABC):
         seg_m = seg_m.detach().cpu().numpy()
         recolored_img = utils.to8b(0.4 * rgb + 0.6 * (seg_m>0))
         if sam_seg_show is not None: sam_seg_show = utils.to8b(sam_seg_show)
+        self.tracer.end_view()
+        if idx >= len(render_poses)-1:
+            self.tracer.close()
         return recolored_img, sam_seg_show, idx >= len(render_poses)-1
 
 
     def save_ckpt(self):
         if self.args.save_ckpt:
             model = self.render_viewpoints_kwargs['model']
-            torch.save({
-                'model_kwargs': model.get_kwargs(),
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': self.optimizer.state_dict(),
-            }, os.path.join(self.base_save_dir, f'{self.stage}_segmentation'+self.e_flag+'.tar'))
-            print(f'scene_rep_reconstruction ({self.stage}): saved checkpoints at', os.path.join(self.base_save_dir, f'{self.stage}_segmentation'+self.e_flag+'.tar'))
+            # only the mask grids are stored, on top of the NeRF checkpoint they were trained from
+            path = os.path.join(self.base_save_dir, f'{self.stage}_segmentation'+self.e_flag+'.tar')
+            write_seg_delta(model, self.reload_ckpt_path, path)
+            print(f'scene_rep_reconstruction ({self.stage}): saved checkpoints at', path)
         else:
             print('Did not add --save_ckpt in parser. Therefore, ckpt is not saved.')
     
@@ -244,6 +270,34 @@ class Sam3D(ABC):
             videos.append(video)
         return videos
 
+    @torch.no_grad()
+    def render_preview(self, c2w, H, W, K):
+        '''Render the seg_img and seg_density results of one view for the GUI preview'''
+        cam_params = ([c2w], np.array([[H, W]]), np.array([K]))
+        rgb, _, _, seg_m, _ = self.render_view(0, cam_params)
+        rgb = rgb.cpu().numpy()
+        if seg_m is None:
+            return {'masked_rgb': utils.to8b(rgb)}
+
+        # Winner takes all, as in render_fn
+        seg_m = seg_m.cpu().numpy()
+        num_obj = seg_m.shape[-1]
+        tmp_seg = np.argmax(seg_m, axis=-1)
+        tmp_seg[np.max(seg_m, axis=-1) <= 0.1] = num_obj
+        frames = {'masked_rgb': utils.to8b(0.3*rgb + 0.7*self.preview_colors[tmp_seg])}
+        if num_obj == 1:
+            with self.render_viewpoints_kwargs['model'].segmented_density():
+                seged_rgb, _, _, _, _ = self.render_view(0, cam_params)
+            frames['seged_rgb'] = utils.to8b(seged_rgb.cpu().numpy())
+        return frames
+
+    def preview_renderer(self, factors=(8, 4, 0)):
+        '''Progressive (coarse-to-fine) preview of the segmentation on the render_opt poses'''
+        render_poses, HW, Ks, _ = fetch_render_params(self.args.render_opt, self.data_dict)
+        num_obj = self.render_viewpoints_kwargs['model'].seg_mask_grid.grid.shape[1]
+        self.preview_colors = utils.gen_rand_colors(num_obj)
+        return ProgressiveRenderer(self.render_preview, render_poses, HW, Ks, factors)
+
     def seg_init_frame_coarse(self):
         '''for coarse stage init, we need to set a prompt for the user to select a mask'''
         with torch.no_grad():
@@ -353,8 +407,9 @@ class Sam3D(ABC):
         for num in range(num_obj):
             with torch.no_grad():
                 # self-prompting
-                prompt_points, input_label = mask_to_prompt(predictor = self.predictor, rendered_mask_score = seg_m_for_prompt[:,:,num][:,:,None], 
-                                                            index_matrix = index_matrix, num_prompts = self.args.num_prompts)
+                with self.tracer.span('mask_to_prompt'):
+                    prompt_points, input_label = mask_to_prompt(predictor = self.predictor, rendered_mask_score = seg_m_for_prompt[:,:,num][:,:,None], 
+                                                                index_matrix = index_matrix, num_prompts = self.args.num_prompts)
 
                 masks, selected = None, -1
                 if len(prompt_points) != 0:
@@ -385,15 +440,20 @@ class Sam3D(ABC):
                 tmp_rendered_mask[tmp_rendered_mask != 0] = 1
                 tmp_IoU = utils.cal_IoU(torch.as_tensor(masks[selected]).float(), tmp_rendered_mask)
                 print(f"current IoU is: {tmp_IoU}")
+                self.tracer.count('iou_checks')
                 if tmp_IoU < 0.5:
                     print("SKIP, unacceptable sam prediction, IoU is", tmp_IoU)
+                    self.tracer.count('skips')
                     continue
 
-                loss += seg_loss(masks, selected, tmp_seg_m, self.args.lamb)
-                for neg_i in range(seg_m.shape[-1]):
-                    if neg_i == num:
-                        continue
-                    loss += (torch.tensor(masks[selected]).to(seg_m.device) * seg_m[:,:,neg_i]).sum()
+                with self.tracer.span('seg_loss'):
+                    loss += seg_loss(masks, selected, tmp_seg_m, self.args.lamb)
+                    for neg_i in range(seg_m.shape[-1]):
+                        if neg_i == num:
+                            continue
+                        loss += (torch.tensor(masks[selected]).to(seg_m.device) * seg_m[:,:,neg_i]).sum()
+            else:
+                self.tracer.count('no_prompts')
         return loss, sam_seg_show
 
 
@@ -426,13 +486,15 @@ class Sam3D(ABC):
 
             
                 # self-prompting
-                ori_prompt_points, ori_input_label = mask_to_prompt(predictor = self.predictor, \
-                    rendered_mask_score = seg_m_for_prompt[:,:,num].unsqueeze(-1), index_matrix = index_matrix, num_prompts = self.args.num_prompts)
+                with self.tracer.span('mask_to_prompt'):
+                    ori_prompt_points, ori_input_label = mask_to_prompt(predictor = self.predictor, \
+                        rendered_mask_score = seg_m_for_prompt[:,:,num].unsqueeze(-1), index_matrix = index_matrix, num_prompts = self.args.num_prompts)
                 num_self_prompts = len(ori_prompt_points)
 
                 # dual self-prompting
-                dual_prompt_points, dual_input_label = mask_to_prompt(predictor = self.predictor, \
-                    rendered_mask_score = dual_seg_m_for_prompt[:,:,num].unsqueeze(-1), index_matrix = index_matrix, num_prompts = self.args.num_prompts)                
+                with self.tracer.span('mask_to_prompt'):
+                    dual_prompt_points, dual_input_label = mask_to_prompt(predictor = self.predictor, \
+                        rendered_mask_score = dual_seg_m_for_prompt[:,:,num].unsqueeze(-1), index_matrix = index_matrix, num_prompts = self.args.num_prompts)                
                 num_dual_self_prompts = len(dual_prompt_points)
 
                 masks, dual_masks = None, None
@@ -482,30 +544,36 @@ class Sam3D(ABC):
             if masks is not None:
                 tmp_IoU = utils.cal_IoU(torch.as_tensor(masks[0]).float(), tmp_rendered_mask)
                 print("tmp_IoU:", tmp_IoU)
+                self.tracer.count('iou_checks')
                 if tmp_IoU < 0.5:
                     print("SKIP, unacceptable sam prediction for original seg, IoU is", tmp_IoU)
+                    self.tracer.count('skips')
                 else:
-                    loss += seg_loss(masks[0], None, tmp_seg_m, self.args.lamb)
-                    # loss += -(torch.tensor(masks[0]).to(seg_m.device) * tmp_seg_m).sum() + 0.15 * (torch.tensor(1-masks[0]).to(seg_m.device) * tmp_seg_m).sum()
-                    for neg_i in range(seg_m.shape[-1]):
-                        if neg_i == num: 
-                            continue
-                        loss -= seg_loss(masks[0], None, seg_m[:,:,neg_i], 0)
-                        # loss += (torch.tensor(masks[0]).to(seg_m.device) * seg_m[:,:,neg_i]).sum()
+                    with self.tracer.span('seg_loss'):
+                        loss += seg_loss(masks[0], None, tmp_seg_m, self.args.lamb)
+                        # loss += -(torch.tensor(masks[0]).to(seg_m.device) * tmp_seg_m).sum() + 0.15 * (torch.tensor(1-masks[0]).to(seg_m.device) * tmp_seg_m).sum()
+                        for neg_i in range(seg_m.shape[-1]):
+                            if neg_i == num: 
+                                continue
+                            loss -= seg_loss(masks[0], None, seg_m[:,:,neg_i], 0)
+                            # loss += (torch.tensor(masks[0]).to(seg_m.device) * seg_m[:,:,neg_i]).sum()
 
                 if dual_masks is not None:
                     tmp_IoU = utils.cal_IoU(torch.as_tensor(dual_masks[0]).float(), tmp_rendered_dual_mask)
                     print("tmp_dual_IoU:", tmp_IoU)
+                    self.tracer.count('iou_checks')
                     if tmp_IoU < 0.5:
                         print("SKIP, unacceptable sam prediction for dual seg, IoU is", tmp_IoU)
+                        self.tracer.count('skips')
                     else:
-                        loss += seg_loss(dual_masks[0], None, dual_tmp_seg_m, self.args.lamb)
-                        # loss += -(torch.tensor(dual_masks[0]).to(seg_m.device) * dual_tmp_seg_m).sum() + 0.15 * (torch.tensor(1-dual_masks[0]).to(dual_seg_m.device) * dual_tmp_seg_m).sum()
-                        for neg_i in range(dual_seg_m.shape[-1]):
-                            if neg_i == num: 
-                                continue
-                            loss -= seg_loss(dual_masks[0], None, dual_seg_m[:,:,neg_i], 0)
-                            # loss += (torch.tensor(dual_masks[0]).to(seg_m.device) * dual_seg_m[:,:,neg_i]).sum()
+                        with self.tracer.span('seg_loss'):
+                            loss += seg_loss(dual_masks[0], None, dual_tmp_seg_m, self.args.lamb)
+                            # loss += -(torch.tensor(dual_masks[0]).to(seg_m.device) * dual_tmp_seg_m).sum() + 0.15 * (torch.tensor(1-dual_masks[0]).to(dual_seg_m.device) * dual_tmp_seg_m).sum()
+                            for neg_i in range(dual_seg_m.shape[-1]):
+                                if neg_i == num: 
+                                    continue
+                                loss -= seg_loss(dual_masks[0], None, dual_seg_m[:,:,neg_i], 0)
+                                # loss += (torch.tensor(dual_masks[0]).to(seg_m.device) * dual_seg_m[:,:,neg_i]).sum()
         
         return loss, sam_seg_show, dual_sam_seg_show
 
@@ -554,6 +622,10 @@ def optim(optimizer, loss, clip=None, model=None):
         loss.backward()
         if clip is not None:
             torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+        if isinstance(optimizer, RunningAverageSGD):
+            # the view-count averaging is fused into the update
+            optimizer.step()
+            return
         if model is not None:
             with torch.no_grad():
                 model.seg_mask_grid.grid *= model.mask_view_counts
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from . import utils
+from . import sam3d
+from . import checkpoint
+from .bbox_utils import compute_bbox_by_cam_frustrm, compute_bbox_by_coarse_geo
+from .config_loader import Config
+from .configs import config_parser
+
+
+''' Headless batch segmentation
+A manifest lists segmentation jobs, one object of a scene each:
+    {"config": "configs/llff/seg/seg_fern.py", "sp_name": "_leaf",
+     "points": [[x, y], ...] | "box": [x0, y0, x1, y1] | "text": "a leaf",
+     "mask_id": 0, "argv": ["--num_prompts", "5"]}
+as a json list or one job per line. The prompt is given on the first seg view
+(the first train view); mask_id selects one of the three SAM masks, the best
+scored one by default; argv overrides the command line arguments of the job.
+SegBatchRunner runs the jobs as run_seg_gui.py does (coarse stage, then the
+fine stage with --use_fine_stage) without the Dash GUI. SAM is loaded once, the
+scenes (config, images / poses, scene bbox) are kept in an LRU cache and the
+NeRF checkpoints are read once per scene through the checkpoint cache. The jobs
+are grouped by scene, and every job appends its metrics (timings, IoU of the
+rendered mask with the prompt mask, ckpt paths) to a jsonl file. As in
+run_seg_gui.py, the stages whose seg checkpoint exists are skipped unless redo.
+'''
+def load_manifest(path):
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        jobs = json.loads(text)
+    else:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    for i, job in enumerate(jobs):
+        job.setdefault('id', i)
+        n_prompts = sum(k in job for k in ['points', 'box', 'text'])
+        if 'config' not in job or n_prompts != 1:
+            raise ValueError(f'seg_batch: job {job["id"]} needs a config and one of points/box/text')
+    return jobs
+
+
+def group_by_scene(jobs):
+    '''Stable order of the jobs with the jobs of a scene next to each other'''
+    order = {}
+    for job in jobs:
+        order.setdefault(os.path.abspath(job['config']), len(order))
+    return sorted(jobs, key=lambda job: order[os.path.abspath(job['config'])])
+
+
+@torch.no_grad()
+def predict_prompt_masks(predictor, image, points=None, box=None, text=None):
+    '''The three SAM masks and scores of a prompt on the image set in the predictor'''
+    if text is not None:
+        from .self_prompting import grounding_dino_prompt
+        box = grounding_dino_prompt(image, text)[0]
+    if points is not None:
+        points = np.asarray(points)
+        masks, scores, _ = predictor.predict(
+            point_coords=points,
+            point_labels=np.ones(len(points)),
+            multimask_output=True,
+        )
+    else:
+        masks, scores, _ = predictor.predict(
+            box=np.asarray(box, dtype=np.float32),
+            multimask_output=True,
+        )
+    return masks, scores
+
+
+class SegBatchRunner:
+    def __init__(self, argv=(), device=torch.device('cuda'), max_scenes=2, redo=False, metrics_path=None):
+        # command line arguments shared by the jobs, the jobs add their own argv
+        self.argv = list(argv)
+        self.device = device
+        self.max_scenes = max_scenes
+        self.redo = redo
+        self.metrics_path = metrics_path
+        self.scenes = OrderedDict()
+        self.predictor = None
+
+    def job_args(self, job):
+        args = config_parser().parse_args(['--config', job['config']] + self.argv + list(job.get('argv', [])))
+        if job.get('sp_name') is not None:
+            args.sp_name = job['sp_name']
+        # the seg checkpoints are the output of the jobs
+        args.segment = True
+        args.save_ckpt = True
+        return args
+
+    def load_scene(self, args):
+        '''cfg, data_dict and scene bbox of the config, from the LRU cache'''
+        key = os.path.abspath(args.config)
+        if key in self.scenes:
+            self.scenes.move_to_end(key)
+            return self.scenes[key]
+        while len(self.scenes) >= self.max_scenes:
+            _, evicted = self.scenes.popitem(last=False)
+            checkpoint.clear_cache(os.path.join(evicted['cfg'].basedir, evicted['cfg'].expname))
+        cfg = Config.fromfile(args.config)
+        data_dict = utils.load_everything(args=args, cfg=cfg)
+        xyz_min, xyz_max = compute_bbox_by_cam_frustrm(args=args, cfg=cfg, **data_dict)
+        scene = {'cfg': cfg, 'data_dict': data_dict, 'xyz_min': xyz_min, 'xyz_max': xyz_max}
+        self.scenes[key] = scene
+        return scene
+
+    def run_stage(self, args, scene, job, stage, xyz_min, xyz_max, coarse_ckpt_path=None):
+        '''Train the seg grids of one stage from the job prompt, as Sam3dGUI.start_training'''
+        cfg = scene['cfg']
+        metrics = {}
+        eps_time = time.time()
+        Seg3d = sam3d.Sam3D(args, cfg, cfg_model=cfg[f'{stage}_model_and_render'], cfg_train=cfg[f'{stage}_train'],
+                xyz_min=xyz_min, xyz_max=xyz_max, data_dict=scene['data_dict'], device=self.device,
+                stage=stage, coarse_ckpt_path=coarse_ckpt_path, predictor=self.predictor)
+        init_rgb = Seg3d.init_model()
+        metrics['init_s'] = time.time() - eps_time
+
+        masks, scores = predict_prompt_masks(self.predictor, init_rgb,
+                points=job.get('points'), box=job.get('box'), text=job.get('text'))
+        mask_id = job.get('mask_id')
+        if mask_id is None:
+            mask_id = int(np.argmax(scores))
+        metrics['mask_id'] = mask_id
+        metrics['sam_score'] = float(scores[mask_id])
+
+        eps_train = time.time()
+        # optim in the first view, then cross-view training
+        train_idx = 0
+        try:
+            Seg3d.train_step(train_idx, sam_mask=masks[mask_id])
+            is_finished = False
+            while not is_finished:
+                train_idx += 1
+                _, _, is_finished = Seg3d.train_step(train_idx)
+        finally:
+            # a failed job still saves the trace of the views trained
+            Seg3d.tracer.close()
+        metrics['n_views'] = train_idx + 1
+        metrics['train_s'] = time.time() - eps_train
+        Seg3d.save_ckpt()
+
+        # the rendered mask of the prompt view against the prompt mask
+        with torch.no_grad():
+            _, _, _, seg_m, _ = Seg3d.render_view(0)
+        rendered_mask = (seg_m[..., 0] > 0).float()
+        metrics['prompt_view_iou'] = float(utils.cal_IoU(rendered_mask, torch.as_tensor(masks[mask_id]).float().to(rendered_mask.device)))
+
+        if args.render_opt is not None:
+            eps_render = time.time()
+            Seg3d.render_test()
+            metrics['render_s'] = time.time() - eps_render
+        if Seg3d.tracer.enabled:
+            metrics['trace'] = Seg3d.tracer.prefix
+        metrics['ckpt'] = os.path.join(Seg3d.base_save_dir, f'{stage}_segmentation'+Seg3d.e_flag+'.tar')
+        metrics['time_s'] = time.time() - eps_time
+        del Seg3d
+        return metrics
+
+    def run_job(self, job):
+        args = self.job_args(job)
+        utils.seed_everything(args)
+        eps_time = time.time()
+        scene = self.load_scene(args)
+        cfg = scene['cfg']
+        ret = {'id': job['id'], 'config': job['config'], 'sp_name': args.sp_name,
+               'scene_s': time.time() - eps_time, 'stages': {}}
+
+        e_flag = args.sp_name if args.sp_name is not None else ''
+        coarse_seg_ckpt_path = os.path.join(cfg.basedir, cfg.expname, f'coarse_segmentation'+e_flag+'.tar')
+        for stage in ['coarse'] + (['fine'] if args.use_fine_stage else []):
+            seg_ckpt_path = os.path.join(cfg.basedir, cfg.expname, f'{stage}_segmentation'+e_flag+'.tar')
+            if not self.redo and os.path.exists(seg_ckpt_path):
+                print(f'seg_batch: job {job["id"]} {stage} segmentation has been completed, skip!')
+                continue
+            if stage == 'coarse':
+                ret['stages'][stage] = self.run_stage(
+                        args, scene, job, stage, scene['xyz_min'], scene['xyz_max'])
+                continue
+            if cfg.coarse_train.N_iters == 0:
+                xyz_min_fine, xyz_max_fine = scene['xyz_min'].clone(), scene['xyz_max'].clone()
+            else:
+                xyz_min_fine, xyz_max_fine = compute_bbox_by_coarse_geo(
+                        model_class=utils.find_model(cfg), model_path=coarse_seg_ckpt_path,
+                        thres=cfg.fine_model_and_render.bbox_thres)
+            ret['stages'][stage] = self.run_stage(
+                    args, scene, job, stage, xyz_min_fine, xyz_max_fine, coarse_ckpt_path=coarse_seg_ckpt_path)
+
+        ret['time_s'] = time.time() - eps_time
+        torch.cuda.empty_cache()
+        return ret
+
+    def run(self, jobs):
+        jobs = group_by_scene(jobs)
+        eps_time = time.time()
+        if self.predictor is None:
+            self.predictor = sam3d.load_sam_predictor(self.device)
+            print('seg_batch: SAM initialized in', f'{time.time() - eps_time:.1f}s')
+        if self.metrics_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.metrics_path)), exist_ok=True)
+        results, n_failed = [], 0
+        for i, job in enumerate(jobs):
+            print(f'seg_batch: job {job["id"]} ({i+1}/{len(jobs)}) {job["config"]} {job.get("sp_name") or ""}')
+            try:
+                ret = self.run_job(job)
+            except Exception as e:
+                # a failed job does not stop the batch
+                print(f'seg_batch: job {job["id"]} failed: {type(e).__name__}: {e}')
+                ret = {'id': job['id'], 'config': job['config'], 'sp_name': job.get('sp_name'),
+                       'error': f'{type(e).__name__}: {e}'}
+                n_failed += 1
+            results.append(ret)
+            if self.metrics_path is not None:
+                with open(self.metrics_path, 'a') as f:
+                    f.write(json.dumps(ret) + '\n')
+        eps_time = time.time() - eps_time
+        print(f'seg_batch: {len(jobs) - n_failed}/{len(jobs)} jobs in {eps_time:.1f}s '
+              f'({eps_time / max(len(jobs), 1):.1f}s per job)')
+        return results
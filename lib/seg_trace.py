@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import functools
+
+import torch
+
+from .render_stats import RenderStats
+
+
+''' Per-stage timing and counters of the segmentation
+A SegTracer records, for every traced view, the time spent in the stages of a
+Sam3D step (render_view, set_image, mask_to_prompt, predict, seg_loss, optim)
+and counters (the SAM calls, the IoU checks and the skipped predictions), with
+the RenderStats of the rendered samples of the view. Each span records its
+wall time (until the python call returns) and its device synchronized time;
+spans are inclusive, e.g. the predict calls of the self-prompting are also
+counted in mask_to_prompt. The views are appended to `<prefix>.jsonl`, close()
+prints the summary table, writes it to `<prefix>_summary.json` and optionally a
+chrome://tracing file `<prefix>_chrome.json`. close() is a no-op when no view
+was traced since the last one, and the views traced after a close (e.g. a
+resumed training) are appended and saved by the next close. A disabled tracer
+returns shared no-op spans and the unwrapped functions.
+'''
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        self.tracer._sync()
+        synced = time.perf_counter() - self.start
+        self.tracer._record(self.name, self.start, wall, synced)
+        return False
+
+
+class SegTracer:
+    def __init__(self, prefix=None, enabled=False, chrome=False):
+        self.prefix = prefix
+        self.enabled = enabled and prefix is not None
+        self.chrome = chrome
+        self.sync = torch.cuda.is_available()
+        self.view = None
+        self.n_views = 0
+        # name -> [calls, wall, synced] over all the views
+        self.totals = {}
+        self.counters = {}
+        self.render_stats = RenderStats()
+        self.view_render_stats = None
+        self.view_time = 0
+        self.chrome_events = []
+        self.t0 = time.perf_counter()
+        self.trace_file = None
+        self.trace_started = False
+        # n_views at the last close
+        self.n_closed = None
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def _record(self, name, start, wall, synced):
+        for spans in [self.totals] + ([self.view['spans']] if self.view is not None else []):
+            acc = spans.setdefault(name, [0, 0., 0.])
+            acc[0] += 1
+            acc[1] += wall
+            acc[2] += synced
+        if self.chrome:
+            self.chrome_events.append({
+                'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                'ts': (start - self.t0) * 1e6, 'dur': synced * 1e6,
+            })
+
+    def span(self, name):
+        '''Context timing a stage'''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def wrap(self, name, fn):
+        '''fn timed as the stage `name` (fn itself when disabled).
+        A fn wrapped by another tracer (e.g. the methods of a SAM predictor shared
+        by several Sam3D) is unwrapped first, so that the wrappers do not nest.
+        '''
+        fn = getattr(fn, '_untraced', fn)
+        if not self.enabled:
+            return fn
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with _Span(self, name):
+                return fn(*args, **kwargs)
+        wrapped._untraced = fn
+        return wrapped
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.view is not None:
+            self.view['counters'][name] = self.view['counters'].get(name, 0) + n
+
+    @property
+    def stats(self):
+        '''The RenderStats of the current view to pass to the forward, None when disabled'''
+        if not self.enabled:
+            return None
+        return self.view_render_stats if self.view is not None else self.render_stats
+
+    def begin_view(self, idx):
+        if not self.enabled:
+            return
+        self._sync()
+        self.view = {'view': int(idx), 'spans': {}, 'counters': {}, 'start': time.perf_counter()}
+        self.view_render_stats = RenderStats()
+
+    def end_view(self):
+        if not self.enabled or self.view is None:
+            return
+        self._sync()
+        view, self.view = self.view, None
+        elapsed = time.perf_counter() - view.pop('start')
+        self.n_views += 1
+        self.view_time += elapsed
+        view['time_ms'] = elapsed * 1e3
+        view['spans'] = {
+            name: {'calls': calls, 'wall_ms': wall * 1e3, 'sync_ms': synced * 1e3}
+            for name, (calls, wall, synced) in view['spans'].items()}
+        view['render'] = self.view_render_stats.summary()
+        self.render_stats.merge(self.view_render_stats)
+        self.view_render_stats = None
+        if self.trace_file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.prefix)), exist_ok=True)
+            self.trace_file = open(self.prefix + '.jsonl', 'a' if self.trace_started else 'w')
+            self.trace_started = True
+        self.trace_file.write(json.dumps(view) + '\n')
+        self.trace_file.flush()
+
+    def summary(self):
+        '''Per-stage and counter totals over the traced views'''
+        n_views = max(self.n_views, 1)
+        spans = {
+            name: {
+                'calls': calls, 'calls_per_view': calls / n_views,
+                'wall_ms': wall / calls * 1e3, 'sync_ms': synced / calls * 1e3,
+                'total_s': synced, 'share': synced / self.view_time if self.view_time else 0,
+            }
+            for name, (calls, wall, synced) in self.totals.items()}
+        counters = {name: {'total': n, 'per_view': n / n_views} for name, n in self.counters.items()}
+        ret = {'n_views': self.n_views, 'time_s': self.view_time, 'spans': spans, 'counters': counters,
+               'render': self.render_stats.summary()}
+        if self.counters.get('iou_checks'):
+            ret['skip_rate'] = self.counters.get('skips', 0) / self.counters['iou_checks']
+        return ret
+
+    def summary_table(self, summary=None):
+        summary = summary or self.summary()
+        lines = [f'seg_trace: {summary["n_views"]} views in {summary["time_s"]:.2f}s',
+                 f'{"stage":>18s} {"calls":>7s} {"/view":>7s} {"wall ms":>9s} {"sync ms":>9s} {"total s":>9s} {"share":>6s}']
+        for name, s in summary['spans'].items():
+            lines.append(f'{name:>18s} {s["calls"]:7d} {s["calls_per_view"]:7.2f} {s["wall_ms"]:9.2f} '
+                         f'{s["sync_ms"]:9.2f} {s["total_s"]:9.2f} {s["share"]*100:5.1f}%')
+        for name, c in summary['counters'].items():
+            lines.append(f'{name:>18s} {c["total"]:>7d} {c["per_view"]:7.2f}')
+        for stage, s in summary['render']['stages'].items():
+            lines.append(f'{"samples_" + stage:>18s} {s["samples"]:>7d} {s["samples"] / max(summary["n_views"], 1):7.0f}')
+        if 'skip_rate' in summary:
+            lines.append(f'{"skip rate":>18s} {summary["skip_rate"]*100:6.1f}%')
+        return '\n'.join(lines)
+
+    def close(self):
+        '''Print and save the summary (and the chrome trace)'''
+        if not self.enabled:
+            return
+        self.end_view()
+        if self.n_closed == self.n_views:
+            return
+        self.n_closed = self.n_views
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+        summary = self.summary()
+        print(self.summary_table(summary))
+        os.makedirs(os.path.dirname(os.path.abspath(self.prefix)), exist_ok=True)
+        with open(self.prefix + '_summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        if self.chrome:
+            with open(self.prefix + '_chrome.json', 'w') as f:
+                json.dump({'traceEvents': self.chrome_events}, f)
+        print('seg_trace: saved to', self.prefix + '*')
@@ -111,12 +111,21 @@ def image_transform(image) -> torch.Tensor:
     return image_transformed
 
 
+_grounding_dino = None
+
+def load_grounding_dino():
+    '''GroundingDINO, loaded once per process'''
+    global _grounding_dino
+    if _grounding_dino is None:
+        model_root = './dependencies/GroundingDINO'
+        _grounding_dino = load_model(os.path.join(model_root, "groundingdino/config/GroundingDINO_SwinT_OGC.py"), os.path.join(model_root, "weights/groundingdino_swint_ogc.pth"))
+    return _grounding_dino
+
+
 def grounding_dino_prompt(image, text):
     
     image_tensor = image_transform(Image.fromarray(image))
-    model_root = './dependencies/GroundingDINO'
-    
-    model = load_model(os.path.join(model_root, "groundingdino/config/GroundingDINO_SwinT_OGC.py"), os.path.join(model_root, "weights/groundingdino_swint_ogc.pth"))
+    model = load_grounding_dino()
     
     BOX_TRESHOLD = 0.35
     TEXT_TRESHOLD = 0.25
@@ -1,8 +1,11 @@
 import copy
+import json
+import time
+import queue
+import threading
 import random
 
 import numpy as np
-import scipy.signal
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,6 +15,8 @@ from lib import seg_dcvgo as dcvgo
 
 from .load_data import load_data
 from .masked_adam import MaskedAdam
+from .running_avg_sgd import RunningAverageSGD
+from .checkpoint import read_checkpoint, resolve_seg_delta, apply_seg_delta
 from torch import Tensor
 
 ''' Misc
@@ -19,6 +24,44 @@ from torch import Tensor
 mse2psnr = lambda x : -10. * torch.log10(x)
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
 
+class StepTimer:
+    '''Accumulate the wall time of the phases of the training steps.
+    cuda is synchronized at every tick, so it is only meant for profiling.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = {}
+        self.n_steps = 0
+
+    def start(self):
+        if self.enabled:
+            torch.cuda.synchronize()
+            self.last = time.time()
+            self.n_steps += 1
+
+    def tick(self, name):
+        if self.enabled:
+            torch.cuda.synchronize()
+            now = time.time()
+            self.times[name] = self.times.get(name, 0) + now - self.last
+            self.last = now
+
+    def add(self, name, seconds):
+        '''Accumulate a time measured elsewhere, e.g. inside a phase.'''
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0) + seconds
+
+    def summary(self):
+        '''Average time per step of each phase (ms) and the peak cuda memory, then reset.'''
+        n_steps = max(self.n_steps, 1)
+        msg = ' / '.join(f'{k}: {v/n_steps*1e3:.2f}ms' for k, v in self.times.items())
+        if torch.cuda.is_available():
+            msg += f' / peak mem: {torch.cuda.max_memory_allocated()/2**30:.2f}GB'
+            torch.cuda.reset_peak_memory_stats()
+        self.times, self.n_steps = {}, 0
+        return msg
+
+
 def seed_everything(args):
     '''Seed everything for better reproducibility.
     NOTE that some pytorch operation is non-deterministic like the backprop of grid_samples
@@ -145,7 +188,8 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
         else:
             print(f'create_optimizer_or_freeze_model: param {k} freeze')
             param.requires_grad = False
-    return MaskedAdam(param_group)
+    return MaskedAdam(param_group, sparse_state=cfg_train.sparse_optim_state,
+                      sparse_cold_steps=cfg_train.sparse_optim_cold_steps)
 
 
 def create_segmentation_optimizer(model, cfg_train):
@@ -169,23 +213,35 @@ def create_segmentation_optimizer(model, cfg_train):
             print(f'create_optimizer_or_freeze_model: param {k} lr {lr}')
             if isinstance(param, nn.Module):
                 param = param.parameters()
-            param_group.append({'params': param, 'lr': lr})
+            # the mask grid keeps the average of the updates over the views
+            view_counts = model.mask_view_counts if k == 'seg_mask_grid' else None
+            param_group.append({'params': param, 'lr': lr, 'view_counts': view_counts})
         else:
             print(f'create_optimizer_or_freeze_model: param {k} freeze')
             param.requires_grad = False
-    return torch.optim.SGD(param_group)
+    return RunningAverageSGD(param_group)
 
 
 ''' Checkpoint utils
 '''
 def load_checkpoint(model, optimizer, ckpt_path, no_reload_optimizer):
-    ckpt = torch.load(ckpt_path)
+    # segmentation-delta checkpoints are composed with the NeRF checkpoint they are based on
+    ckpt_path, seg_delta = resolve_seg_delta(ckpt_path)
+    sections = ['global_step', 'model_state_dict']
+    if not no_reload_optimizer:
+        sections.append('optimizer_state_dict')
+    ckpt = read_checkpoint(ckpt_path, sections=sections)
     try:
         start = ckpt['global_step']
     except:
         start = 0
-    msg = model.load_state_dict(ckpt['model_state_dict'], strict = False)
+    state_dict = ckpt['model_state_dict']
+    if seg_delta is not None:
+        state_dict = {k: v for k, v in state_dict.items() if k not in seg_delta['grids']}
+    msg = model.load_state_dict(state_dict, strict = False)
     print("NeRF loaded with msg: ", msg)
+    if seg_delta is not None:
+        apply_seg_delta(model, seg_delta)
     if not no_reload_optimizer:
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
     return model, optimizer, start
@@ -202,15 +258,23 @@ def find_model(cfg):
 
 
 def load_model(model_class, ckpt_path):
-    ckpt = torch.load(ckpt_path)
+    ckpt_path, seg_delta = resolve_seg_delta(ckpt_path)
+    ckpt = read_checkpoint(ckpt_path, sections=['model_kwargs', 'model_state_dict'])
     num_objects = 1
-    if 'seg_mask_grid.grid' in ckpt['model_state_dict'].keys():
+    if seg_delta is not None:
+        num_objects = seg_delta['num_objects']
+    elif 'seg_mask_grid.grid' in ckpt['model_state_dict'].keys():
         num_objects = ckpt['model_state_dict']['seg_mask_grid.grid'].shape[1]
         
     print("Load model with num_objects =", num_objects)
 
     model = model_class(num_objects = num_objects, **ckpt['model_kwargs'])
-    msg = model.load_state_dict(ckpt['model_state_dict'], strict = False)
+    state_dict = ckpt['model_state_dict']
+    if seg_delta is not None:
+        # the base checkpoint may hold the mask grids of another number of objects
+        state_dict = {k: v for k, v in state_dict.items() if k not in seg_delta['grids']}
+        apply_seg_delta(model, seg_delta)
+    msg = model.load_state_dict(state_dict, strict = False)
     print("NeRF loaded with msg: ", msg)
     return model
 
@@ -253,6 +317,15 @@ def create_new_model(cfg, cfg_model, cfg_train, xyz_min, xyz_max, stage, coarse_
 
 ''' Evaluation metrics (ssim, lpips)
 '''
+def ssim_filter(filter_size=11, filter_sigma=1.5):
+    '''1D Gaussian blur filter of the mip-NeRF ssim'''
+    hw = filter_size // 2
+    shift = (2 * hw - filter_size + 1) / 2
+    f_i = ((np.arange(filter_size) - hw + shift) / filter_sigma)**2
+    filt = np.exp(-0.5 * f_i)
+    return filt / np.sum(filt)
+
+
 def rgb_ssim(img0, img1, max_val,
              filter_size=11,
              filter_sigma=1.5,
@@ -260,45 +333,50 @@ def rgb_ssim(img0, img1, max_val,
              k2=0.03,
              return_map=False):
     # Modified from https://github.com/google/mipnerf/blob/16e73dfdb52044dcceb47cda5243a686391a6e0f/internal/math.py#L58
-    assert len(img0.shape) == 3
+    # Evaluated in float64 on the device of img0 with separable depthwise convolutions.
+    # img0/img1: [H, W, 3] or a batch [B, H, W, 3] of numpy arrays or tensors; numpy
+    # inputs give numpy results, tensor inputs give (per-frame) tensors without sync.
+    is_numpy = isinstance(img0, np.ndarray)
+    img0 = torch.as_tensor(img0)
+    img1 = torch.as_tensor(img1, device=img0.device)
     assert img0.shape[-1] == 3
     assert img0.shape == img1.shape
-
-    # Construct a 1D Gaussian blur filter.
-    hw = filter_size // 2
-    shift = (2 * hw - filter_size + 1) / 2
-    f_i = ((np.arange(filter_size) - hw + shift) / filter_sigma)**2
-    filt = np.exp(-0.5 * f_i)
-    filt /= np.sum(filt)
-
-    # Blur in x and y (faster than the 2D convolution).
-    def convolve2d(z, f):
-        return scipy.signal.convolve2d(z, f, mode='valid')
-
-    filt_fn = lambda z: np.stack([
-        convolve2d(convolve2d(z[...,i], filt[:, None]), filt[None, :])
-        for i in range(z.shape[-1])], -1)
-    mu0 = filt_fn(img0)
-    mu1 = filt_fn(img1)
+    batched = img0.dim() == 4
+    if not batched:
+        img0, img1 = img0[None], img1[None]
+    assert img0.dim() == 4
+    img0 = img0.double().permute(0, 3, 1, 2)
+    img1 = img1.double().permute(0, 3, 1, 2)
+
+    # Blur in x and y (faster than the 2D convolution), all the statistics at once.
+    filt = torch.tensor(ssim_filter(filter_size, filter_sigma), dtype=torch.float64, device=img0.device)
+    z = torch.cat([img0, img1, img0**2, img1**2, img0 * img1], 1)
+    z = F.conv2d(z, filt.view(1, 1, -1, 1).expand(z.shape[1], 1, -1, 1), groups=z.shape[1])
+    z = F.conv2d(z, filt.view(1, 1, 1, -1).expand(z.shape[1], 1, 1, -1), groups=z.shape[1])
+    mu0, mu1, e00, e11, e01 = z.split(img0.shape[1], 1)
     mu00 = mu0 * mu0
     mu11 = mu1 * mu1
     mu01 = mu0 * mu1
-    sigma00 = filt_fn(img0**2) - mu00
-    sigma11 = filt_fn(img1**2) - mu11
-    sigma01 = filt_fn(img0 * img1) - mu01
+    sigma00 = e00 - mu00
+    sigma11 = e11 - mu11
+    sigma01 = e01 - mu01
 
     # Clip the variances and covariances to valid values.
     # Variance must be non-negative:
-    sigma00 = np.maximum(0., sigma00)
-    sigma11 = np.maximum(0., sigma11)
-    sigma01 = np.sign(sigma01) * np.minimum(
-        np.sqrt(sigma00 * sigma11), np.abs(sigma01))
+    sigma00 = sigma00.clamp(min=0.)
+    sigma11 = sigma11.clamp(min=0.)
+    sigma01 = torch.sign(sigma01) * torch.minimum(
+        torch.sqrt(sigma00 * sigma11), torch.abs(sigma01))
     c1 = (k1 * max_val)**2
     c2 = (k2 * max_val)**2
     numer = (2 * mu01 + c1) * (2 * sigma01 + c2)
     denom = (mu00 + mu11 + c1) * (sigma00 + sigma11 + c2)
-    ssim_map = numer / denom
-    ssim = np.mean(ssim_map)
+    ssim_map = (numer / denom).permute(0, 2, 3, 1)
+    ssim = ssim_map.mean([1, 2, 3])
+    if not batched:
+        ssim_map, ssim = ssim_map[0], ssim[0]
+    if is_numpy:
+        ssim_map, ssim = ssim_map.cpu().numpy(), ssim.cpu().numpy()
     return ssim_map if return_map else ssim
 
 
@@ -318,6 +396,117 @@ def rgb_lpips(np_gt, np_im, net_name, device):
     return __LPIPS__[net_name](gt, im, normalize=True).item()
 
 
+class ImageMetrics:
+    '''Per-frame psnr / ssim / lpips of rendered views against their ground truth.
+    psnr and ssim are computed on the current stream and stay on the device until
+    summary(). The frames are queued for lpips and both nets run on mini-batches
+    of `batch_size` frames in a worker thread, on its own CUDA stream, so they
+    overlap the render of the next views. At most one batch waits for the worker,
+    which bounds the memory of the queue.
+    '''
+    def __init__(self, eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, batch_size=8):
+        self.eval_ssim = eval_ssim
+        self.lpips_nets = [name for name, on in [('vgg', eval_lpips_vgg), ('alex', eval_lpips_alex)] if on]
+        self.batch_size = batch_size
+        self.scores = {'psnr': []}
+        if eval_ssim:
+            self.scores['ssim'] = []
+        for name in self.lpips_nets:
+            self.scores[f'lpips_{name}'] = []
+        self.queue = []
+        self.error = None
+        self.batches = queue.Queue(maxsize=1)
+        self.worker = None
+
+    def __len__(self):
+        return len(self.scores['psnr'])
+
+    @torch.no_grad()
+    def add(self, rgb, gt):
+        '''Score a [H, W, 3] render (tensor) against its ground truth (numpy or tensor).'''
+        rgb = torch.as_tensor(rgb)
+        gt = torch.as_tensor(gt, device=rgb.device).to(rgb.dtype)
+        self.scores['psnr'].append(-10. * torch.log10(torch.mean(torch.square(rgb - gt))))
+        if self.eval_ssim:
+            self.scores['ssim'].append(rgb_ssim(rgb, gt, max_val=1))
+        if len(self.lpips_nets):
+            if len(self.queue) and self.queue[0][0].shape != rgb.shape:
+                self.flush()
+            self.queue.append((rgb, gt))
+            if len(self.queue) >= self.batch_size:
+                self.flush()
+
+    @torch.no_grad()
+    def flush(self):
+        '''Hand the queued frames to the lpips worker.'''
+        if len(self.queue) == 0:
+            return
+        rgb = torch.stack([rgb for rgb, _ in self.queue]).permute(0, 3, 1, 2).contiguous()
+        gt = torch.stack([gt for _, gt in self.queue]).permute(0, 3, 1, 2).contiguous()
+        self.queue = []
+        event = None
+        if rgb.is_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(rgb.device))
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._run, daemon=True)
+            self.worker.start()
+        self.batches.put((rgb, gt, event))
+
+    def wait(self):
+        '''Block until the lpips of all the flushed frames are scored.'''
+        if self.worker is not None:
+            self.batches.put(None)
+            self.worker.join()
+            self.worker = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    @torch.no_grad()
+    def _run(self):
+        stream = None
+        while True:
+            task = self.batches.get()
+            if task is None:
+                return
+            rgb, gt, event = task
+            try:
+                if event is not None:
+                    if stream is None:
+                        stream = torch.cuda.Stream(rgb.device)
+                    # the frames are produced on the render stream
+                    stream.wait_event(event)
+                    rgb.record_stream(stream)
+                    gt.record_stream(stream)
+                with torch.cuda.stream(stream):
+                    scores = {}
+                    for name in self.lpips_nets:
+                        if name not in __LPIPS__:
+                            __LPIPS__[name] = init_lpips(name, rgb.device)
+                        scores[name] = __LPIPS__[name](gt, rgb, normalize=True).flatten().unbind()
+                if stream is not None:
+                    # the scores are read on the render stream by summary()
+                    stream.synchronize()
+                for name, v in scores.items():
+                    self.scores[f'lpips_{name}'].extend(v)
+            except Exception as e:
+                self.error = e
+
+    def summary(self):
+        '''Mean and per-frame scores (python floats).'''
+        self.flush()
+        self.wait()
+        per_frame = {k: torch.stack(v).tolist() if len(v) else [] for k, v in self.scores.items()}
+        mean = {k: float(np.mean(v)) for k, v in per_frame.items() if len(v)}
+        return {'n_frames': len(self), 'mean': mean, 'per_frame': per_frame}
+
+    def write(self, path):
+        '''Dump the summary to a json metrics file.'''
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
 ''' generate rays
 '''
 def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
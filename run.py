@@ -19,6 +19,10 @@ from lib import utils, dmpigo
 from lib import dvgo
 from lib import dcvgo
 from lib.load_data import load_data
+from lib.checkpoint import AsyncCheckpointWriter
+from lib.ray_loader import RayBatchLoader
+from lib.ray_sampler import PermutationSampler, StratifiedSampler, ImportanceSampler
+from lib.render_stats import RenderStats, write_render_stats, summary_table as render_stats_table
 
 
 
@@ -56,12 +60,18 @@ def config_parser():
     parser.add_argument("--eval_ssim", action='store_true')
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
+    parser.add_argument("--render_stats", action='store_true',
+                        help='dump the per-view sample counts of the pruning stages to render_stats.json')
 
     # logging/saving options
     parser.add_argument("--i_print",   type=int, default=500,
                         help='frequency of console printout and metric loggin')
     parser.add_argument("--i_weights", type=int, default=5000,
                         help='frequency of weight ckpt saving')
+    parser.add_argument("--keep_ckpts", type=int, default=0,
+                        help='number of numbered ckpts to keep, 0 to keep all of them')
+    parser.add_argument("--time_steps", action='store_true',
+                        help='print a per-step timing breakdown (synchronizes cuda at every phase)')
 
     parser.add_argument("--freeze_density", action='store_true',
                         help='freeze density grid')
@@ -76,8 +86,10 @@ def config_parser():
 def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, dump_images=False, cfg=None, device='cuda',
                       render_factor=0, render_video_flipy=False, render_video_rot90=0,
-                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, render_fct=0.0):
+                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, render_fct=0.0,
+                      render_stats=False):
     '''Render images for the given viewpoints; run evaluation if gt given.
+    @render_stats: dump the RenderStats of the views to savedir/render_stats.json.
     '''
     assert len(render_poses) == len(HW) and len(HW) == len(Ks)
 
@@ -90,10 +102,8 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     rgbs = []
     depths = []
     bgmaps = []
-    psnrs = []
-    ssims = []
-    lpips_alex = []
-    lpips_vgg = []
+    metrics = utils.ImageMetrics(eval_ssim, eval_lpips_alex, eval_lpips_vgg)
+    view_stats = []
 
     for i, c2w in enumerate(tqdm(render_poses)):
 
@@ -107,8 +117,9 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
         rays_o = rays_o.flatten(0,-2).to(device)
         rays_d = rays_d.flatten(0,-2).to(device)
         viewdirs = viewdirs.flatten(0,-2).to(device)
+        stats = RenderStats() if render_stats else None
         render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, **render_kwargs).items() if k in keys}
+            {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, stats=stats, **render_kwargs).items() if k in keys}
             for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
         ]
         render_result = {
@@ -122,24 +133,27 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
         rgbs.append(rgb)
         depths.append(depth)
         bgmaps.append(bgmap)
+        if stats is not None:
+            view_stats.append(stats)
         if i==0:
             print('Testing', rgb.shape)
 
         if gt_imgs is not None and render_factor==0:
-            p = -10. * np.log10(np.mean(np.square(rgb - gt_imgs[i])))
-            psnrs.append(p)
-            if eval_ssim:
-                ssims.append(utils.rgb_ssim(rgb, gt_imgs[i], max_val=1))
-            if eval_lpips_alex:
-                lpips_alex.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='alex', device=c2w.device))
-            if eval_lpips_vgg:
-                lpips_vgg.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
-
-    if len(psnrs):
-        print('Testing psnr', np.mean(psnrs), '(avg)')
-        if eval_ssim: print('Testing ssim', np.mean(ssims), '(avg)')
-        if eval_lpips_vgg: print('Testing lpips (vgg)', np.mean(lpips_vgg), '(avg)')
-        if eval_lpips_alex: print('Testing lpips (alex)', np.mean(lpips_alex), '(avg)')
+            # scored on the device of the render, gathered at the end
+            metrics.add(render_result['rgb_marched'], gt_imgs[i])
+
+    if len(metrics):
+        mean = metrics.summary()['mean']
+        print('Testing psnr', mean['psnr'], '(avg)')
+        if eval_ssim: print('Testing ssim', mean['ssim'], '(avg)')
+        if eval_lpips_vgg: print('Testing lpips (vgg)', mean['lpips_vgg'], '(avg)')
+        if eval_lpips_alex: print('Testing lpips (alex)', mean['lpips_alex'], '(avg)')
+        if savedir is not None:
+            metrics.write(os.path.join(savedir, 'metrics.json'))
+
+    if len(view_stats) and savedir is not None:
+        report = write_render_stats(os.path.join(savedir, 'render_stats.json'), view_stats)
+        print(render_stats_table(report['total']))
 
     if render_video_flipy:
         for i in range(len(rgbs)):
@@ -400,7 +414,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                     ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
                     flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
                     model=model, render_kwargs=render_kwargs)
-        elif cfg_train.ray_sampler == 'flatten':
+        elif cfg_train.ray_sampler in ['flatten', 'stratified', 'importance']:
             rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = dvgo.get_training_rays_flatten(
                 rgb_tr_ori=rgb_tr_ori,
                 train_poses=poses[i_train],
@@ -413,8 +427,19 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                 HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
                 flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
 
-        index_generator = dvgo.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
-        batch_index_sampler = lambda: next(index_generator)
+        if cfg_train.ray_sampler == 'stratified':
+            batch_index_sampler = StratifiedSampler(imsz, cfg_train.N_rand, seed=args.seed, device=rgb_tr.device)
+        elif cfg_train.ray_sampler == 'importance':
+            # the tile errors and loss weights live next to the rendered rays
+            batch_index_sampler = ImportanceSampler(
+                    len(rgb_tr), cfg_train.N_rand, tile=cfg_train.importance_tile,
+                    rebuild_every=cfg_train.importance_rebuild_every,
+                    uniform_frac=cfg_train.importance_uniform_frac,
+                    seed=args.seed, device=device)
+        elif cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
+            batch_index_sampler = PermutationSampler(len(rgb_tr), cfg_train.N_rand, seed=args.seed, device=rgb_tr.device)
+        else:
+            batch_index_sampler = None
 
         return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
 
@@ -442,6 +467,31 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
     torch.cuda.empty_cache()
     psnr_lst = []
     time0 = time.time()
+    ckpt_writer = AsyncCheckpointWriter(keep_last=args.keep_ckpts)
+    ray_loader = None
+    # the importance sampler needs the errors of a batch before drawing the next one
+    if cfg.data.load2gpu_on_the_fly and cfg_train.prefetch_rays and cfg_train.ray_sampler != 'importance':
+        if batch_index_sampler is not None:
+            index_sampler = batch_index_sampler
+        elif cfg_train.ray_sampler == 'random':
+            n_tr, H_tr, W_tr = rgb_tr.shape[:3]
+            def index_sampler():
+                sel_b = torch.randint(n_tr, [cfg_train.N_rand], device='cpu')
+                sel_r = torch.randint(H_tr, [cfg_train.N_rand], device='cpu')
+                sel_c = torch.randint(W_tr, [cfg_train.N_rand], device='cpu')
+                return (sel_b * H_tr + sel_r) * W_tr + sel_c
+        else:
+            raise NotImplementedError
+        ray_loader = RayBatchLoader(rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, index_sampler, device)
+        # the loader keeps its own pinned copy of the rays
+        rgb_tr = rays_o_tr = rays_d_tr = viewdirs_tr = None
+    step_timer = utils.StepTimer(enabled=args.time_steps)
+    # mixed precision: the model forward runs under autocast, the custom autograd
+    # functions and the losses stay in fp32
+    if cfg_train.amp not in [None, 'fp16', 'bf16']:
+        raise ValueError(f'Unknown amp mode {cfg_train.amp}')
+    amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(cfg_train.amp)
+    scaler = torch.cuda.amp.GradScaler(enabled=cfg_train.amp == 'fp16')
     global_step = -1
     for global_step in trange(1+start, 1+args.stop_at):
 
@@ -465,12 +515,16 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             torch.cuda.empty_cache()
 
         # random sample rays
-        if cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
+        step_timer.start()
+        if ray_loader is not None:
+            target, rays_o, rays_d, viewdirs = ray_loader.next()
+        elif batch_index_sampler is not None:
             sel_i = batch_index_sampler()
-            target = rgb_tr[sel_i]
-            rays_o = rays_o_tr[sel_i]
-            rays_d = rays_d_tr[sel_i]
-            viewdirs = viewdirs_tr[sel_i]
+            sel_tr = sel_i.to(rgb_tr.device)
+            target = rgb_tr[sel_tr]
+            rays_o = rays_o_tr[sel_tr]
+            rays_d = rays_d_tr[sel_tr]
+            viewdirs = viewdirs_tr[sel_tr]
         elif cfg_train.ray_sampler == 'random':
             sel_b = torch.randint(rgb_tr.shape[0], [cfg_train.N_rand])
             sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
@@ -482,22 +536,34 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
         else:
             raise NotImplementedError
 
-        if cfg.data.load2gpu_on_the_fly:
+        if cfg.data.load2gpu_on_the_fly and ray_loader is None:
             target = target.to(device)
             rays_o = rays_o.to(device)
             rays_d = rays_d.to(device)
             viewdirs = viewdirs.to(device)
+        step_timer.tick('data')
+        if ray_loader is not None:
+            # the part of `data` spent waiting for the prefetch worker
+            step_timer.add('data_wait', ray_loader.pop_wait_time())
 
         # volume rendering
-        render_result = model(
-            rays_o, rays_d, viewdirs,
-            global_step=global_step, is_train=True,
-            **render_kwargs)
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+            render_result = model(
+                rays_o, rays_d, viewdirs,
+                global_step=global_step, is_train=True,
+                **render_kwargs)
+        step_timer.tick('render')
 
 
         # gradient descent step
         optimizer.zero_grad(set_to_none=True)
-        loss = cfg_train.weight_main * F.mse_loss(render_result['rgb_marched'], target)
+        if cfg_train.ray_sampler == 'importance':
+            # reweighted to estimate the mse over all the rays
+            ray_mse = (render_result['rgb_marched'] - target).pow(2).mean(-1)
+            loss = cfg_train.weight_main * (ray_mse * batch_index_sampler.weights(sel_i)).mean()
+            batch_index_sampler.update(sel_i, ray_mse.detach())
+        else:
+            loss = cfg_train.weight_main * F.mse_loss(render_result['rgb_marched'], target)
         psnr = utils.mse2psnr(loss.detach())
 
 
@@ -524,7 +590,10 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             rgbper_loss = (rgbper * render_result['weights'].detach()).sum() / len(rays_o)
             loss += cfg_train.weight_rgbper * rgbper_loss
 
-        loss.backward()
+        scaler.scale(loss).backward()
+        # MaskedAdam and the total variation kernels read/write the raw grads
+        scaler.unscale_(optimizer)
+        step_timer.tick('backward')
 
         if global_step<cfg_train.tv_before and global_step>cfg_train.tv_after and global_step%cfg_train.tv_every==0:
             if not args.freeze_density:
@@ -536,7 +605,9 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                     model.k0_total_variation_add_grad(
                         cfg_train.weight_tv_k0/len(rays_o), global_step<cfg_train.tv_dense_before)
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
+        step_timer.tick('optimizer')
         psnr_lst.append(psnr.item())
 
         # update lr
@@ -551,34 +622,35 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             eps_time_str = f'{eps_time//3600:02.0f}:{eps_time//60%60:02.0f}:{eps_time%60:02.0f}'
             tqdm.write(f'scene_rep_reconstruction ({stage}): iter {global_step:6d} / '
                        f'Loss: {loss.item():.9f} / PSNR: {np.mean(psnr_lst):5.2f} / '
-                       f'Eps: {eps_time_str}')
+                       f'Eps: {eps_time_str}' +
+                       (f' / Epoch: {batch_index_sampler.epoch}' if batch_index_sampler is not None else ''))
+            if step_timer.enabled:
+                tqdm.write(f'scene_rep_reconstruction ({stage}): step time / {step_timer.summary()}')
             psnr_lst = []
 
         if global_step%args.i_weights==0:
             path = os.path.join(cfg.basedir, cfg.expname, f'{stage}_{global_step:06d}.tar')
-            torch.save({
-                'global_step': global_step,
-                'model_kwargs': model.get_kwargs(),
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }, path)
-            torch.save({
+            ckpt_writer.save({
                 'global_step': global_step,
                 'model_kwargs': model.get_kwargs(),
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
-            }, last_ckpt_path)
-            print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', path)
-            print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', last_ckpt_path)
+            }, path, last_paths=[last_ckpt_path])
+            print(f'scene_rep_reconstruction ({stage}): saving checkpoints at', path)
+            print(f'scene_rep_reconstruction ({stage}): saving checkpoints at', last_ckpt_path)
 
     if global_step != -1:
-        torch.save({
+        ckpt_writer.save({
             'global_step': global_step,
             'model_kwargs': model.get_kwargs(),
             'model_state_dict': model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
-        }, last_ckpt_path)
-        print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', last_ckpt_path)
+        }, last_ckpt_path, numbered=False)
+        print(f'scene_rep_reconstruction ({stage}): saving checkpoints at', last_ckpt_path)
+    # the next stage reloads the last checkpoint
+    ckpt_writer.close()
+    if ray_loader is not None:
+        ray_loader.close()
 
 
 def train(args, cfg, data_dict):
@@ -722,7 +794,8 @@ if __name__=='__main__':
                 'flip_y': cfg.data.flip_y,
                 'render_depth': True,
             },
-            "device": device
+            "device": device,
+            "render_stats": args.render_stats,
         }
 
         render_viewpoints_kwargs['model'] = render_viewpoints_kwargs['model'].cuda()
@@ -0,0 +1,43 @@
+'''Headless batch segmentation of many objects / scenes.
+
+Runs the segmentation jobs of a manifest (see lib/seg_batch.py) without the GUI,
+keeping SAM and the scenes loaded across the jobs. The arguments after the batch
+options are passed to every job, as to run_seg_gui.py:
+
+    python run_seg_batch.py --manifest jobs.jsonl --metrics logs/seg_batch.jsonl --use_fine_stage --num_prompts 3
+'''
+import argparse
+
+import torch
+
+from lib.seg_batch import SegBatchRunner, load_manifest
+
+
+def batch_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True,
+                        help='json / jsonl file of the jobs')
+    parser.add_argument("--metrics", type=str, default='seg_batch_metrics.jsonl',
+                        help='jsonl file the metrics of the jobs are appended to')
+    parser.add_argument("--max_scenes", type=int, default=2,
+                        help='number of scenes (images / poses) kept loaded')
+    parser.add_argument("--redo", action='store_true',
+                        help='re-run the stages whose seg checkpoint exists')
+    return parser
+
+
+if __name__=='__main__':
+    # the unknown arguments are the run_seg_gui.py arguments of the jobs
+    bargs, argv = batch_parser().parse_known_args()
+    jobs = load_manifest(bargs.manifest)
+
+    # init enviroment
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    runner = SegBatchRunner(argv, device=device, max_scenes=bargs.max_scenes,
+                            redo=bargs.redo, metrics_path=bargs.metrics)
+    runner.run(jobs)
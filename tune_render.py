@@ -0,0 +1,96 @@
+'''Tune the stepsize / fast_color_thres of the renders of a scene.
+
+Renders a few held-out views at reduced resolution with the candidate settings,
+compares them to a fine reference and writes the selected setting to the render
+profile of the checkpoint (<basedir>/<expname>/render_profile_<ckpt name>.json),
+which render_fn then uses for the renders of this checkpoint.
+
+    python tune_render.py --config configs/llff/seg/seg_fern.py --tune_factor 4 --tune_views 3
+'''
+import os
+
+import numpy as np
+import torch
+
+from lib.config_loader import Config
+from lib import utils
+from lib.configs import config_parser
+from lib.render_profile import tune_render_settings, write_render_profile
+
+
+def tune_parser():
+    parser = config_parser()
+    parser.add_argument("--tune_views", type=int, default=3,
+                        help='number of held-out views to render')
+    parser.add_argument("--tune_factor", type=float, default=4,
+                        help='downsampling factor of the tuning renders')
+    parser.add_argument("--tune_stepsizes", type=float, nargs='+', default=[0.25, 0.5, 1.0, 1.5])
+    parser.add_argument("--tune_fast_color_thres", type=float, nargs='+', default=[0, 1e-4, 1e-3, 1e-2, 1e-1])
+    parser.add_argument("--tune_ref_stepsize", type=float, default=None,
+                        help='stepsize of the reference renders, half the smallest candidate by default')
+    parser.add_argument("--tune_min_psnr", type=float, default=35.,
+                        help='min psnr w.r.t. the reference')
+    parser.add_argument("--tune_min_iou", type=float, default=0.98,
+                        help='min mask IoU w.r.t. the reference')
+    parser.add_argument("--tune_cpu", action='store_true',
+                        help='profile on cpu even if cuda is available')
+    return parser
+
+
+def fetch_tune_views(data_dict, n_views, factor):
+    '''n_views evenly spaced test views (train views if no test split), (c2w, H, W, K) each'''
+    i_views = data_dict['i_test'] if len(data_dict['i_test']) else data_dict['i_train']
+    i_views = np.asarray(i_views)[np.linspace(0, len(i_views)-1, min(n_views, len(i_views))).round().astype(int)]
+    views = []
+    for i in i_views:
+        H, W = data_dict['HW'][i]
+        K = np.copy(data_dict['Ks'][i])
+        if factor != 0:
+            H, W = int(H / factor), int(W / factor)
+            K[:2, :3] /= factor
+        views.append((torch.Tensor(data_dict['poses'][i]), H, W, K))
+    return views
+
+
+if __name__=='__main__':
+    args = tune_parser().parse_args()
+    cfg = Config.fromfile(args.config)
+
+    if torch.cuda.is_available() and not args.tune_cpu:
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    utils.seed_everything(args)
+    data_dict = utils.load_everything(args=args, cfg=cfg)
+
+    e_flag = args.sp_name if args.sp_name is not None else ''
+    if args.ft_path:
+        ckpt_path = args.ft_path
+    else:
+        ckpt_paths = [os.path.join(cfg.basedir, cfg.expname, name) for name in [
+            'fine_segmentation'+e_flag+'.tar', 'coarse_segmentation'+e_flag+'.tar', 'fine_last.tar']]
+        ckpt_path = next((path for path in ckpt_paths if os.path.exists(path)), ckpt_paths[-1])
+    print("\033[96mTuning with ckpt "+ckpt_path+"\033[0m")
+    model = utils.load_model(utils.find_model(cfg), ckpt_path).to(device)
+    model.eval()
+
+    render_kwargs = {
+        'near': data_dict['near'],
+        'far': data_dict['far'],
+        'bg': 1 if cfg.data.white_bkgd else 0,
+        'inverse_y': cfg.data.inverse_y,
+        'flip_x': cfg.data.flip_x,
+        'flip_y': cfg.data.flip_y,
+    }
+    views = fetch_tune_views(data_dict, args.tune_views, args.tune_factor)
+    ref_stepsize = args.tune_ref_stepsize or min(args.tune_stepsizes) / 2
+    profile = tune_render_settings(
+            model, views, cfg.data.ndc, render_kwargs, cfg,
+            stepsizes=args.tune_stepsizes, fast_color_threses=args.tune_fast_color_thres,
+            ref_stepsize=ref_stepsize, min_psnr=args.tune_min_psnr, min_iou=args.tune_min_iou)
+    profile.update({'device': str(device), 'tune_factor': args.tune_factor,
+                    'config': {'stepsize': cfg.fine_model_and_render.stepsize,
+                               'fast_color_thres': model.fast_color_thres}})
+    path = write_render_profile(cfg, ckpt_path, profile)
+    print(f'render_profile: stepsize {profile["stepsize"]} fast_color_thres {profile["fast_color_thres"]} saved to {path}')